@@ -28,8 +28,177 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import time
 import dot11
+import eviction
 from helpers import get_vendor_from_oui
+from helpers import mac_address_to_bytes
+
+# Weight of the last sample on the smoothed rssi.
+RSSI_EWMA_ALPHA = 0.125
+# Rssi quantiles estimated per Network and Station.
+RSSI_QUANTILES = (0.5,)
+
+
+class P2Quantile(object):
+    '''Streaming quantile estimator (P-square algorithm, Jain and
+       Chlamtac). Keeps five markers whatever the number of samples.'''
+
+    def __init__(self, p):
+        self._p = p
+        self._heights = []
+        self._positions = [1, 2, 3, 4, 5]
+        self._desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self._increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def update(self, x):
+        '''Adds a sample.'''
+        q = self._heights
+        if len(q) < 5:
+            q.append(float(x))
+            q.sort()
+            return
+        n = self._positions
+        if x < q[0]:
+            q[0] = float(x)
+            k = 0
+        elif x >= q[4]:
+            q[4] = float(x)
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        desired = self._desired
+        increments = self._increments
+        for i in range(5):
+            desired[i] += increments[i]
+        # Adjust the middle markers heights.
+        for i in range(1, 4):
+            d = desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or \
+               (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                height = q[i] + float(d) / (n[i + 1] - n[i - 1]) * \
+                    ((n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) /
+                     (n[i + 1] - n[i]) +
+                     (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) /
+                     (n[i] - n[i - 1]))
+                if not q[i - 1] < height < q[i + 1]:
+                    height = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = height
+                n[i] += d
+
+    def get(self):
+        '''Returns the quantile estimate or None without samples.'''
+        q = self._heights
+        if len(q) == 5:
+            return q[2]
+        if not q:
+            return None
+        return q[int(round(self._p * (len(q) - 1)))]
+
+    def getState(self):
+        '''Returns the estimator state as a tuple of plain values.'''
+        return (self._p, tuple(self._heights), tuple(self._positions))
+
+    @classmethod
+    def fromState(cls, state):
+        '''Returns the estimator saved by getState.'''
+        p, heights, positions = state
+        estimator = cls(p)
+        estimator._heights = list(heights)
+        estimator._positions = list(positions)
+        # The desired positions moved once per sample after the first
+        # five, the last marker position counts the samples.
+        moves = positions[4] - 5
+        estimator._desired = [d + moves * i for d, i in
+                              zip(estimator._desired, estimator._increments)]
+        return estimator
+
+
+class RssiStatistics(object):
+    '''Streaming rssi statistics: smoothed value (EWMA), minimum,
+       maximum and P-square quantiles, in constant time and memory.'''
+
+    def __init__(self, alpha=RSSI_EWMA_ALPHA, quantiles=RSSI_QUANTILES):
+        self._alpha = alpha
+        self._count = 0
+        self._ewma = None
+        self._min = None
+        self._max = None
+        self._quantiles = [(p, P2Quantile(p)) for p in quantiles]
+
+    def update(self, rssi):
+        '''Adds a rssi sample, None samples are ignored.'''
+        if rssi is None:
+            return
+        self._count += 1
+        if self._ewma is None:
+            self._ewma = float(rssi)
+            self._min = rssi
+            self._max = rssi
+        else:
+            self._ewma += self._alpha * (rssi - self._ewma)
+            if rssi < self._min:
+                self._min = rssi
+            elif rssi > self._max:
+                self._max = rssi
+        for p, estimator in self._quantiles:
+            estimator.update(rssi)
+
+    def getCount(self):
+        '''Returns the number of samples.'''
+        return self._count
+
+    def getSmoothed(self):
+        '''Returns the smoothed rssi rounded to an integer or None.'''
+        if self._ewma is None:
+            return None
+        return int(round(self._ewma))
+
+    def getMin(self):
+        '''Returns the minimum rssi or None.'''
+        return self._min
+
+    def getMax(self):
+        '''Returns the maximum rssi or None.'''
+        return self._max
+
+    def getQuantile(self, p):
+        '''Returns the estimate of the p quantile or None.'''
+        for quantile, estimator in self._quantiles:
+            if quantile == p:
+                return estimator.get()
+        raise KeyError("Quantile %r not estimated." % p)
+
+    def toDict(self):
+        '''Returns a dictionary with the statistics that have samples.'''
+        if self._ewma is None:
+            return {}
+        result = {'rssi': self.getSmoothed(),
+                  'rssiMin': self._min,
+                  'rssiMax': self._max}
+        for p, estimator in self._quantiles:
+            result['rssiP%d' % int(p * 100)] = int(round(estimator.get()))
+        return result
+
+    def getState(self):
+        '''Returns the statistics state as a tuple of plain values.'''
+        return (self._alpha, self._count, self._ewma, self._min, self._max,
+                tuple(e.getState() for p, e in self._quantiles))
+
+    @classmethod
+    def fromState(cls, state):
+        '''Returns the statistics saved by getState.'''
+        statistics = cls.__new__(cls)
+        (statistics._alpha, statistics._count, statistics._ewma,
+         statistics._min, statistics._max, quantiles) = state
+        statistics._quantiles = [(q[0], P2Quantile.fromState(q))
+                                 for q in quantiles]
+        return statistics
 
 
 class Station(object):
@@ -40,6 +209,7 @@ class Station(object):
         self._conneted = False
         self._probes = []
         self._sentDataFrames = 0
+        self._rssi = RssiStatistics()
 
     def getMacAddress(self):
         '''Returns the Station MAC address.'''
@@ -61,10 +231,36 @@ class Station(object):
     def incrementDataFrameStatistics(self):
         self._sentDataFrames += 1
 
+    def updateRssi(self, rssi):
+        '''Adds the rssi of a frame sent by the Station.'''
+        self._rssi.update(rssi)
+
+    def getRssiStatistics(self):
+        '''Returns the Station RssiStatistics.'''
+        return self._rssi
+
     def toDict(self):
-        return {'addr': self._mac_address,
-                'vendor': self._vendor,
-                'sentDataFrames': self._sentDataFrames}
+        result = {'addr': self._mac_address,
+                  'vendor': self._vendor,
+                  'sentDataFrames': self._sentDataFrames}
+        result.update(self._rssi.toDict())
+        return result
+
+    def getState(self):
+        '''Returns the Station state as a tuple of plain values.'''
+        return (self._mac_address, self._vendor, self._conneted,
+                tuple(self._probes), self._sentDataFrames,
+                self._rssi.getState())
+
+    @classmethod
+    def fromState(cls, state):
+        '''Returns the Station saved by getState.'''
+        station = cls.__new__(cls)
+        (station._mac_address, station._vendor, station._conneted, probes,
+         station._sentDataFrames, rssi) = state
+        station._probes = list(probes)
+        station._rssi = RssiStatistics.fromState(rssi)
+        return station
 
 
 class Network(object):
@@ -72,16 +268,23 @@ class Network(object):
     MGMT_FRAMES_COUNT = "Management frames count"
     DATA_FRAMES_COUNT = "Data frames count"
 
+    # Fields of the state returned by getState.
+    STATE_STATIONS = 10
+    STATE_LAST_SEEN = 11
+
     def __init__(self, beacon):
         if not isinstance(beacon, dot11.Beacon):
             raise TypeError("Network constructor is expecting Beacon class.")
 
         self._processBeacon(beacon)
+        self._beaconDigest = None
+        self._rssi = RssiStatistics()
 
         self._statistics = {Network.MGMT_FRAMES_COUNT: 0,
                             Network.DATA_FRAMES_COUNT: 0}
 
         self._stations = {}
+        self._lastSeen = 0
 
     def _processBeacon(self, beacon):
         self._bssid = beacon.getBssid()
@@ -111,6 +314,28 @@ class Network(object):
         else:
             self._channel = 0
 
+    def update(self, beacon):
+        '''Updates the Network information from a new Beacon.'''
+        if not isinstance(beacon, dot11.Beacon):
+            raise TypeError("Network update is expecting Beacon class.")
+        self._processBeacon(beacon)
+
+    def getBeaconDigest(self):
+        '''Returns the digest of the last processed Beacon.'''
+        return self._beaconDigest
+
+    def setBeaconDigest(self, digest):
+        '''Sets the digest of the last processed Beacon.'''
+        self._beaconDigest = digest
+
+    def updateRssi(self, rssi):
+        '''Adds the rssi of a beacon sent by the Network.'''
+        self._rssi.update(rssi)
+
+    def getRssiStatistics(self):
+        '''Returns the Network RssiStatistics.'''
+        return self._rssi
+
     def getBssid(self):
         '''Returns the Network BSSID'''
         return self._bssid
@@ -158,7 +383,119 @@ class Network(object):
         if not addr in self._stations:
             self._stations[addr] = station
 
+    def removeStation(self, mac_address):
+        '''Removes the Station with mac_address, if any.'''
+        self._stations.pop(mac_address, None)
+
     def getStations(self):
         '''Returns a list with the Stations that have exchange Data frames
            with the Network.'''
         return self._stations
+
+    def getLastSeen(self):
+        '''Returns the time the Network was last updated.'''
+        return self._lastSeen
+
+    def setLastSeen(self, timestamp):
+        '''Sets the time the Network was last updated.'''
+        self._lastSeen = timestamp
+
+    def getState(self):
+        '''Returns the Network state, stations included, as a tuple of
+           plain values.'''
+        statistics = self._statistics
+        return (self._bssid, self._ssid, self._cloacked, self._security,
+                self._vendor, self._channel, self._beaconDigest,
+                self._rssi.getState(),
+                statistics[Network.MGMT_FRAMES_COUNT],
+                statistics[Network.DATA_FRAMES_COUNT],
+                tuple(s.getState() for s in self._stations.itervalues()),
+                self._lastSeen)
+
+    @classmethod
+    def fromState(cls, state):
+        '''Returns the Network saved by getState.'''
+        network = cls.__new__(cls)
+        (network._bssid, network._ssid, network._cloacked, network._security,
+         network._vendor, network._channel, network._beaconDigest, rssi,
+         management, data, stations, network._lastSeen) = state
+        network._rssi = RssiStatistics.fromState(rssi)
+        network._statistics = {Network.MGMT_FRAMES_COUNT: management,
+                               Network.DATA_FRAMES_COUNT: data}
+        from_state = Station.fromState
+        network._stations = dict((s[0], from_state(s)) for s in stations)
+        return network
+
+
+class LinkStatistics(object):
+    '''Link layer statistics of every address seen on the air.
+
+       Addresses are kept as 6 bytes strings so the frame handlers do not
+       need to convert them. The statistics of the addresses past limit or
+       not seen for ttl seconds are dropped by expire, 0 disables either
+       bound.
+    '''
+
+    def __init__(self, limit=0, ttl=0):
+        self._airtime = {}
+        # [frames, retries, duplicates]
+        self._sequenced = {}
+        self._lru = eviction.LruTracker(limit, ttl)
+        self._now = time.time()
+
+    def expire(self, now):
+        '''Drops the statistics of the least recently seen addresses past
+           the limit or the ttl.'''
+        self._now = now
+        for raw_address in self._lru.expire(now):
+            self._airtime.pop(raw_address, None)
+            self._sequenced.pop(raw_address, None)
+
+    def getEvicted(self):
+        '''Returns the number of addresses dropped by expire.'''
+        return self._lru.evicted
+
+    def addAirtime(self, raw_address, duration):
+        '''Adds duration microseconds of airtime to raw_address.'''
+        self._lru.touchOnce(raw_address, self._now)
+        airtime = self._airtime
+        airtime[raw_address] = airtime.get(raw_address, 0) + duration
+
+    def getAirtime(self, mac_address):
+        '''Returns the airtime in microseconds used by mac_address.'''
+        return self._airtime.get(mac_address_to_bytes(mac_address), 0)
+
+    def addSequencedFrame(self, raw_address, retry, duplicate):
+        '''Accounts a frame with sequence control sent by raw_address.'''
+        self._lru.touchOnce(raw_address, self._now)
+        counters = self._sequenced.get(raw_address)
+        if counters is None:
+            counters = [0, 0, 0]
+            self._sequenced[raw_address] = counters
+        counters[0] += 1
+        if retry:
+            counters[1] += 1
+        if duplicate:
+            counters[2] += 1
+
+    def getRetryRate(self, mac_address):
+        '''Returns the ratio of frames sent by mac_address with the Retry
+           flag set.'''
+        counters = self._sequenced.get(mac_address_to_bytes(mac_address))
+        if not counters:
+            return 0.0
+        return float(counters[1]) / counters[0]
+
+    def forget(self, mac_address):
+        '''Removes the statistics of mac_address.'''
+        raw_address = mac_address_to_bytes(mac_address)
+        self._airtime.pop(raw_address, None)
+        self._sequenced.pop(raw_address, None)
+        self._lru.discard(raw_address)
+
+    def getDuplicates(self, mac_address):
+        '''Returns the number of duplicated frames sent by mac_address.'''
+        counters = self._sequenced.get(mac_address_to_bytes(mac_address))
+        if not counters:
+            return 0
+        return counters[2]
@@ -0,0 +1,242 @@
+#/usr/bin/env python
+
+# Copyright (c) 2012, Andres Blanco and Matias Eissler
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. All advertising materials mentioning features or use of this software
+#    must display the following acknowledgement:
+#    This product includes software developed by the authors.
+# 4. Neither the name of the authors nor the
+#    names of its contributors may be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# 802.11 frame templates for the injection path.
+
+import ctypes
+import struct
+import dot11
+import helpers
+
+# The injection ioctl expects the frame length before the frame.
+INJECTION_HEADER_SIZE = 4
+
+BROADCAST_ADDRESS = "ff:ff:ff:ff:ff:ff"
+
+# 1(B), 2(B), 5.5(B), 11(B), 18, 24, 36, 54 Mbps
+DEFAULT_RATES = '\x82\x84\x8b\x96\x24\x30\x48\x6c'
+
+DEFAULT_BEACON_INTERVAL = 100
+DEFAULT_CAPABILITIES = dot11.CAP_ESS | dot11.CAP_SHORT_PREAMBLE | \
+                       dot11.CAP_SHORT_SLOT_TIME
+
+# Field offsets on the 802.11 header.
+ADDRESS1_OFFSET = 4
+ADDRESS2_OFFSET = 10
+ADDRESS3_OFFSET = 16
+SEQUENCE_CONTROL_OFFSET = 22
+TIMESTAMP_OFFSET = 24
+
+
+def information_element(ie_id, ie_data):
+    '''Returns an encoded information element.'''
+    if len(ie_data) > 255:
+        raise ValueError("Information element too long.")
+    return chr(ie_id) + chr(len(ie_data)) + ie_data
+
+
+def frame_control(frame_type, subtype, flags=0):
+    '''Returns the frame control field as a 2 bytes string.'''
+    return struct.pack("<BB", (subtype << 4) | (frame_type << 2), flags)
+
+
+class FrameTemplate(object):
+    '''802.11 frame stored on a reusable bytearray.
+
+       The bytearray starts with the frame length expected by the injection
+       ioctl, followed by the frame. The fields that change between frames
+       are patched in place with struct.pack_into so injecting the same
+       template over and over does not allocate a new frame.
+    '''
+
+    def __init__(self, frame):
+        self._frame_size = len(frame)
+        self._buffer = bytearray(INJECTION_HEADER_SIZE + self._frame_size)
+        struct.pack_into("<L", self._buffer, 0, self._frame_size)
+        self._buffer[INJECTION_HEADER_SIZE:] = frame
+        self._sequence = 0
+        # ctypes view over the bytearray, shares the memory.
+        self._cbuffer = (ctypes.c_char * len(self._buffer)).from_buffer(
+            self._buffer)
+
+    def _setAddress(self, offset, mac_address):
+        '''Patches the address at offset.'''
+        struct.pack_into("6s", self._buffer, INJECTION_HEADER_SIZE + offset,
+                         helpers.mac_address_to_bytes(mac_address))
+
+    def setAddress1(self, mac_address):
+        '''Sets the first address (receiver / destination).'''
+        self._setAddress(ADDRESS1_OFFSET, mac_address)
+
+    def setAddress2(self, mac_address):
+        '''Sets the second address (transmitter / source).'''
+        self._setAddress(ADDRESS2_OFFSET, mac_address)
+
+    def setAddress3(self, mac_address):
+        '''Sets the third address.'''
+        self._setAddress(ADDRESS3_OFFSET, mac_address)
+
+    def setSequence(self, sequence):
+        '''Sets the sequence number, fragment number is always 0.'''
+        self._sequence = sequence & 0x0FFF
+        struct.pack_into("<H", self._buffer,
+                         INJECTION_HEADER_SIZE + SEQUENCE_CONTROL_OFFSET,
+                         self._sequence << 4)
+
+    def nextSequence(self):
+        '''Increments the sequence number.'''
+        self.setSequence(self._sequence + 1)
+
+    def getSequence(self):
+        '''Returns the sequence number.'''
+        return self._sequence
+
+    def getFrame(self):
+        '''Returns a copy of the frame as a string.'''
+        return str(self._buffer[INJECTION_HEADER_SIZE:])
+
+    def getBuffer(self):
+        '''Returns the bytearray with the length prefix and the frame.'''
+        return self._buffer
+
+    def getInjectionBuffer(self):
+        '''Returns the ctypes buffer used by ioctl.inject_buffer.'''
+        return self._cbuffer
+
+
+class ManagementTemplate(FrameTemplate):
+    '''Management frame template.'''
+
+    def __init__(self, subtype, destination, source, bssid, body):
+        header = frame_control(dot11.TYPE_MANAGEMENT, subtype) + \
+                 struct.pack("<H", 0) + \
+                 helpers.mac_address_to_bytes(destination) + \
+                 helpers.mac_address_to_bytes(source) + \
+                 helpers.mac_address_to_bytes(bssid) + \
+                 struct.pack("<H", 0)
+        super(ManagementTemplate, self).__init__(header + body)
+
+
+class BeaconTemplate(ManagementTemplate):
+    '''Beacon frame template.'''
+
+    def __init__(self, bssid, ssid, channel,
+                 interval=DEFAULT_BEACON_INTERVAL,
+                 capabilities=DEFAULT_CAPABILITIES,
+                 rates=DEFAULT_RATES,
+                 information_elements=''):
+        body = struct.pack("<QHH", 0, interval, capabilities) + \
+               information_element(0x00, ssid) + \
+               information_element(0x01, rates[:8]) + \
+               information_element(0x03, chr(channel))
+        if len(rates) > 8:
+            body += information_element(0x32, rates[8:])
+        body += information_elements
+        super(BeaconTemplate, self).__init__(
+            dot11.SUBTYPE_MANAGEMENT_BEACON, BROADCAST_ADDRESS, bssid, bssid,
+            body)
+
+    def setTimestamp(self, timestamp):
+        '''Sets the timestamp field in microseconds.'''
+        struct.pack_into("<Q", self._buffer,
+                         INJECTION_HEADER_SIZE + TIMESTAMP_OFFSET, timestamp)
+
+
+class ProbeRequestTemplate(ManagementTemplate):
+    '''Probe Request frame template, empty ssid is a wildcard probe.'''
+
+    def __init__(self, source, ssid='', rates=DEFAULT_RATES,
+                 bssid=BROADCAST_ADDRESS):
+        body = information_element(0x00, ssid) + \
+               information_element(0x01, rates[:8])
+        if len(rates) > 8:
+            body += information_element(0x32, rates[8:])
+        super(ProbeRequestTemplate, self).__init__(
+            dot11.SUBTYPE_MANAGEMENT_PROBE_REQ, BROADCAST_ADDRESS, source,
+            bssid, body)
+
+
+class DeauthenticationTemplate(ManagementTemplate):
+    '''Deauthentication frame template.'''
+
+    def __init__(self, destination, source, bssid, reason=1):
+        super(DeauthenticationTemplate, self).__init__(
+            dot11.SUBTYPE_MANAGEMENT_DEAUTHENTICATION, destination, source,
+            bssid, struct.pack("<H", reason))
+
+
+class DataTemplate(FrameTemplate):
+    '''Data frame template with a LLC/SNAP encapsulated payload.
+
+       Only the infrastructure cases are supported, to_ds selects the
+       direction (station to AP when True).
+    '''
+
+    def __init__(self, bssid, source, destination, payload, ethertype=0x0800,
+                 to_ds=True):
+        if to_ds:
+            flags = dot11.frame_control_flags["ToDS"]
+            addresses = (bssid, source, destination)
+        else:
+            flags = dot11.frame_control_flags["FromDS"]
+            addresses = (destination, bssid, source)
+        header = frame_control(dot11.TYPE_DATA, 0, flags) + \
+                 struct.pack("<H", 0) + \
+                 ''.join(helpers.mac_address_to_bytes(a) for a in addresses) + \
+                 struct.pack("<H", 0)
+        llc = dot11.LLC_SNAP_HEADER + struct.pack(">H", ethertype)
+        super(DataTemplate, self).__init__(header + llc + payload)
+
+
+if __name__ == "__main__":
+    beacon = BeaconTemplate("e0:cb:4e:52:a3:cb", "ipad injected", 6)
+    beacon.setSequence(0x0FFF)
+    beacon.nextSequence()
+    beacon.setTimestamp(0x1122334455667788)
+    frame = beacon.getFrame()
+    # Frames are parsed without FCS, add a fake one.
+    parsed = dot11.Beacon(frame + '\x00' * dot11.FCS_SIZE)
+    if parsed.getSequence() != 0:
+        print "Error: sequence number incorrect."
+    if parsed.getTimestamp() != 0x1122334455667788:
+        print "Error: timestamp incorrect."
+    if parsed.getBssid() != "e0:cb:4e:52:a3:cb":
+        print "Error: bssid incorrect."
+    if parsed.getInformationElements()[dot11.IE_SSID] != "ipad injected":
+        print "Error: ssid incorrect."
+    if struct.unpack("<L", str(beacon.getBuffer()[:4]))[0] != len(frame):
+        print "Error: injection length incorrect."
+    data = DataTemplate("00:11:22:33:44:55", "66:77:88:99:aa:bb",
+                        "ff:ff:ff:ff:ff:ff", "payload")
+    parsed = dot11.DataFrame(data.getFrame() + '\x00' * dot11.FCS_SIZE)
+    if parsed.getEthertype() != 0x0800:
+        print "Error: ethertype incorrect."
+    if parsed.getSourceAddress() != "66:77:88:99:aa:bb":
+        print "Error: source address incorrect."
@@ -28,8 +28,13 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import time
+import zlib
 import struct
 import helpers
+import eviction
+from collections import deque
+from collections import OrderedDict
 
 DOT11_FRAME_CONTROL_SIZE = 2
 
@@ -40,6 +45,21 @@ DOT11_BEACON_FRAME_FIELDS_SIZE = 36
 
 FCS_SIZE = 4
 
+# Shortest frames (ACK and CTS): frame control, duration, receiver and FCS.
+DOT11_MIN_FRAME_SIZE = 14
+
+# Sequence control values remembered per transmitter to detect retries.
+SEQUENCE_WINDOW = 8
+
+# Frame control, duration, destination, source, bssid and sequence control.
+management_header = struct.Struct("<HH6s6s6sH")
+# Frame control, duration, address1, address2, address3 and sequence control.
+data_header = struct.Struct("<HH6s6s6sH")
+# Frame control, duration and receiver address (CTS, ACK).
+control_header = struct.Struct("<HH6s")
+# Frame control, duration, receiver and transmitter addresses.
+control_header_ta = struct.Struct("<HH6s6s")
+
 IE_SSID = "SSID"
 IE_SUPPORTED_RATES = "Supported Rates"
 IE_DS_PARAMETER_SET = "DS Parameter Set"
@@ -48,6 +68,9 @@ IE_WPA = "WPA"
 IE_EXTENDED_SUPPORTED_RATES = "Extended Supported Rates"
 IE_VENDOR_SPECIFIC = "Vendor Specific"
 
+# LLC/SNAP header with the RFC 1042 OUI, the ethertype follows it.
+LLC_SNAP_HEADER = '\xAA\xAA\x03\x00\x00\x00'
+
 # OUI
 OUI_SIZE = 3
 OUI_RSN = '\x00\x0F\xAC'
@@ -82,6 +105,15 @@ SUBTYPE_MANAGEMENT_AUTHENTICATION = 11
 SUBTYPE_MANAGEMENT_DEAUTHENTICATION = 12
 SUBTYPE_MANAGEMENT_ACTION = 13
 
+SUBTYPE_CONTROL_BLOCK_ACK_REQ = 8
+SUBTYPE_CONTROL_BLOCK_ACK = 9
+SUBTYPE_CONTROL_PS_POLL = 10
+SUBTYPE_CONTROL_RTS = 11
+SUBTYPE_CONTROL_CTS = 12
+SUBTYPE_CONTROL_ACK = 13
+SUBTYPE_CONTROL_CF_END = 14
+SUBTYPE_CONTROL_CF_END_ACK = 15
+
 
 frame_type = {0: "Management",
               1: "Control",
@@ -150,11 +182,115 @@ rsn_cipher_suite_id = {0: "Same as Group Cipher Suite",
 
 rsn_authentication_suite_id = {1: "PMK", 2: "PSK"}
 
+# Information elements that change between beacons of the same network and
+# are left out of the beacon digest.
+IE_ID_TIM = 0x05
+IE_ID_BSS_LOAD = 0x0b
+IE_ID_CHANNEL_SWITCH = 0x25
+IE_ID_QUIET = 0x28
+dynamic_information_elements_id = (IE_ID_TIM,
+                                   IE_ID_BSS_LOAD,
+                                   IE_ID_CHANNEL_SWITCH,
+                                   IE_ID_QUIET)
+
+# Information elements whose decoded value is memoized by raw content.
+IE_CACHE_SIZE = 512
+cached_information_elements_id = (0x30, 0xdd)
+
 
 class InvalidInformationElement(Exception):
     pass
 
 
+class FrozenDict(dict):
+    '''Read only dictionary used for shared decoded information elements.'''
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("FrozenDict is read only.")
+
+    __setitem__ = _readonly
+    __delitem__ = _readonly
+    clear = _readonly
+    pop = _readonly
+    popitem = _readonly
+    setdefault = _readonly
+    update = _readonly
+
+
+def freeze(value):
+    '''Returns an immutable copy of a decoded information element value.'''
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+class InformationElementCache(object):
+    '''Bounded LRU cache of decoded information elements.
+
+       Entries are keyed on (ie id, raw ie data) and hold the (name, data)
+       tuple produced by InformationElementHelper. Decoded values are frozen
+       because the same object is shared by every frame carrying the IE.
+    '''
+
+    def __init__(self, size=IE_CACHE_SIZE):
+        self._size = size
+        self._entries = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key):
+        '''Returns the cached entry for key or None.'''
+        entries = self._entries
+        try:
+            value = entries.pop(key)
+        except KeyError:
+            self._misses += 1
+            return None
+        # Re insert to mark the entry as the most recently used.
+        entries[key] = value
+        self._hits += 1
+        return value
+
+    def put(self, key, value):
+        '''Stores value for key evicting the least recently used entry.'''
+        entries = self._entries
+        if key in entries:
+            del entries[key]
+        elif len(entries) >= self._size:
+            entries.popitem(last=False)
+        entries[key] = value
+
+    def clear(self):
+        '''Removes every entry and resets the counters.'''
+        self._entries.clear()
+        self._hits = 0
+        self._misses = 0
+
+    def getHits(self):
+        '''Returns the number of lookups served from the cache.'''
+        return self._hits
+
+    def getMisses(self):
+        '''Returns the number of lookups that required decoding.'''
+        return self._misses
+
+    def getSize(self):
+        '''Returns the number of cached entries.'''
+        return len(self._entries)
+
+    def getStatistics(self):
+        '''Returns a dictionary with the cache counters.'''
+        return {'hits': self._hits,
+                'misses': self._misses,
+                'size': len(self._entries),
+                'max size': self._size}
+
+
+ie_cache = InformationElementCache()
+
+
 class FrameControl(object):
     def __init__(self, data):
         if len(data) < DOT11_FRAME_CONTROL_SIZE:
@@ -247,9 +383,22 @@ class FrameControl(object):
 
 
 class ManagementFrame(object):
+    '''Base class of the management frames.
+
+       The header, the fixed fields and the information elements are
+       decoded in place with struct.unpack_from over the frame buffer.
+       Subclasses only describe their fixed fields layout.
+    '''
+    # Frame subtype, None to accept any management frame.
+    SUBTYPE = None
+    # struct.Struct with the fixed fields that follow the header.
+    FIXED_FIELDS = None
+    # True if information elements follow the fixed fields.
+    INFORMATION_ELEMENTS = False
+
     def __init__(self, data):
         self._frame_size = len(data)
-        # Essential fields on the data frame
+        # Essential fields on the management frame
         # Field ----------- Size
         # frame control --- 2 B
         # duration -------- 2 B
@@ -257,42 +406,113 @@ class ManagementFrame(object):
         # source ---------- 6 B
         # bssid ----------- 6 B
         # sequence ctrl --- 2 B
-        if self._frame_size < DOT11_DATA_FRAME_FIELDS_SIZE:
+        body_offset = DOT11_MANAGEMENT_FRAME_FIELDS_SIZE
+        if self.FIXED_FIELDS is not None:
+            body_offset += self.FIXED_FIELDS.size
+        if self._frame_size < body_offset:
             raise IndexError("Frame to short.")
-        index = 0
+        self._fixed = ()
+        self._raw_ies = {}
+        self._ies = {}
+        self._process(data, body_offset)
+
+    def _process(self, data, body_offset):
+        '''Process management frame fields.'''
+        (frameControl, self._duration, self._raw_destination,
+         self._raw_source, self._raw_bssid,
+         seqctrl) = management_header.unpack_from(data)
+        self._frameControl = frameControl
+        if (frameControl & 0x000C) >> 2 != TYPE_MANAGEMENT:
+            raise Exception("Invalid Frame Type.")
+        subtype = (frameControl & 0x00F0) >> 4
+        if self.SUBTYPE is not None and subtype != self.SUBTYPE:
+            raise Exception("Invalid Frame Subtype.")
+        self._fragment = (seqctrl & 0x000F)
+        self._sequence = (seqctrl & 0xFFF0) >> 4
+        if self.FIXED_FIELDS is not None:
+            self._fixed = self.FIXED_FIELDS.unpack_from(
+                data, DOT11_MANAGEMENT_FRAME_FIELDS_SIZE)
+        if self.INFORMATION_ELEMENTS:
+            # Information elements go from the end of the fixed fields up
+            # to the end of the frame substracting the 4 bytes of the FCS.
+            end = self._frame_size - FCS_SIZE
+            if end > body_offset:
+                self._processInformationElements(data, body_offset, end)
+
+    def _processInformationElements(self, data, index, end):
+        '''Process Information Elements between index and end.'''
+        # ie header -> 2 bytes
+        # ie id -> 1 byte
+        # ie len -> 1 byte
+        ie_header_size = 2
+        while end - index >= ie_header_size:
+            ie_id = ord(data[index])
+            begin = index + ie_header_size
+            index = begin + ord(data[index + 1])
+            if index > end:
+                break
+            ie_data = data[begin:index]
+            self._raw_ies[ie_id] = ie_data
+            ie_item = InformationElementHelper(ie_id, ie_data)
+            self._ies[ie_item.getName()] = ie_item.getData()
 
-        self._fc = FrameControl(data)
-        index += 2
+    def getFrameControl(self):
+        '''Returns the FrameControl of the frame.'''
+        return FrameControl(struct.pack("<H", self._frameControl))
 
-        self._duration = data[index:index + 2]
-        index += 2
+    def getSubtype(self):
+        '''Returns the frame subtype.'''
+        return (self._frameControl & 0x00F0) >> 4
 
-        # Addresses
-        self._destination = helpers.bytes_to_mac_address(data[index:index + 6])
-        index += 6
-        self._source = helpers.bytes_to_mac_address(data[index:index + 6])
-        index += 6
-        self._bssid = helpers.bytes_to_mac_address(data[index:index + 6])
-        index += 6
+    def getDuration(self):
+        '''Returns the frame Duration field.'''
+        return self._duration
 
-        seqctrl = struct.unpack("H", data[index:index + 2])[0]
-        self._fragment = (seqctrl & 0x000F)
-        self._sequence = (seqctrl & 0xFFF0) >> 4
+    def getDestination(self):
+        '''Returns the frame Destination field.'''
+        return helpers.bytes_to_mac_address(self._raw_destination)
+
+    def getSource(self):
+        '''Returns the frame Source field.'''
+        return helpers.bytes_to_mac_address(self._raw_source)
 
     def getBssid(self):
-        '''Return the bssid of the data frame.'''
-        return self._bssid
+        '''Returns the frame BSSID field.'''
+        return helpers.bytes_to_mac_address(self._raw_bssid)
 
     def getSourceAddress(self):
-        '''Return the source address of the data frame.'''
-        return self._source
+        '''Return the source address of the frame.'''
+        return self.getSource()
 
     def getDestinationAddress(self):
-        '''Return the destination address of the data frame.'''
-        return self._destination
+        '''Return the destination address of the frame.'''
+        return self.getDestination()
+
+    def getFragment(self):
+        '''Returns the frame fragment field.'''
+        return self._fragment
+
+    def getSequence(self):
+        '''Returns the frame sequence field.'''
+        return self._sequence
+
+    def getRawInformationElements(self):
+        '''Returns dictionary with the raw information elements.'''
+        return self._raw_ies
+
+    def getInformationElements(self):
+        '''Returns dictionary with the information elements.'''
+        return self._ies
 
 
 class DataFrame(object):
+    '''Data frame.
+
+       The header length takes into account the fourth address (WDS), the
+       QoS Control field of the QoS subtypes and the HT Control field of
+       QoS frames with the Order flag set, so the payload (LLC/SNAP header
+       on unprotected frames) is at getPayloadOffset().
+    '''
     def __init__(self, data):
         self._frame_size = len(data)
         # Essential fields on the data frame
@@ -303,28 +523,24 @@ class DataFrame(object):
         # address2 -------- 6 B
         # address3 -------- 6 B
         # sequence ctrl --- 2 B
-        # address4 -------- 6 B (optional)
+        # address4 -------- 6 B (only WDS)
+        # qos control ----- 2 B (only QoS subtypes)
+        # ht control ------ 4 B (only QoS subtypes with Order flag)
         if self._frame_size < DOT11_DATA_FRAME_FIELDS_SIZE:
             raise IndexError("Frame to short.")
-        index = 0
+        self._data = data
 
+        (frameControl, self._duration, address1, address2, address3,
+         seqctrl) = data_header.unpack_from(data)
         self._fc = FrameControl(data)
-        index += 2
-
-        self._duration = data[index:index + 2]
-        index += 2
+        self._fragment = (seqctrl & 0x000F)
+        self._sequence = (seqctrl & 0xFFF0) >> 4
+        index = DOT11_DATA_FRAME_FIELDS_SIZE
 
         self._ibss = False
         self._infrastructure = False
         self._wds = False
-
-        # Addresses
-        self._address1 = helpers.bytes_to_mac_address(data[index:index + 6])
-        index += 6
-        self._address2 = helpers.bytes_to_mac_address(data[index:index + 6])
-        index += 6
-        self._address3 = helpers.bytes_to_mac_address(data[index:index + 6])
-        index += 6
+        self._raw_address4 = None
 
         to_ds = self._fc.getToDs()
         from_ds = self._fc.getFromDs()
@@ -332,34 +548,48 @@ class DataFrame(object):
         # IBSS
         if not to_ds and not from_ds:
             self._ibss = True
-            self._destination = self._address1
-            self._source = self._address2
-            self._bssid = self._address3
+            self._raw_destination = address1
+            self._raw_source = address2
+            self._raw_bssid = address3
 
         # Infrastructure
         if (to_ds and not from_ds) or (not to_ds and from_ds):
             self._infrastructure = True
             if (to_ds and not from_ds):
-                self._bssid = self._address1
-                self._source = self._address2
-                self._destination = self._address3
+                self._raw_bssid = address1
+                self._raw_source = address2
+                self._raw_destination = address3
             else:
-                self._destination = self._address1
-                self._bssid = self._address2
-                self._source = self._address3
+                self._raw_destination = address1
+                self._raw_bssid = address2
+                self._raw_source = address3
 
         # WDS
         if to_ds and from_ds:
-            self._address4 = helpers.bytes_to_mac_address(data[index:index + 6])
+            if self._frame_size < index + 6:
+                raise IndexError("Frame to short.")
+            self._raw_address4 = data[index:index + 6]
             index += 6
             self._wds = True
-            self._bssid = self._address1
-            self._destination = self._address3
-            self._source = self._address4
-
-        seqctrl = struct.unpack("H", data[index:index + 2])[0]
-        self._fragment = (seqctrl & 0x000F)
-        self._sequence = (seqctrl & 0xFFF0) >> 4
+            self._raw_bssid = address1
+            self._raw_destination = address3
+            self._raw_source = self._raw_address4
+
+        # QoS
+        self._qos = (frameControl & 0x0080) != 0
+        self._tid = None
+        if self._qos:
+            if self._frame_size < index + 2:
+                raise IndexError("Frame to short.")
+            qosctrl = struct.unpack_from("<H", data, index)[0]
+            self._tid = qosctrl & 0x000F
+            index += 2
+            # HT Control is present on QoS frames with the Order flag.
+            if self._fc.getOrder():
+                index += 4
+
+        self._header_size = index
+        self._payload_size = max(0, self._frame_size - FCS_SIZE - index)
 
     def isIbss(self):
         '''Returns True if frame is from a IBSS network.'''
@@ -373,214 +603,582 @@ class DataFrame(object):
         '''Returns True if frame is from a WDS network.'''
         return self._wds
 
+    def isQos(self):
+        '''Returns True if frame has a QoS Control field.'''
+        return self._qos
+
+    def getFrameControl(self):
+        '''Return the FrameControl of the data frame.'''
+        return self._fc
+
+    def getDuration(self):
+        '''Return the duration field of the data frame.'''
+        return self._duration
+
     def getBssid(self):
         '''Return the bssid of the data frame.'''
-        return self._bssid
+        return helpers.bytes_to_mac_address(self._raw_bssid)
 
     def getSourceAddress(self):
         '''Return the source address of the data frame.'''
-        return self._source
+        return helpers.bytes_to_mac_address(self._raw_source)
 
     def getDestinationAddress(self):
         '''Return the destination address of the data frame.'''
-        return self._destination
+        return helpers.bytes_to_mac_address(self._raw_destination)
 
+    def getFragment(self):
+        '''Return the fragment number of the data frame.'''
+        return self._fragment
+
+    def getSequence(self):
+        '''Return the sequence number of the data frame.'''
+        return self._sequence
+
+    def getTid(self):
+        '''Return the traffic identifier of QoS frames or None.'''
+        return self._tid
+
+    def getHeaderSize(self):
+        '''Return the length of the 802.11 header.'''
+        return self._header_size
+
+    def getPayloadOffset(self):
+        '''Return the offset of the payload on the frame.'''
+        return self._header_size
+
+    def getPayload(self):
+        '''Return a buffer over the frame payload, FCS excluded.'''
+        return buffer(self._data, self._header_size, self._payload_size)
+
+    def getEthertype(self):
+        '''Return the LLC/SNAP ethertype of unprotected frames or None.'''
+        if self._fc.getProtectedFrame() or self._payload_size < 8:
+            return None
+        index = self._header_size
+        if self._data[index:index + 6] != LLC_SNAP_HEADER:
+            return None
+        return struct.unpack_from(">H", self._data, index + 6)[0]
+
+
+def frame_header_size(data):
+    '''Returns the 802.11 header length of a management or data frame.'''
+    size = DOT11_DATA_FRAME_FIELDS_SIZE
+    fc = ord(data[0])
+    if (fc & 0x0C) >> 2 == TYPE_DATA:
+        flags = ord(data[1])
+        # WDS, ToDS and FromDS flags set.
+        if flags & 0x03 == 0x03:
+            size += 6
+        # QoS subtypes.
+        if fc & 0x80:
+            size += 2
+            if flags & frame_control_flags["Order"]:
+                size += 4
+    return size
+
+
+def frame_bssid(data):
+    '''Returns the raw BSSID of a management or data frame, None for
+       control frames.'''
+    if len(data) < DOT11_DATA_FRAME_FIELDS_SIZE:
+        return None
+    frame_type = (ord(data[0]) & 0x0C) >> 2
+    if frame_type == TYPE_MANAGEMENT:
+        return data[16:22]
+    if frame_type == TYPE_DATA:
+        ds = ord(data[1]) & 0x03
+        if ds == 0x00:
+            return data[16:22]
+        if ds == 0x02:
+            # FromDS, the transmitter is the AP.
+            return data[10:16]
+        # ToDS and WDS.
+        return data[4:10]
+    return None
+
+
+class SequenceTracker(object):
+    '''Drops retransmitted frames and reassembles fragmented frames.
+
+       The last SEQUENCE_WINDOW sequence control values are kept per
+       transmitter (and per TID on QoS data frames). A frame with the Retry
+       flag set and a sequence control already in the window is a
+       duplicate. Fragments are joined in order, the reassembled frame
+       has the header of the first fragment with the MoreFrag flag cleared
+       and ends with the FCS of the last fragment.
+
+       If a statistics object is given its addSequencedFrame(transmitter,
+       retry, duplicate) method is called for every sequenced frame.
+
+       The state of the transmitters past limit or not seen for ttl
+       seconds is dropped by expire, 0 disables either bound. Transmitters
+       are marked as seen at the time of the last expire.
+    '''
+
+    def __init__(self, statistics=None, window=SEQUENCE_WINDOW, limit=0,
+                 ttl=0):
+        self._statistics = statistics
+        self._window = window
+        self._history = {}
+        self._fragments = {}
+        self._lru = eviction.LruTracker(limit, ttl)
+        self._now = time.time()
+
+    def expire(self, now):
+        '''Drops the state of the least recently seen transmitters past
+           the limit or the ttl.'''
+        self._now = now
+        history = self._history
+        fragments = self._fragments
+        for key in self._lru.expire(now):
+            history.pop(key, None)
+            fragments.pop(key, None)
+
+    def getEvicted(self):
+        '''Returns the number of transmitters dropped by expire.'''
+        return self._lru.evicted
+
+    def process(self, data):
+        '''Returns the frame to process, the reassembled frame when data is
+           the last fragment, or None for duplicates and fragments waiting
+           for the rest of the frame.'''
+        if len(data) < DOT11_DATA_FRAME_FIELDS_SIZE + FCS_SIZE:
+            return data
+        fc = ord(data[0])
+        frame_type = (fc & 0x0C) >> 2
+        if frame_type == TYPE_CONTROL:
+            return data
+        flags = ord(data[1])
+        header_size = frame_header_size(data)
+        if header_size + FCS_SIZE > len(data):
+            # Truncated header (WDS, QoS or HT fields missing).
+            return None
+        transmitter = data[10:16]
+        key = transmitter
+        if frame_type == TYPE_DATA and fc & 0x80:
+            # Sequence numbers are assigned per TID on QoS data frames.
+            tid_offset = DOT11_DATA_FRAME_FIELDS_SIZE
+            if flags & 0x03 == 0x03:
+                tid_offset += 6
+            key += chr(ord(data[tid_offset]) & 0x0F)
+
+        seqctrl = struct.unpack_from("<H", data, 22)[0]
+        retry = (flags & frame_control_flags["Retry"]) != 0
+        self._lru.touchOnce(key, self._now)
+        history = self._history.get(key)
+        if history is None:
+            history = deque(maxlen=self._window)
+            self._history[key] = history
+        duplicate = retry and seqctrl in history
+        if self._statistics is not None:
+            self._statistics.addSequencedFrame(transmitter, retry, duplicate)
+        if duplicate:
+            return None
+        history.append(seqctrl)
+
+        more_frag = (flags & frame_control_flags["MoreFrag"]) != 0
+        fragment = seqctrl & 0x000F
+        if not more_frag and fragment == 0:
+            return data
+        return self._reassemble(key, data, header_size, seqctrl >> 4,
+                                fragment, more_frag)
+
+    def _reassemble(self, key, data, header_size, sequence, fragment,
+                    more_frag):
+        '''Stores a fragment, returns the whole frame on the last one.'''
+        pending = self._fragments.get(key)
+        if fragment == 0:
+            # [sequence, next fragment, frame parts]
+            self._fragments[key] = [sequence, 1, [data[:-FCS_SIZE]]]
+            return None
+        if pending is None or pending[0] != sequence or pending[1] != fragment:
+            # Missing or out of order fragment, drop the whole frame.
+            self._fragments.pop(key, None)
+            return None
+        pending[1] += 1
+        parts = pending[2]
+        parts.append(data[header_size:-FCS_SIZE])
+        if more_frag:
+            return None
+        del self._fragments[key]
+        first = parts[0]
+        flags = ord(first[1]) & ~frame_control_flags["MoreFrag"]
+        parts[0] = first[0] + chr(flags) + first[2:]
+        parts.append(data[-FCS_SIZE:])
+        return ''.join(parts)
+
+
+class BeaconSummary(object):
+    '''Cheap view of a beacon frame used to detect unchanged beacons.
+
+       Only the BSSID is decoded. The digest covers the beacon interval,
+       the capabilities and every information element except the dynamic
+       ones (TIM, BSS Load, etc.), so two beacons with the same digest
+       produce the same Beacon information.
+    '''
 
-class ProbeRequest(object):
     def __init__(self, data):
-        self._frame_size = len(data)
-        # Essential fields on the beacon frame
-        # Field ----------- Size
-        # frame control --- 2 B
-        # duration -------- 2 B
-        # destination ----- 6 B
-        # source ---------- 6 B
-        # bssid ----------- 6 B
-        # sequence ctrl --- 2 B
-        if self._frame_size < DOT11_PROBE_REQUEST_FRAME_FIELDS_SIZE:
+        if len(data) < DOT11_BEACON_FRAME_FIELDS_SIZE:
             raise IndexError("Frame to short.")
-        self._management_frame = ManagementFrame(data)
-        self._raw_ies = {}
-        self._ies = {}
-        self._process(data)
-
-    def _process(self, data):
-        '''Process Probe Request frame fields.'''
-        self._frameControl = FrameControl(data[:2])
-        if self._frameControl.getType() != TYPE_MANAGEMENT:
-            raise Exception("Invalid Frame Type.")
-        if self._frameControl.getSubtype() != SUBTYPE_MANAGEMENT_PROBE_REQ:
-            raise Exception("Invalid Frame Subtype.")
-        self._duration = struct.unpack("H", data[2:4])[0]
-        self._destination = helpers.bytes_to_mac_address(data[4:10])
-        self._source = helpers.bytes_to_mac_address(data[10:16])
         self._bssid = helpers.bytes_to_mac_address(data[16:22])
-        # Process sequence control field
-        seqctrl = struct.unpack("H", data[22:24])[0]
-        self._fragment = (seqctrl & 0x000F)
-        self._sequence = (seqctrl & 0xFFF0) >> 4
-        if self._frame_size > DOT11_PROBE_REQUEST_FRAME_FIELDS_SIZE + FCS_SIZE:
-            # To get the offset of the information elements we need to go
-            # to the end offset of the essential fields of the beacon frame
-            # up to the end of the frame substracting the 4 bytes of the FCS.
-            ie_data = data[DOT11_BEACON_FRAME_FIELDS_SIZE:-4]
-            self._processInformationElements(ie_data)
-
-    def _processInformationElements(self, data):
-        '''Process Information Elements.'''
-        index = 0
-        # ie header -> 2 bytes
-        # ie id -> 1 byte
-        # ie len -> 1 byte
-        ie_header_size = 2
-        data_length = len(data)
-        while(data_length):
-            if data_length < ie_header_size:
+        self._digest = self._processDigest(data)
+
+    def _processDigest(self, data):
+        '''Returns the crc32 of the static part of the beacon body.'''
+        # Skip the timestamp, start on the beacon interval field.
+        begin = DOT11_BEACON_FRAME_FIELDS_SIZE - 4
+        end = len(data) - FCS_SIZE
+        index = DOT11_BEACON_FRAME_FIELDS_SIZE
+        digest = 0
+        # Digest contiguous runs of static information elements.
+        while index + 2 <= end:
+            ie_id = ord(data[index])
+            ie_end = index + 2 + ord(data[index + 1])
+            if ie_end > end:
                 break
-            ie_id = struct.unpack("B", data[index])[0]
-            ie_len = struct.unpack("B", data[index + 1])[0]
-            if (data_length - ie_header_size) < ie_len:
-                break
-            begin = index + ie_header_size
-            end = begin + ie_len
-            ie_data = data[begin:end]
-            self._raw_ies[ie_id] = ie_data
-            ie_item = InformationElementHelper(ie_id, ie_data)
-            self._ies[ie_item.getName()] = ie_item.getData()
-            data_length -= (ie_len + ie_header_size)
-            index += (ie_len + ie_header_size)
+            if ie_id in dynamic_information_elements_id:
+                digest = zlib.crc32(data[begin:index], digest)
+                begin = ie_end
+            index = ie_end
+        return zlib.crc32(data[begin:end], digest)
 
-    def getSource(self):
-        '''Returns Probe Request Source field.'''
-        return self._management_frame.getSourceAddress()
+    def getBssid(self):
+        '''Returns Beacon BSSID field.'''
+        return self._bssid
 
+    def getDigest(self):
+        '''Returns the digest of the static part of the Beacon.'''
+        return self._digest
+
+
+class AssociationRequest(ManagementFrame):
+    '''Association Request frame.
+
+       Fixed fields: capabilities (2 B), listen interval (2 B).
+    '''
+    SUBTYPE = SUBTYPE_MANAGEMENT_ASSOCIATION_REQ
+    FIXED_FIELDS = struct.Struct("<HH")
+    INFORMATION_ELEMENTS = True
+
+    def getCapabilities(self):
+        '''Returns Association Request capabilities field.'''
+        return self._fixed[0]
+
+    def getListenInterval(self):
+        '''Returns Association Request listen interval field.'''
+        return self._fixed[1]
 
-class ProbeResponse(object):
-    def __init__(self):
-        pass
 
+class AssociationResponse(ManagementFrame):
+    '''Association Response frame.
+
+       Fixed fields: capabilities (2 B), status code (2 B), association
+       id (2 B).
+    '''
+    SUBTYPE = SUBTYPE_MANAGEMENT_ASSOCIATION_RES
+    FIXED_FIELDS = struct.Struct("<HHH")
+    INFORMATION_ELEMENTS = True
+
+    def getCapabilities(self):
+        '''Returns Association Response capabilities field.'''
+        return self._fixed[0]
+
+    def getStatusCode(self):
+        '''Returns Association Response status code field.'''
+        return self._fixed[1]
+
+    def getAssociationId(self):
+        '''Returns Association Response association id field.'''
+        # The two most significant bits are always set.
+        return self._fixed[2] & 0x3FFF
+
+
+class ReassociationRequest(AssociationRequest):
+    '''Reassociation Request frame.
+
+       Fixed fields: capabilities (2 B), listen interval (2 B), current
+       AP address (6 B).
+    '''
+    SUBTYPE = SUBTYPE_MANAGEMENT_REASSOCIATION_REQ
+    FIXED_FIELDS = struct.Struct("<HH6s")
+
+    def getCurrentAP(self):
+        '''Returns Reassociation Request current AP address field.'''
+        return helpers.bytes_to_mac_address(self._fixed[2])
+
+
+class ReassociationResponse(AssociationResponse):
+    '''Reassociation Response frame, same layout as Association Response.'''
+    SUBTYPE = SUBTYPE_MANAGEMENT_REASSOCIATION_RES
+
+
+class ProbeRequest(ManagementFrame):
+    '''Probe Request frame, information elements follow the header.'''
+    SUBTYPE = SUBTYPE_MANAGEMENT_PROBE_REQ
+    INFORMATION_ELEMENTS = True
+
+
+class BssFrame(ManagementFrame):
+    '''Base class of the frames announcing a BSS (Beacon, Probe Response).
+
+       Fixed fields: timestamp (8 B), beacon interval (2 B),
+       capabilities (2 B).
+    '''
+    FIXED_FIELDS = struct.Struct("<QHH")
+    INFORMATION_ELEMENTS = True
+
+    def getTimestamp(self):
+        '''Returns timestamp field.'''
+        return self._fixed[0]
+
+    def getInterval(self):
+        '''Returns beacon interval field.'''
+        return self._fixed[1]
+
+    def getCapabilities(self):
+        '''Returns capabilities field.'''
+        return self._fixed[2]
+
+
+class ProbeResponse(BssFrame):
+    '''Probe Response frame.'''
+    SUBTYPE = SUBTYPE_MANAGEMENT_PROBE_RES
+
+
+class Beacon(BssFrame):
+    '''Beacon frame.'''
+    SUBTYPE = SUBTYPE_MANAGEMENT_BEACON
+
+
+class Atim(ManagementFrame):
+    '''Announcement Traffic Indication Message frame, it has no body.'''
+    SUBTYPE = SUBTYPE_MANAGEMENT_ATIM
+
+
+class Disassociation(ManagementFrame):
+    '''Disassociation frame.
+
+       Fixed fields: reason code (2 B).
+    '''
+    SUBTYPE = SUBTYPE_MANAGEMENT_DISASSOCIATION
+    FIXED_FIELDS = struct.Struct("<H")
+    INFORMATION_ELEMENTS = True
+
+    def getReasonCode(self):
+        '''Returns reason code field.'''
+        return self._fixed[0]
+
+
+class Deauthentication(Disassociation):
+    '''Deauthentication frame, same layout as Disassociation.'''
+    SUBTYPE = SUBTYPE_MANAGEMENT_DEAUTHENTICATION
+
+
+class Authentication(ManagementFrame):
+    '''Authentication frame.
+
+       Fixed fields: algorithm number (2 B), transaction sequence (2 B),
+       status code (2 B).
+    '''
+    SUBTYPE = SUBTYPE_MANAGEMENT_AUTHENTICATION
+    FIXED_FIELDS = struct.Struct("<HHH")
+    INFORMATION_ELEMENTS = True
+
+    def getAlgorithm(self):
+        '''Returns authentication algorithm number field.'''
+        return self._fixed[0]
+
+    def getTransactionSequence(self):
+        '''Returns authentication transaction sequence field.'''
+        return self._fixed[1]
+
+    def getStatusCode(self):
+        '''Returns status code field.'''
+        return self._fixed[2]
+
+
+class Action(ManagementFrame):
+    '''Action frame.
+
+       Fixed fields: category (1 B), action (1 B). The rest of the body
+       depends on the category and is exposed as a buffer.
+    '''
+    SUBTYPE = SUBTYPE_MANAGEMENT_ACTION
+    FIXED_FIELDS = struct.Struct("<BB")
 
-class Beacon(object):
     def __init__(self, data):
-        self._frame_size = len(data)
-        # Essential fields on the beacon frame
-        # Field ----------- Size
-        # frame control --- 2 B
-        # duration -------- 2 B
-        # destination ----- 6 B
-        # source ---------- 6 B
-        # bssid ----------- 6 B
-        # sequence ctrl --- 2 B
-        # timestamp ------- 8 B
-        # beacon interval - 2 B
-        # capabilities ---- 2 B
-        if self._frame_size < DOT11_BEACON_FRAME_FIELDS_SIZE:
+        super(Action, self).__init__(data)
+        self._data = data
+
+    def getCategory(self):
+        '''Returns action category field.'''
+        return self._fixed[0]
+
+    def getAction(self):
+        '''Returns action field.'''
+        return self._fixed[1]
+
+    def getPayload(self):
+        '''Returns a buffer over the action details, FCS excluded.'''
+        begin = DOT11_MANAGEMENT_FRAME_FIELDS_SIZE + self.FIXED_FIELDS.size
+        end = max(begin, self._frame_size - FCS_SIZE)
+        return buffer(self._data, begin, end - begin)
+
+
+management_frame_class = {
+    SUBTYPE_MANAGEMENT_ASSOCIATION_REQ: AssociationRequest,
+    SUBTYPE_MANAGEMENT_ASSOCIATION_RES: AssociationResponse,
+    SUBTYPE_MANAGEMENT_REASSOCIATION_REQ: ReassociationRequest,
+    SUBTYPE_MANAGEMENT_REASSOCIATION_RES: ReassociationResponse,
+    SUBTYPE_MANAGEMENT_PROBE_REQ: ProbeRequest,
+    SUBTYPE_MANAGEMENT_PROBE_RES: ProbeResponse,
+    SUBTYPE_MANAGEMENT_BEACON: Beacon,
+    SUBTYPE_MANAGEMENT_ATIM: Atim,
+    SUBTYPE_MANAGEMENT_DISASSOCIATION: Disassociation,
+    SUBTYPE_MANAGEMENT_AUTHENTICATION: Authentication,
+    SUBTYPE_MANAGEMENT_DEAUTHENTICATION: Deauthentication,
+    SUBTYPE_MANAGEMENT_ACTION: Action}
+
+
+def parse_management_frame(data):
+    '''Returns the ManagementFrame subclass instance for the frame or None
+       if the subtype is reserved.'''
+    subtype = (ord(data[0]) & 0xF0) >> 4
+    if subtype not in management_frame_class:
+        return None
+    return management_frame_class[subtype](data)
+
+
+
+class ControlFrame(object):
+    '''Base class of the control frames.
+
+       Control frames have a fixed layout, only the duration and the
+       receiver and transmitter addresses are decoded. Addresses are kept
+       as 6 bytes strings and converted only when requested.
+    '''
+    __slots__ = ('_frameControl', '_duration', '_raw_receiver',
+                 '_raw_transmitter')
+    SUBTYPE = None
+    HEADER = control_header_ta
+
+    def __init__(self, data):
+        if len(data) < self.HEADER.size:
             raise IndexError("Frame to short.")
-        self._duration = 0
-        self._destination = ""
-        self._source = ""
-        self._bssid = ""
-        self._fragment = 0
-        self._sequence = 0
-        self._timestamp = 0
-        self._interval = 0
-        self._capabilities = 0
-        self._raw_ies = {}
-        self._ies = {}
-        self._process(data)
+        fields = self.HEADER.unpack_from(data)
+        self._frameControl = fields[0]
+        self._duration = fields[1]
+        self._raw_receiver = fields[2]
+        if len(fields) > 3:
+            self._raw_transmitter = fields[3]
+        else:
+            self._raw_transmitter = None
 
-    def _process(self, data):
-        '''Process Beacon frame fields.'''
-        self._frameControl = FrameControl(data[:2])
-        if self._frameControl.getType() != TYPE_MANAGEMENT:
-            raise Exception("Invalid Frame Type.")
-        if self._frameControl.getSubtype() != SUBTYPE_MANAGEMENT_BEACON:
-            raise Exception("Invalid Frame Subtype.")
-        self._duration = struct.unpack("H", data[2:4])[0]
-        self._destination = helpers.bytes_to_mac_address(data[4:10])
-        self._source = helpers.bytes_to_mac_address(data[10:16])
-        self._bssid = helpers.bytes_to_mac_address(data[16:22])
-        # Process sequence control field
-        seqctrl = struct.unpack("H", data[22:24])[0]
-        self._fragment = (seqctrl & 0x000F)
-        self._sequence = (seqctrl & 0xFFF0) >> 4
-        self._timestamp = struct.unpack("Q", data[24:32])[0]
-        self._interval = struct.unpack("H", data[32:34])[0]
-        self._capabilities = struct.unpack("H", data[34:36])[0]
-        if self._frame_size > DOT11_BEACON_FRAME_FIELDS_SIZE + FCS_SIZE:
-            # To get the offset of the information elements we need to go
-            # to the end offset of the essential fields of the beacon frame
-            # up to the end of the frame substracting the 4 bytes of the FCS.
-            ie_data = data[DOT11_BEACON_FRAME_FIELDS_SIZE:-4]
-            self._processInformationElements(ie_data)
-
-    def _processInformationElements(self, data):
-        '''Process Information Elements.'''
-        index = 0
-        # ie header -> 2 bytes
-        # ie id -> 1 byte
-        # ie len -> 1 byte
-        ie_header_size = 2
-        data_length = len(data)
-        while(data_length):
-            if data_length < ie_header_size:
-                break
-            ie_id = struct.unpack("B", data[index])[0]
-            ie_len = struct.unpack("B", data[index + 1])[0]
-            if (data_length - ie_header_size) < ie_len:
-                break
-            begin = index + ie_header_size
-            end = begin + ie_len
-            ie_data = data[begin:end]
-            self._raw_ies[ie_id] = ie_data
-            ie_item = InformationElementHelper(ie_id, ie_data)
-            self._ies[ie_item.getName()] = ie_item.getData()
-            data_length -= (ie_len + ie_header_size)
-            index += (ie_len + ie_header_size)
+    def getSubtype(self):
+        '''Returns the frame subtype.'''
+        return (self._frameControl & 0x00F0) >> 4
 
     def getDuration(self):
-        '''Returns Beacon Duration field.'''
+        '''Returns the NAV duration in microseconds, 0 if the Duration/ID
+           field does not carry a duration.'''
+        if self._duration & 0x8000:
+            return 0
         return self._duration
 
-    def getDestination(self):
-        '''Returns Beacon Destination field.'''
-        return self._destination
+    def getRawReceiverAddress(self):
+        '''Returns the receiver address as a 6 bytes string.'''
+        return self._raw_receiver
 
-    def getSource(self):
-        '''Returns Beacon Source field.'''
-        return self._source
+    def getRawTransmitterAddress(self):
+        '''Returns the transmitter address as a 6 bytes string or None if
+           the frame does not carry it.'''
+        return self._raw_transmitter
+
+    def getReceiverAddress(self):
+        '''Returns the receiver address.'''
+        return helpers.bytes_to_mac_address(self._raw_receiver)
+
+    def getTransmitterAddress(self):
+        '''Returns the transmitter address or None.'''
+        if self._raw_transmitter is None:
+            return None
+        return helpers.bytes_to_mac_address(self._raw_transmitter)
+
+
+class RTS(ControlFrame):
+    '''Request To Send frame: duration, receiver and transmitter.'''
+    __slots__ = ()
+    SUBTYPE = SUBTYPE_CONTROL_RTS
+
+
+class CTS(ControlFrame):
+    '''Clear To Send frame: duration and receiver.'''
+    __slots__ = ()
+    SUBTYPE = SUBTYPE_CONTROL_CTS
+    HEADER = control_header
+
+
+class ACK(ControlFrame):
+    '''Acknowledgment frame: duration and receiver.'''
+    __slots__ = ()
+    SUBTYPE = SUBTYPE_CONTROL_ACK
+    HEADER = control_header
+
+
+class PSPoll(ControlFrame):
+    '''Power Save Poll frame: association id, bssid and transmitter.'''
+    __slots__ = ()
+    SUBTYPE = SUBTYPE_CONTROL_PS_POLL
+
+    def getAssociationId(self):
+        '''Returns the association id carried on the Duration/ID field.'''
+        return self._duration & 0x3FFF
 
     def getBssid(self):
-        '''Returns Beacon BSSID field.'''
-        return self._bssid
+        '''Returns the bssid (receiver address).'''
+        return self.getReceiverAddress()
 
-    def getFragment(self):
-        '''Returns Beacon fragment field.'''
-        return self._fragment
 
-    def getSequence(self):
-        '''Returns Beacon sequence field.'''
-        return self._sequence
+class BlockAckRequest(ControlFrame):
+    '''Block Acknowledgment Request frame: duration, receiver and
+       transmitter. The BAR control and information fields are ignored.'''
+    __slots__ = ()
+    SUBTYPE = SUBTYPE_CONTROL_BLOCK_ACK_REQ
 
-    def getTimestamp(self):
-        '''Returns Beacon timestamp field.'''
-        return self._timestamp
 
-    def getInterval(self):
-        '''Returns Beacon interval field.'''
-        return self._interval
+class BlockAck(ControlFrame):
+    '''Block Acknowledgment frame: duration, receiver and transmitter.
+       The BA control, information and bitmap fields are ignored.'''
+    __slots__ = ()
+    SUBTYPE = SUBTYPE_CONTROL_BLOCK_ACK
 
-    def getCapabilities(self):
-        '''Returns Beacon capabilities field.'''
-        return self._capabilities
 
-    def getRawInformationElements(self):
-        '''Returns dictionary with Beacon information elements.'''
-        return self._raw_ies
+class CFEnd(ControlFrame):
+    '''Contention Free End frame (with or without CF-ACK): duration,
+       receiver and bssid.'''
+    __slots__ = ()
+    SUBTYPE = SUBTYPE_CONTROL_CF_END
+
+
+control_frame_class = {
+    SUBTYPE_CONTROL_BLOCK_ACK_REQ: BlockAckRequest,
+    SUBTYPE_CONTROL_BLOCK_ACK: BlockAck,
+    SUBTYPE_CONTROL_PS_POLL: PSPoll,
+    SUBTYPE_CONTROL_RTS: RTS,
+    SUBTYPE_CONTROL_CTS: CTS,
+    SUBTYPE_CONTROL_ACK: ACK,
+    SUBTYPE_CONTROL_CF_END: CFEnd,
+    SUBTYPE_CONTROL_CF_END_ACK: CFEnd}
 
-    def getInformationElements(self):
-        '''Returns dictionary with Beacon information elements.'''
-        return self._ies
+
+def parse_control_frame(data):
+    '''Returns the ControlFrame subclass instance for the frame or None
+       if the subtype is reserved.'''
+    subtype = (ord(data[0]) & 0xF0) >> 4
+    if subtype not in control_frame_class:
+        return None
+    return control_frame_class[subtype](data)
 
 
 class InformationElementHelper(object):
@@ -705,7 +1303,20 @@ class InformationElementHelper(object):
 
     def _process(self):
         '''Process information element data.'''
-        if self._ie_id in information_elements_id.keys():
+        if self._ie_id in cached_information_elements_id:
+            key = (self._ie_id, self._ie_data)
+            cached = ie_cache.get(key)
+            if cached is None:
+                self._decode()
+                cached = (self._name, freeze(self._data))
+                ie_cache.put(key, cached)
+            self._name, self._data = cached
+        else:
+            self._decode()
+
+    def _decode(self):
+        '''Decode information element data.'''
+        if self._ie_id in information_elements_id:
             self._name = information_elements_id[self._ie_id]
             if self._name == IE_SSID:
                 self._data = self._process_ssid(self._data)
@@ -731,3 +1342,138 @@ class InformationElementHelper(object):
         '''Returns a string with the processed
            information element value.'''
         return self._data
+
+
+if __name__ == "__main__":
+    def ie(ie_id, data):
+        return chr(ie_id) + chr(len(data)) + data
+
+    def frame(fc, flags, a1, a2, a3, seq=0, fragment=0, tail=''):
+        return struct.pack("<BBH", fc, flags, 0) + a1 + a2 + a3 + \
+            struct.pack("<H", (seq << 4) | fragment) + tail + '\x00' * FCS_SIZE
+
+    ap = '\x00\x11\x22\x33\x44\x55'
+    sta = '\x66\x77\x88\x99\xaa\xbb'
+    rsn = ie(0x30, '\x01\x00\x00\x0f\xac\x04\x01\x00\x00\x0f\xac\x04'
+                   '\x01\x00\x00\x0f\xac\x02\x00\x00')
+
+    def beacon(tim, ssid='test'):
+        return frame(0x80, 0, '\xff' * 6, ap, ap, tail='\x00' * 8 +
+                     struct.pack("<HH", 100, CAP_ESS | CAP_PRIVACY) +
+                     ie(0, ssid) + ie(IE_ID_TIM, tim) + ie(3, '\x06') + rsn)
+
+    # Beacon digest ignores the dynamic information elements only.
+    digest = BeaconSummary(beacon('\x00\x01\x00\x00')).getDigest()
+    if BeaconSummary(beacon('\x01\x02\x00\xff')).getDigest() != digest:
+        print "Error: digest changed with the TIM."
+    if BeaconSummary(beacon('\x00\x01\x00\x00', 'other')).getDigest() == \
+       digest:
+        print "Error: digest unchanged with the SSID."
+    if BeaconSummary(beacon('\x00\x01\x00\x00')).getBssid() != \
+       helpers.bytes_to_mac_address(ap):
+        print "Error: beacon summary BSSID incorrect."
+
+    # Decoded RSN elements are shared through the cache and read only.
+    ie_cache.clear()
+    first = Beacon(beacon('\x00\x01\x00\x00'))
+    second = Beacon(beacon('\x00\x01\x00\x00'))
+    if ie_cache.getHits() != 1 or ie_cache.getMisses() != 1:
+        print "Error: IE cache counters incorrect."
+    if first.getInformationElements()[IE_RSN] is not \
+       second.getInformationElements()[IE_RSN]:
+        print "Error: cached IE not shared."
+    try:
+        first.getInformationElements()[IE_RSN]['type'] = None
+        print "Error: cached IE not read only."
+    except TypeError:
+        pass
+    if first.getInformationElements()[IE_DS_PARAMETER_SET] != 6:
+        print "Error: channel incorrect."
+
+    # Header sizes: plain, WDS, QoS, WDS + QoS and QoS + HT Control.
+    for fc, flags, size in ((0x08, 0x01, 24), (0x08, 0x03, 30),
+                            (0x88, 0x01, 26), (0x88, 0x03, 32),
+                            (0x88, 0x81, 30)):
+        data = frame(fc, flags, ap, sta, ap, tail='\x00' * 8)
+        if frame_header_size(data) != size or \
+           DataFrame(data).getHeaderSize() != size:
+            print "Error: header size of %02x %02x incorrect." % (fc, flags)
+    qos = frame(0x88, 0x01, ap, sta, ap, tail='\x05\x00' + LLC_SNAP_HEADER +
+                '\x08\x00')
+    if DataFrame(qos).getTid() != 5 or DataFrame(qos).getEthertype() != 0x0800:
+        print "Error: QoS data frame decoded incorrectly."
+
+    # Control frames.
+    rts = parse_control_frame(struct.pack("<BBH", 0xb4, 0, 300) + ap + sta +
+                              '\x00' * FCS_SIZE)
+    if not isinstance(rts, RTS) or rts.getDuration() != 300 or \
+       rts.getRawTransmitterAddress() != sta:
+        print "Error: RTS decoded incorrectly."
+    ack = parse_control_frame(struct.pack("<BBH", 0xd4, 0, 44) + sta +
+                              '\x00' * FCS_SIZE)
+    if not isinstance(ack, ACK) or ack.getTransmitterAddress() is not None:
+        print "Error: ACK decoded incorrectly."
+    ps_poll = parse_control_frame(struct.pack("<BBH", 0xa4, 0, 0xC005) +
+                                  ap + sta + '\x00' * FCS_SIZE)
+    if ps_poll.getAssociationId() != 5 or ps_poll.getDuration() != 0:
+        print "Error: PS-Poll decoded incorrectly."
+    if parse_control_frame('\x74\x00' + '\x00' * 12) is not None:
+        print "Error: reserved control subtype decoded."
+
+    # Retransmissions are dropped, fragments are joined.
+    class Statistics(object):
+        def __init__(self):
+            self.frames = self.retries = self.duplicates = 0
+
+        def addSequencedFrame(self, transmitter, retry, duplicate):
+            self.frames += 1
+            self.retries += retry
+            self.duplicates += duplicate
+
+    statistics = Statistics()
+    tracker = SequenceTracker(statistics)
+    data = frame(0x08, 0x01, ap, sta, ap, seq=7, tail='payload')
+    retry = frame(0x08, 0x09, ap, sta, ap, seq=7, tail='payload')
+    if tracker.process(data) != data or tracker.process(retry) is not None:
+        print "Error: retransmission not dropped."
+    if tracker.process(frame(0x08, 0x09, ap, sta, ap, seq=8)) is None:
+        print "Error: retry of a new sequence dropped."
+    if (statistics.frames, statistics.retries, statistics.duplicates) != \
+       (3, 2, 1):
+        print "Error: sequence statistics incorrect."
+    # Same sequence number on another TID is not a duplicate.
+    tracker.process(frame(0x88, 0x01, ap, sta, ap, seq=9, tail='\x01\x00'))
+    if tracker.process(frame(0x88, 0x09, ap, sta, ap, seq=9,
+                             tail='\x02\x00')) is None:
+        print "Error: QoS TID not tracked separately."
+    parts = [frame(0x08, 0x05, ap, sta, ap, seq=10, fragment=0, tail='abc'),
+             frame(0x08, 0x05, ap, sta, ap, seq=10, fragment=1, tail='def'),
+             frame(0x08, 0x01, ap, sta, ap, seq=10, fragment=2, tail='gh')]
+    if tracker.process(parts[0]) is not None or \
+       tracker.process(parts[1]) is not None:
+        print "Error: fragment returned before the last one."
+    if tracker.process(parts[2]) != frame(0x08, 0x01, ap, sta, ap, seq=10,
+                                          tail='abcdefgh'):
+        print "Error: fragments joined incorrectly."
+    tracker.process(parts[0])
+    if tracker.process(parts[2]) is not None:
+        print "Error: frame with a missing fragment returned."
+    # Truncated WDS + QoS header.
+    for size in xrange(28, 36):
+        truncated = frame(0x88, 0x03, ap, sta, ap, seq=11)[:size]
+        if tracker.process(truncated) is not None:
+            print "Error: truncated frame of %d bytes returned." % size
+    # Transmitters seen once are dropped past the limit and the ttl.
+    tracker = SequenceTracker(limit=1000, ttl=10)
+    now = time.time()
+    tracker.expire(now)
+    for i in xrange(20000):
+        tracker.process(frame(0x08, 0x05, ap, struct.pack(">HI", 0x0200, i),
+                              ap, seq=i & 0xfff))
+    tracker.expire(now)
+    if len(tracker._history) != 1000 or len(tracker._fragments) != 1000 or \
+       tracker.getEvicted() != 19000:
+        print "Error: sequence state not bounded by the limit."
+    tracker.expire(now + 11)
+    if tracker._history or tracker._fragments:
+        print "Error: sequence state not expired."
@@ -0,0 +1,132 @@
+#/usr/bin/env python
+
+# Copyright (c) 2012, Andres Blanco and Matias Eissler
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. All advertising materials mentioning features or use of this software
+#    must display the following acknowledgement:
+#    This product includes software developed by the authors.
+# 4. Neither the name of the authors nor the
+#    names of its contributors may be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from collections import OrderedDict
+
+
+class LruTracker(object):
+    '''Keys ordered by the time they were last used, the least recently
+       used first.
+
+       Touching and evicting a key take constant time. Keys are evicted
+       when there are more than limit keys or when they were not used for
+       ttl seconds, 0 disables either bound.
+    '''
+    def __init__(self, limit=0, ttl=0):
+        self.limit = limit
+        self.ttl = ttl
+        self.order = OrderedDict()
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.order)
+
+    def __contains__(self, key):
+        return key in self.order
+
+    def touch(self, key, now):
+        '''Marks key as used at now.'''
+        order = self.order
+        if key in order:
+            del order[key]
+        order[key] = now
+
+    def touchOnce(self, key, now):
+        '''Marks key as used at now, unless it already was. A key used
+           many times with the same now moves to the end only once, which
+           is cheaper when now only advances between expires.'''
+        order = self.order
+        if order.get(key) != now:
+            if key in order:
+                del order[key]
+            order[key] = now
+
+    def discard(self, key):
+        '''Forgets key without counting it as evicted.'''
+        self.order.pop(key, None)
+
+    def getLastUse(self, key):
+        return self.order.get(key)
+
+    def expire(self, now, keep=None):
+        '''Returns the keys evicted, the least recently used first. Keys
+           for which keep returns True are touched instead of evicted.'''
+        order = self.order
+        limit = self.limit
+        cutoff = now - self.ttl if self.ttl else None
+        evicted = []
+        kept = 0
+        while order and kept < len(order):
+            key = next(iter(order))
+            over = limit and len(order) > limit
+            if not over and (cutoff is None or order[key] >= cutoff):
+                break
+            if keep is not None and keep(key):
+                self.touch(key, now)
+                kept += 1
+                continue
+            del order[key]
+            evicted.append(key)
+        self.evicted += len(evicted)
+        return evicted
+
+
+if __name__ == "__main__":
+    lru = LruTracker(limit=3, ttl=10)
+    for i, key in enumerate('abcd'):
+        lru.touch(key, i)
+    lru.touch('a', 4)
+    if lru.expire(5) != ['b']:
+        print "Error: least recently used key not evicted."
+    if lru.expire(13.5) != ['c', 'd']:
+        print "Error: expired keys not evicted."
+    if lru.expire(100, lambda key: key == 'a') or not 'a' in lru:
+        print "Error: kept key evicted."
+    if lru.evicted != 3:
+        print "Error: evictions not counted."
+    lru = LruTracker()
+    for key in 'abca':
+        lru.touchOnce(key, 1)
+    lru.touchOnce('a', 2)
+    if list(lru.order) != ['b', 'c', 'a'] or lru.getLastUse('a') != 2:
+        print "Error: touchOnce order incorrect."
+    # Constant time per operation whatever the size.
+    import time
+    for size in (1000, 100000):
+        lru = LruTracker(limit=size)
+        for i in xrange(size):
+            lru.touch(i, i)
+        t0 = time.time()
+        for i in xrange(size, size + 10000):
+            lru.touch(i % size, i)
+            lru.touch(i, i)
+            lru.expire(i)
+        print "%d keys: %.1f us per touch and eviction." % \
+            (size, (time.time() - t0) * 1e6 / 10000)
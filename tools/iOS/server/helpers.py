@@ -57,6 +57,14 @@ def bytes_to_mac_address(bytes):
     return ':'.join(result)
 
 
+def mac_address_to_bytes(mac_address):
+    '''Returns a bytes string from a mac address string.
+       Input -> '00:01:02:03:04:05'
+       Output -> '\x00\x01\x02\x03\x04\x05'
+    '''
+    return mac_address.replace(":", "").decode('hex')
+
+
 def get_vendor_from_oui(oui):
     '''Returns the vendor name from an OUI.'''
     oui_regex = "([0-9a-fA-F][0-9a-fA-F][:-]){2}[0-9a-fA-F][0-9a-fA-F]"
@@ -88,6 +96,11 @@ if __name__ == "__main__":
     if result != "00:01:02:03:04:05":
         print "Error: bytes_to_mac_address() -> %r" % result
     print "OK: bytes_to_mac_address() -> %r" % result
+    # Test mac_address_to_bytes function
+    result = mac_address_to_bytes("00:01:02:03:04:05")
+    if result != "\x00\x01\x02\x03\x04\x05":
+        print "Error: mac_address_to_bytes() -> %r" % result
+    print "OK: mac_address_to_bytes() -> %r" % result
     # Test get_vendor_from_oui function
     result = get_vendor_from_oui("00:00:00")
     if result != "XEROX CORPORATION":
@@ -0,0 +1,179 @@
+#/usr/bin/env python
+
+# Copyright (c) 2012, Andres Blanco and Matias Eissler
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. All advertising materials mentioning features or use of this software
+#    must display the following acknowledgement:
+#    This product includes software developed by the authors.
+# 4. Neither the name of the authors nor the
+#    names of its contributors may be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import ioctl
+
+# 2.4 GHz channels, 14 is only allowed in Japan.
+CHANNELS = range(1, 15)
+# Dwell time bounds in seconds. Beacons are usually sent every 102.4 ms.
+MIN_DWELL = 0.15
+MAX_DWELL = 1.0
+# Retries of a channel change before skipping the channel.
+MAX_RETRIES = 2
+# A new network counts as this many frames.
+NEW_NETWORK_WEIGHT = 50
+# Smoothing of the activity of a channel between visits.
+ACTIVITY_ALPHA = 0.3
+
+
+class ChannelHopper(object):
+    '''Visits every channel once per cycle and stays longer on the busy
+       ones.
+
+       The activity of a channel is the rate of frames seen while on it
+       plus NEW_NETWORK_WEIGHT per network found, smoothed between visits.
+       The dwell time grows linearly from min_dwell on a quiet channel to
+       max_dwell on the busiest one, quiet channels are still checked on
+       every cycle. Channels not visited yet get max_dwell.
+    '''
+    def __init__(self, channels=CHANNELS, min_dwell=MIN_DWELL,
+                 max_dwell=MAX_DWELL, retries=MAX_RETRIES,
+                 setChannel=ioctl.set_channel_checked):
+        self.channels = list(channels)
+        self.minDwell = min_dwell
+        self.maxDwell = max_dwell
+        self.retries = retries
+        self.setChannel = setChannel
+        self.activity = dict((c, None) for c in self.channels)
+        self.index = -1
+        self.current = None
+        self.paused = False
+        self.dwellStart = 0
+        self.nextHop = 0
+        self.lastFrames = 0
+        self.lastNetworks = 0
+        self.hops = 0
+        self.failures = 0
+
+    def getCurrentChannel(self):
+        return self.current
+
+    def getActivity(self, channel):
+        return self.activity.get(channel)
+
+    def getNextHop(self):
+        '''Returns the time of the next hop, None while paused.'''
+        if self.paused:
+            return None
+        return self.nextHop
+
+    def getDwell(self, channel):
+        activity = self.activity.get(channel)
+        if activity is None:
+            return self.maxDwell
+        busiest = max(a for a in self.activity.itervalues() if a is not None)
+        if busiest <= 0:
+            return self.minDwell
+        return self.minDwell + \
+            (self.maxDwell - self.minDwell) * activity / busiest
+
+    def pause(self):
+        self.paused = True
+
+    def pauseOn(self, channel):
+        '''Moves to channel and stays there, returns False and keeps
+           hopping if the channel could not be set.'''
+        if not self.setChannel(channel, self.retries):
+            self.failures += 1
+            return False
+        self.current = channel
+        self.paused = True
+        return True
+
+    def resume(self, now):
+        '''Restarts hopping, the activity seen while paused is ignored.'''
+        self.paused = False
+        self.current = None
+        self.nextHop = now
+
+    def hop(self, now, frames, networks):
+        '''Accounts the activity of the current channel and moves to the
+           next channel that can be set. frames and networks are the
+           totals seen since the start.'''
+        if self.current is not None:
+            elapsed = max(now - self.dwellStart, 1e-3)
+            rate = (frames - self.lastFrames +
+                    NEW_NETWORK_WEIGHT * (networks - self.lastNetworks)) / elapsed
+            last = self.activity[self.current]
+            if last is None:
+                self.activity[self.current] = rate
+            else:
+                self.activity[self.current] = last + ACTIVITY_ALPHA * (rate - last)
+        self.lastFrames = frames
+        self.lastNetworks = networks
+        self.current = None
+        for i in xrange(len(self.channels)):
+            self.index = (self.index + 1) % len(self.channels)
+            channel = self.channels[self.index]
+            if self.setChannel(channel, self.retries):
+                self.current = channel
+                self.hops += 1
+                break
+            self.failures += 1
+        self.dwellStart = now
+        self.nextHop = now + self.getDwell(self.current)
+
+
+if __name__ == "__main__":
+    card = {'channel': None}
+    def set_channel(channel, retries):
+        # The card refuses channel 14.
+        if channel == 14:
+            return False
+        card['channel'] = channel
+        return True
+
+    hopper = ChannelHopper(setChannel=set_channel)
+    # Traffic per second on each channel.
+    traffic = dict((c, 0) for c in CHANNELS)
+    traffic.update({1: 400, 6: 200, 11: 100})
+    now = frames = 0
+    hopper.hop(now, frames, 0)
+    time_on = dict((c, 0.0) for c in CHANNELS)
+    for i in xrange(14 * 20):
+        dwell = hopper.getNextHop() - now
+        time_on[card['channel']] += dwell
+        frames += traffic[card['channel']] * dwell
+        now += dwell
+        hopper.hop(now, frames, 0)
+    if time_on[14] or not hopper.failures:
+        print "Error: channel 14 not skipped."
+    if hopper.getDwell(1) != MAX_DWELL or hopper.getDwell(2) != MIN_DWELL:
+        print "Error: dwell bounds incorrect."
+    if not time_on[1] > time_on[6] > time_on[11] > time_on[2]:
+        print "Error: dwell not ordered by activity."
+    # Following a network moves to its channel, or keeps hopping.
+    if hopper.pauseOn(14) or hopper.getNextHop() is None:
+        print "Error: paused on a channel that could not be set."
+    if not hopper.pauseOn(3) or card['channel'] != 3 or \
+       hopper.getNextHop() is not None:
+        print "Error: not paused on the channel of the network."
+    print "Seconds per channel:", ", ".join(
+        "%d: %.1f" % (c, time_on[c]) for c in CHANNELS)
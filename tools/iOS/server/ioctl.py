@@ -46,6 +46,7 @@ WLC_GET_RADIO = 37
 WLC_SET_RADIO = 38
 WLC_GET_VAR = 262
 WLC_SET_VAR = 263
+WLC_INJECT = 0xfafa
 
 
 class apple80211req(ctypes.Structure):
@@ -56,6 +57,24 @@ class apple80211req(ctypes.Structure):
                 ("req_data", ctypes.c_void_p)]
 
 
+_libSystem = None
+_socket = None
+_inject_req = None
+
+
+def _ioctl(req):
+    '''Sends the request, libSystem and the socket are reused.'''
+    global _libSystem, _socket
+    if _libSystem is None:
+        _libSystem = ctypes.cdll.LoadLibrary("/usr/lib/libSystem.B.dylib")
+        _libSystem.__error.restype = ctypes.POINTER(ctypes.c_int)
+        _libSystem.strerror.restype = ctypes.c_char_p
+        _socket = socket.socket()
+    if _libSystem.ioctl(_socket.fileno(), SIOCSA80211, ctypes.byref(req)) != 0:
+        errno = _libSystem.__error().contents.value
+        raise Exception("ioctl error: %s" % _libSystem.strerror(errno))
+
+
 def wl_ioctl(cmd, buff=''):
     req = apple80211req()
     req.ifname = "en0\0"
@@ -72,15 +91,7 @@ def wl_ioctl(cmd, buff=''):
         req.req_data = ctypes.cast(buff, ctypes.c_void_p)
         req.req_len = 4
 
-    libSystem = ctypes.cdll.LoadLibrary("/usr/lib/libSystem.B.dylib")
-    s = socket.socket()
-    if libSystem.ioctl(s.fileno(), SIOCSA80211, ctypes.byref(req)) != 0:
-        libSystem.__error.restype = ctypes.POINTER(ctypes.c_int)
-        libSystem.strerror.restype = ctypes.c_char_p
-        errno = libSystem.__error().contents.value
-        raise Exception("ioctl error: %s" % libSystem.strerror(errno))
-
-    s.close()
+    _ioctl(req)
     return ''.join(x for x in buff)
 
 
@@ -91,7 +102,22 @@ def test_ioctl():
 
 def inject(frame):
     buff = struct.pack("<L", len(frame)) + frame
-    wl_ioctl(0xfafa, buff)
+    wl_ioctl(WLC_INJECT, buff)
+
+
+def inject_buffer(buff):
+    '''Injects a frame from a ctypes buffer that starts with the frame
+       length (see builder.FrameTemplate.getInjectionBuffer). The buffer
+       is used in place and the request structure is reused.'''
+    global _inject_req
+    if _inject_req is None:
+        _inject_req = apple80211req()
+        _inject_req.ifname = "en0\0"
+        _inject_req.req_type = APPLE80211_IOC_CARD_SPECIFIC
+        _inject_req.req_val = WLC_INJECT
+    _inject_req.req_data = ctypes.addressof(buff)
+    _inject_req.req_len = ctypes.sizeof(buff)
+    _ioctl(_inject_req)
 
 
 def get_channel():
@@ -105,6 +131,19 @@ def set_channel(number):
     wl_ioctl(WLC_SET_CHANNEL, struct.pack("<L", number))
 
 
+def set_channel_checked(number, retries=2):
+    '''Sets the channel and checks that the card moved to it, trying
+       again at most retries times. Returns True if the channel was set.'''
+    for i in xrange(retries + 1):
+        try:
+            set_channel(number)
+            if get_channel()[0] == number:
+                return True
+        except Exception, e:
+            print e
+    return False
+
+
 def get_radio():
     return struct.unpack("<L", wl_ioctl(WLC_GET_RADIO))[0]
 
@@ -129,29 +168,9 @@ if __name__ == "__main__":
         raise Exception("test failed")
 
     # beacon frame.
-    ssid = 'ipad injected'
-    frame = (
-        "80000000"
-        "ffffffff"
-        "ffffe0cb"
-        "4e52a3cb"
-        "e0cb4e52"
-        "a3cbf072"
-        "8b91606e"
-        "a4010000"
-        "64002104"
-        "00").decode('hex') + struct.pack('b', len(ssid)) + ssid + (
-        "0108"
-        "82848b96"
-        "2430486c"
-        "03010605"
-        "04000100"
-        "002a0100"
-        "2f010032"
-        "040c1218"
-        "60dd0600"
-        "10180200"
-        "00").decode('hex')
+    import builder
+    beacon = builder.BeaconTemplate("e0:cb:4e:52:a3:cb", "ipad injected", 6)
+    beacon_buffer = beacon.getInjectionBuffer()
 
     channel = 8
     set_channel(channel)
@@ -175,4 +194,5 @@ if __name__ == "__main__":
             print "radio changed to", cur_radio
             set_radio(radio)
 
-        inject(frame)
+        beacon.nextSequence()
+        inject_buffer(beacon_buffer)
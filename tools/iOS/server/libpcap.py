@@ -29,18 +29,29 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import ctypes
+import ctypes.util
 import helpers
 
 libpcap_filename = "libpcap.dylib"
-_libpcap_lib = ctypes.cdll.LoadLibrary(libpcap_filename)
 
-if helpers.is_lib_installed_on_system(libpcap_filename):
+if not helpers.is_lib_installed_on_system(libpcap_filename):
+    # Not on iOS, look for the system libpcap (i.e. Linux).
+    libpcap_filename = ctypes.util.find_library("pcap") or libpcap_filename
+
+try:
     _libpcap_lib = ctypes.cdll.LoadLibrary(libpcap_filename)
-else:
+except OSError:
     print "Error: unable to load \"%s\" library." % libpcap_filename
+    raise
 
 PCAP_NETMASK_UNKNOWN = 0xffffffff
 
+# pcap_next_ex results.
+PCAP_NEXT_OK = 1
+PCAP_NEXT_TIMEOUT = 0
+PCAP_NEXT_ERROR = -1
+PCAP_NEXT_EOF = -2
+
 
 class sockaddr(ctypes.Structure):
     _fields_ = [("sa_family", ctypes.c_ushort),
@@ -78,6 +89,12 @@ class pcap_pkthdr(ctypes.Structure):
                 ('len', ctypes.c_uint)]
 
 
+class pcap_stat(ctypes.Structure):
+    _fields_ = [('ps_recv', ctypes.c_uint),
+                ('ps_drop', ctypes.c_uint),
+                ('ps_ifdrop', ctypes.c_uint)]
+
+
 class bpf_insn(ctypes.Structure):
     _fields_ = [('code', ctypes.c_ushort),
                 ('jt', ctypes.c_ubyte),
@@ -166,6 +183,83 @@ def pcap_next(handle):
     return pkthdr, pktdata[:pkthdr.len]
 
 
+def pcap_open_offline(filename):
+    '''Open a savefile (pcap capture file) for reading.'''
+    # pcap_t* pcap_open_offline(const char* fname, char* errbuf)
+    pcap_open_offline = _libpcap_lib.pcap_open_offline
+    pcap_open_offline.restype = ctypes.POINTER(ctypes.c_void_p)
+    pcap_open_offline.argtypes = [ctypes.c_char_p, ctypes.c_char_p]
+    errbuf = ctypes.create_string_buffer(256)
+    handle = pcap_open_offline(filename, errbuf)
+    if not handle:
+        print "Error opening file %s: %s" % (filename, errbuf.value)
+        return None
+    return handle
+
+
+def pcap_next_ex(handle):
+    '''Read the next packet, returns a tuple (result, header, data).
+
+       result is PCAP_NEXT_OK if a packet was read, PCAP_NEXT_TIMEOUT if
+       no packet is available (live capture), PCAP_NEXT_EOF at the end of a
+       savefile or PCAP_NEXT_ERROR. header and data are None unless a
+       packet was read.'''
+    # int pcap_next_ex(pcap_t* p, struct pcap_pkthdr** pkt_header,
+    #                  const u_char** pkt_data)
+    pcap_next_ex = _libpcap_lib.pcap_next_ex
+    pcap_next_ex.restype = ctypes.c_int
+    pcap_next_ex.argtypes = [ctypes.POINTER(ctypes.c_void_p),
+                             ctypes.POINTER(ctypes.POINTER(pcap_pkthdr)),
+                             ctypes.POINTER(ctypes.POINTER(ctypes.c_char))]
+    pkthdr = ctypes.POINTER(pcap_pkthdr)()
+    pktdata = ctypes.POINTER(ctypes.c_char)()
+    result = pcap_next_ex(handle, ctypes.byref(pkthdr), ctypes.byref(pktdata))
+    if result != PCAP_NEXT_OK:
+        return result, None, None
+    header = pkthdr.contents
+    return result, header, pktdata[:header.caplen]
+
+
+def pcap_get_selectable_fd(handle):
+    '''Return a file descriptor that can be used with select() to wait
+       for packets.'''
+    # int pcap_get_selectable_fd(pcap_t* p)
+    pcap_get_selectable_fd = _libpcap_lib.pcap_get_selectable_fd
+    pcap_get_selectable_fd.restype = ctypes.c_int
+    pcap_get_selectable_fd.argtypes = [ctypes.POINTER(ctypes.c_void_p)]
+    return pcap_get_selectable_fd(handle)
+
+
+def pcap_setnonblock(handle, nonblock):
+    '''Put a capture in non blocking mode.'''
+    # int pcap_setnonblock(pcap_t* p, int nonblock, char* errbuf)
+    pcap_setnonblock = _libpcap_lib.pcap_setnonblock
+    pcap_setnonblock.restype = ctypes.c_int
+    pcap_setnonblock.argtypes = [ctypes.POINTER(ctypes.c_void_p),
+                                 ctypes.c_int,
+                                 ctypes.c_char_p]
+    errbuf = ctypes.create_string_buffer(256)
+    result = pcap_setnonblock(handle, nonblock, errbuf)
+    if result != 0:
+        raise Exception(errbuf.value)
+    return result
+
+
+def pcap_stats(handle):
+    '''Return the packets received, dropped by pcap and dropped by the
+       interface since the capture started as a tuple, None if the
+       capture has no statistics (savefiles).'''
+    # int pcap_stats(pcap_t* p, struct pcap_stat* ps)
+    pcap_stats = _libpcap_lib.pcap_stats
+    pcap_stats.restype = ctypes.c_int
+    pcap_stats.argtypes = [ctypes.POINTER(ctypes.c_void_p),
+                           ctypes.POINTER(pcap_stat)]
+    stats = pcap_stat()
+    if pcap_stats(handle, ctypes.byref(stats)) != 0:
+        return None
+    return stats.ps_recv, stats.ps_drop, stats.ps_ifdrop
+
+
 def pcap_compile(handle, filter, bpf):
     '''Compile a packet filter, converting an high level filtering
        expression in a program that can be interpreted by the kernel-level
@@ -211,6 +305,7 @@ class Packet(object):
     '''Simple wrapper for the pcap structure.'''
     def __init__(self, header, data):
         self._length = header.len
+        self._timestamp = header.ts.tv_sec * 1000000 + header.ts.tv_usec
         self._data = data
 
     def getData(self):
@@ -219,6 +314,10 @@ class Packet(object):
     def getLength(self):
         return self._length
 
+    def getTimestamp(self):
+        '''Returns the capture timestamp in microseconds.'''
+        return self._timestamp
+
 if __name__ == "__main__":
     print "Testcases for libpcap module"
 
@@ -0,0 +1,151 @@
+#/usr/bin/env python
+
+# Copyright (c) 2012, Andres Blanco and Matias Eissler
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. All advertising materials mentioning features or use of this software
+#    must display the following acknowledgement:
+#    This product includes software developed by the authors.
+# 4. Neither the name of the authors nor the
+#    names of its contributors may be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import time
+
+# One of every SAMPLE_RATE frames is timed, counters are always exact.
+SAMPLE_RATE = 64
+# Histogram buckets, bucket i holds the times below 2 ** i microseconds.
+HISTOGRAM_BUCKETS = 32
+
+
+class Histogram(object):
+    '''Time histogram with power of two buckets in microseconds.'''
+    def __init__(self):
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        us = int(seconds * 1000000)
+        self.buckets[min(us.bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def getQuantile(self, p):
+        '''Returns the upper bound (seconds) of the bucket holding the
+           quantile p, None without samples.'''
+        if not self.count:
+            return None
+        rank = p * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return (1 << i) / 1000000.0
+        return self.max
+
+    def toDict(self):
+        result = {'count': self.count,
+                  'buckets': list(self.buckets)}
+        if self.count:
+            result['mean'] = self.total / self.count
+            result['max'] = self.max
+            result['p50'] = self.getQuantile(0.5)
+            result['p99'] = self.getQuantile(0.99)
+        return result
+
+
+class Metrics(object):
+    '''Counters and time histograms of the server. Per frame work is only
+       timed on one of every SAMPLE_RATE frames, the callers check
+       enabled first so disabled metrics cost an attribute lookup.'''
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.start = time.time()
+        self.counters = {}
+        self.histograms = {}
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def histogram(self, name):
+        '''Returns the histogram name, created on first use.'''
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        return histogram
+
+    def getUptime(self):
+        return max(time.time() - self.start, 1e-6)
+
+    def getSnapshot(self):
+        '''Returns the counters, their average rates since the start and
+           the histograms.'''
+        uptime = self.getUptime()
+        rates = dict((name, value / uptime)
+                     for name, value in self.counters.iteritems())
+        histograms = dict((name, h.toDict())
+                          for name, h in self.histograms.iteritems())
+        return {'enabled': self.enabled,
+                'uptime': uptime,
+                'counters': dict(self.counters),
+                'rates': rates,
+                'histograms': histograms}
+
+
+# Metrics of this process.
+registry = Metrics()
+
+
+if __name__ == "__main__":
+    metrics = Metrics(True)
+    h = metrics.histogram('test')
+    for us in (1, 3, 3, 100, 1000):
+        h.add(us / 1000000.0)
+    if h.getQuantile(0.5) != 4 / 1000000.0:
+        print "Error: histogram median incorrect."
+    if h.toDict()['max'] != 0.001:
+        print "Error: histogram maximum incorrect."
+    metrics.count('frames')
+    metrics.count('frames', 2)
+    if metrics.getSnapshot()['counters']['frames'] != 3:
+        print "Error: counter incorrect."
+    metrics.enable(False)
+    metrics.count('frames')
+    if metrics.counters['frames'] != 3:
+        print "Error: disabled metrics are updated."
+
+    # Cost of timing a sampled event.
+    loops = 100000
+    t0 = time.time()
+    for i in xrange(loops):
+        t1 = time.time()
+        h.add(time.time() - t1)
+    print "timed event: %.3f us, %.3f us per frame sampled 1/%d" % (
+        (time.time() - t0) * 1e6 / loops,
+        (time.time() - t0) * 1e6 / loops / SAMPLE_RATE, SAMPLE_RATE)
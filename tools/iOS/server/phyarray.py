@@ -0,0 +1,198 @@
+#/usr/bin/env python
+
+# Copyright (c) 2012, Andres Blanco and Matias Eissler
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. All advertising materials mentioning features or use of this software
+#    must display the following acknowledgement:
+#    This product includes software developed by the authors.
+# 4. Neither the name of the authors nor the
+#    names of its contributors may be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Vectorized PHY header decoding of whole captures for RSSI/channel
+# analytics. Requires NumPy, which the capture server does not need.
+
+import mmap
+import struct
+import numpy
+import phy
+
+PCAP_GLOBAL_HDR_SIZE = 24
+PCAP_FRAME_HDR_SIZE = 16
+PCAP_MAGIC_LE = '\xd4\xc3\xb2\xa1'
+PCAP_MAGIC_BE = '\xa1\xb2\xc3\xd4'
+
+ETHERNET_HEADER_SIZE = 14
+# Ethertype of the fake ethernet header added by the patched firmware.
+MONITOR_ETHERTYPE = 0xfafa
+
+# Common part of the wlc_d11rxhdr layouts (see phy.Bcm4329PhyHeader).
+_common_fields = [('frame_size', '<u2'),
+                  ('pad', '<u2'),
+                  ('phy_rx_status_0', '<u2'),
+                  ('phy_rx_status_1', '<u2'),
+                  ('phy_rx_status_2', '<u2'),
+                  ('phy_rx_status_3', '<u2'),
+                  ('phy_rx_status_4', '<u2'),
+                  ('phy_rx_status_5', '<u2'),
+                  ('rx_status_1', '<u2'),
+                  ('rx_status_2', '<u2'),
+                  ('rx_tsf_time', '<u2'),
+                  ('rx_chan', '<u2'),
+                  ('tsf_l', '<u4'),
+                  ('rssi', 'i1'),
+                  ('rxpwr0', 'i1'),
+                  ('rxpwr1', 'i1'),
+                  ('do_rssi_ma', 'i1')]
+
+phy_header_dtype = {
+    phy.Bcm4325PhyHeader: numpy.dtype(_common_fields),
+    phy.Bcm4329PhyHeader: numpy.dtype(_common_fields + [('rxpwr', 'i1', 4)]),
+    phy.Bcm4330PhyHeader: numpy.dtype(_common_fields + [('rxpwr', 'i1', 4)])}
+
+
+def pcap_packet_offsets(data):
+    '''Returns three arrays with the offset, the captured length and the
+       timestamp in microseconds of every packet of a pcap buffer.
+
+       The records have variable length and each one starts where the
+       previous one ends, so their offsets can only be found walking the
+       buffer. The walk stays in Python but only reads the captured
+       length of each record, the timestamps and lengths are then
+       gathered from all the record headers at once.
+    '''
+    magic = data[:4]
+    if magic == PCAP_MAGIC_LE:
+        byte_order = '<'
+    elif magic == PCAP_MAGIC_BE:
+        byte_order = '>'
+    else:
+        raise Exception("Invalid pcap magic.")
+    unpack_length = struct.Struct(byte_order + "I").unpack_from
+    offsets = []
+    append = offsets.append
+    data_length = len(data)
+    index = PCAP_GLOBAL_HDR_SIZE
+    while index + PCAP_FRAME_HDR_SIZE <= data_length:
+        length = unpack_length(data, index + 8)[0]
+        index += PCAP_FRAME_HDR_SIZE
+        if index + length > data_length:
+            break
+        append(index)
+        index += length
+    offsets = numpy.array(offsets, dtype=numpy.int64)
+    u4 = byte_order + 'u4'
+    record = numpy.dtype([('seconds', u4), ('microseconds', u4),
+                          ('length', u4), ('original_length', u4)])
+    raw = numpy.frombuffer(data, dtype=numpy.uint8)
+    index = (offsets - PCAP_FRAME_HDR_SIZE)[:, numpy.newaxis] + \
+        numpy.arange(PCAP_FRAME_HDR_SIZE)
+    records = raw[index].view(record)[:, 0]
+    timestamps = records['seconds'].astype(numpy.int64) * 1000000 + \
+        records['microseconds']
+    return offsets, records['length'].astype(numpy.int64), timestamps
+
+
+def extract_phy_headers(data, offsets, phy_header_class=phy.Bcm4329PhyHeader):
+    '''Returns a structured array with the PHY headers found at offsets.
+
+       data is any buffer (string, mmap) and offsets the position of each
+       PHY header on it. The headers are gathered with a single fancy
+       indexing operation and reinterpreted with the layout dtype.
+    '''
+    dtype = phy_header_dtype[phy_header_class]
+    raw = numpy.frombuffer(data, dtype=numpy.uint8)
+    index = offsets[:, numpy.newaxis] + numpy.arange(dtype.itemsize)
+    return raw[index].view(dtype)[:, 0]
+
+
+def phy_metadata(headers, phy_header_class=phy.Bcm4329PhyHeader):
+    '''Returns a dictionary of arrays with the channel, the rssi (NaN when
+       the PHY status is not valid), the TSF low word and the FCS status
+       of each header, using the same logic as phy_header_class.'''
+    rx_status_2 = headers['rx_status_2']
+    rssi_valid = (rx_status_2 & 0xFF00) == phy.RXS_PHYRXST_VALID
+    if phy_header_class is phy.Bcm4325PhyHeader:
+        rssi = headers['rssi']
+    else:
+        rssi = (headers['phy_rx_status_1'] & phy.PRXS1_nphy_PWR0_MASK)
+        rssi = rssi.astype(numpy.uint8).view(numpy.int8)
+    return {'channel': ((headers['rx_chan'] >> 3) & 0x00FF).astype(numpy.uint8),
+            'rssi': numpy.where(rssi_valid, rssi, numpy.nan).astype(numpy.float32),
+            'rssiValid': rssi_valid,
+            'tsf': headers['tsf_l'],
+            'fcsValid': (headers['rx_status_1'] & phy.RXS_FCSERR) == 0}
+
+
+def read_capture(filename, phy_header_class=phy.Bcm4329PhyHeader):
+    '''Returns phy_metadata() of every monitor mode packet of a raw pcap
+       capture (fake ethernet + PHY + 802.11), plus the pcap timestamps
+       and the 802.11 frame lengths.'''
+    f = open(filename, "rb")
+    try:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    offsets, lengths, timestamps = pcap_packet_offsets(data)
+    phy_header_size = phy_header_dtype[phy_header_class].itemsize
+    # Keep complete packets with the monitor mode ethertype.
+    raw = numpy.frombuffer(data, dtype=numpy.uint8)
+    complete = lengths >= ETHERNET_HEADER_SIZE + phy_header_size
+    offsets = offsets[complete]
+    lengths = lengths[complete]
+    timestamps = timestamps[complete]
+    ethertype = (raw[offsets + 12].astype(numpy.uint16) << 8) | \
+                raw[offsets + 13]
+    monitor = ethertype == MONITOR_ETHERTYPE
+    offsets = offsets[monitor]
+    headers = extract_phy_headers(data, offsets + ETHERNET_HEADER_SIZE,
+                                  phy_header_class)
+    result = phy_metadata(headers, phy_header_class)
+    result['timestamp'] = timestamps[monitor]
+    result['frameSize'] = lengths[monitor] - ETHERNET_HEADER_SIZE - \
+                          phy_header_size
+    return result
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) != 2:
+        print "Usage:"
+        print "\t%s <pcap file>" % sys.argv[0]
+        sys.exit(-1)
+
+    capture = read_capture(sys.argv[1])
+    channels = capture['channel']
+    print "Frames: %d" % len(channels)
+    print "FCS errors: %d" % numpy.count_nonzero(~capture['fcsValid'])
+    for channel in numpy.unique(channels):
+        selected = channels == channel
+        rssi = capture['rssi'][selected]
+        rssi = rssi[~numpy.isnan(rssi)]
+        if len(rssi):
+            print "Channel %2d: %6d frames - rssi min %d avg %.1f max %d" % (
+                channel, numpy.count_nonzero(selected), rssi.min(),
+                rssi.mean(), rssi.max())
+        else:
+            print "Channel %2d: %6d frames" % (channel,
+                                               numpy.count_nonzero(selected))
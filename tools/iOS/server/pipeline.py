@@ -0,0 +1,329 @@
+#/usr/bin/env python
+
+# Copyright (c) 2012, Andres Blanco and Matias Eissler
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. All advertising materials mentioning features or use of this software
+#    must display the following acknowledgement:
+#    This product includes software developed by the authors.
+# 4. Neither the name of the authors nor the
+#    names of its contributors may be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import sys
+import time
+import zlib
+import multiprocessing
+
+import dot11
+
+# Events sent by the parse workers, plain tuples so they pickle fast.
+# (EVENT_BEACON, raw phy header, timestamp, bssid, digest, raw frame)
+EVENT_BEACON = 0
+# (EVENT_DATA, raw phy header, timestamp, bssid, source, FromDS)
+EVENT_DATA = 1
+# (EVENT_CONTROL, subtype, duration, raw transmitter, raw receiver)
+EVENT_CONTROL = 2
+# (EVENT_SEQUENCE, raw transmitter, retry, duplicate)
+EVENT_SEQUENCE = 3
+# (EVENT_EVICTED, transmitters dropped by the SequenceTracker)
+EVENT_EVICTED = 4
+
+# Batches waiting on each worker queue.
+QUEUE_SIZE = 64
+
+
+def shard_of(raw_bssid, shards):
+    '''Returns the worker of a BSSID. Control frames have no BSSID and
+       all go to the first worker, so RTS and CTS stay in order.'''
+    if raw_bssid is None:
+        return 0
+    return (zlib.crc32(raw_bssid) & 0xffffffff) % shards
+
+
+class EventCollector(object):
+    '''Statistics object of the worker SequenceTracker, the sequenced
+       frames are sent as events and accounted by the server.'''
+    def __init__(self, events):
+        self.events = events
+
+    def addSequencedFrame(self, transmitter, retry, duplicate):
+        self.events.append((EVENT_SEQUENCE, transmitter, retry, duplicate))
+
+
+def parse_frame(events, raw_phy, timestamp, raw_frame):
+    '''Appends the event of a frame, the same values OperationMode.onFrame
+       gets from the parsed frame.'''
+    if len(raw_frame) < dot11.DOT11_MIN_FRAME_SIZE:
+        return
+    fc = ord(raw_frame[0])
+    fc_type = (fc & 0x0C) >> 2
+    fc_subtype = (fc & 0xF0) >> 4
+    if fc_type == dot11.TYPE_CONTROL:
+        frame = dot11.parse_control_frame(raw_frame)
+        if frame is not None:
+            events.append((EVENT_CONTROL, frame.getSubtype(),
+                           frame.getDuration(),
+                           frame.getRawTransmitterAddress(),
+                           frame.getRawReceiverAddress()))
+    elif fc_type == 0 and fc_subtype == 8:
+        frame = dot11.BeaconSummary(raw_frame)
+        events.append((EVENT_BEACON, raw_phy, timestamp, frame.getBssid(),
+                       frame.getDigest(), raw_frame))
+    elif fc_type == 2:
+        frame = dot11.DataFrame(raw_frame)
+        events.append((EVENT_DATA, raw_phy, timestamp, frame.getBssid(),
+                       frame.getSourceAddress(),
+                       frame.getFrameControl().getFromDs()))
+
+
+def parse_worker(queue, conn, limit=0, ttl=0):
+    '''Parse stage. Drops retransmissions, joins fragments and parses
+       the frames of its BSSIDs, in capture order.'''
+    events = []
+    tracker = dot11.SequenceTracker(EventCollector(events), limit=limit,
+                                    ttl=ttl)
+    while True:
+        batch = queue.get()
+        if batch is None:
+            break
+        for raw_phy, timestamp, raw_frame in batch:
+            try:
+                raw_frame = tracker.process(raw_frame)
+                if raw_frame is not None:
+                    parse_frame(events, raw_phy, timestamp, raw_frame)
+            except Exception, e:
+                print repr(e)
+        evicted = tracker.getEvicted()
+        tracker.expire(time.time())
+        if tracker.getEvicted() > evicted:
+            events.append((EVENT_EVICTED, tracker.getEvicted() - evicted))
+        if events:
+            conn.send(events)
+            del events[:]
+    conn.close()
+
+
+def capture_stage(server, queues):
+    '''Capture stage. Reads the packets, drops the corrupted ones and
+       sends the rest to the worker of their BSSID in batches.'''
+    shards = len(queues)
+    batches = [[] for q in queues]
+    header_start = server.ethernet_header_size
+    header_end = header_start + server.phyHeaderClass.SIZE
+    while not server.captureDone:
+        packet = server.readPacket()
+        if packet is None:
+            # Timeout, do not keep the frames waiting for a full batch.
+            for i in xrange(shards):
+                if batches[i]:
+                    queues[i].put(batches[i])
+                    batches[i] = []
+            # The next replayed packet is not due yet.
+            wait = server.captureWait - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            continue
+        try:
+            phy_hdr, raw_frame = server.getPhyFrame(packet)
+            if raw_frame is None:
+                continue
+            i = shard_of(dot11.frame_bssid(raw_frame), shards)
+        except Exception, e:
+            # Skip the packet, the capture goes on.
+            print repr(e)
+            continue
+        batch = batches[i]
+        batch.append((packet.getData()[header_start:header_end],
+                      phy_hdr.getTimestamp(), raw_frame))
+        if len(batch) >= server.capture_batch:
+            queues[i].put(batch)
+            batches[i] = []
+    for queue in queues:
+        queue.put(None)
+
+
+class EventDispatcher(object):
+    '''asyncore channel reading the events of a worker. The pipe is
+       left blocking, a readable pipe always holds a whole message.'''
+    accepting = False
+
+    def __init__(self, server, conn, map):
+        self.server = server
+        self.conn = conn
+        self.map = map
+        self.fd = conn.fileno()
+        map[self.fd] = self
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read_event(self):
+        try:
+            events = self.conn.recv()
+        except EOFError:
+            self.handle_close()
+            return
+        self.server.onEvents(events)
+
+    def handle_expt_event(self):
+        self.handle_close()
+
+    def handle_close(self):
+        self.close()
+        self.server.onWorkerClosed()
+
+    def handle_error(self):
+        print repr(sys.exc_info()[1])
+
+    def close(self):
+        self.map.pop(self.fd, None)
+        self.conn.close()
+
+
+class Pipeline(object):
+    '''Runs the capture and the parsing of the server in other processes:
+
+       capture process -> parse workers (sharded by BSSID) -> server
+
+       A BSSID always goes to the same worker, so its frames keep the
+       capture order. The worker queues are bounded, when the server or
+       a worker falls behind the capture blocks and pcap drops packets.
+    '''
+    def __init__(self, server, workers):
+        self.server = server
+        self.workers = workers
+        self.processes = []
+
+    def start(self):
+        queues = []
+        conns = []
+        for i in xrange(self.workers):
+            queue = multiprocessing.Queue(QUEUE_SIZE)
+            reader, writer = multiprocessing.Pipe(False)
+            queues.append(queue)
+            conns.append((reader, writer))
+            self.processes.append(multiprocessing.Process(
+                target=parse_worker,
+                args=(queue, writer, self.server.sequenceLimit,
+                      self.server.sequence_ttl)))
+        self.processes.append(multiprocessing.Process(
+            target=capture_stage, args=(self.server, queues)))
+        for process in self.processes:
+            process.daemon = True
+            process.start()
+        # The events are read by the server only.
+        for reader, writer in conns:
+            writer.close()
+            EventDispatcher(self.server, reader, self.server.map)
+
+    def stop(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+
+
+if __name__ == "__main__":
+    import random
+    import struct
+    import threading
+
+    def run(packets, shards):
+        '''Returns the events of the packets parsed by shards workers.'''
+        queues = []
+        conns = []
+        processes = []
+        for i in xrange(shards):
+            queue = multiprocessing.Queue(QUEUE_SIZE)
+            reader, writer = multiprocessing.Pipe(False)
+            process = multiprocessing.Process(target=parse_worker,
+                                              args=(queue, writer))
+            process.daemon = True
+            process.start()
+            writer.close()
+            queues.append(queue)
+            conns.append(reader)
+            processes.append(process)
+        batches = [[] for i in xrange(shards)]
+        for packet in packets:
+            batches[shard_of(dot11.frame_bssid(packet[2]), shards)].append(
+                packet)
+
+        def feed():
+            # The queues are bounded, fill them while the events are read.
+            for queue, batch in zip(queues, batches):
+                for i in xrange(0, len(batch), 64):
+                    queue.put(batch[i:i + 64])
+                queue.put(None)
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        events = []
+        for conn in conns:
+            try:
+                while True:
+                    events.extend(conn.recv())
+            except EOFError:
+                pass
+        feeder.join()
+        for process in processes:
+            process.join()
+        return events
+
+    def header(fc, flags, a1, a2, a3, seq):
+        return struct.pack("<BBH", fc, flags, 0) + a1 + a2 + a3 + \
+            struct.pack("<H", seq << 4)
+
+    random.seed(1)
+    fcs = '\x00' * dot11.FCS_SIZE
+    packets = []
+    for i in xrange(5000):
+        bssid = '\x00\x11\x22\x33\x44' + chr(random.randrange(40))
+        # The stations of each network retransmit and fragment.
+        station = '\x66\x77\x88\x99' + bssid[-1] + chr(random.randrange(4))
+        kind = random.random()
+        if kind < 0.3:
+            frame = header(0x80, 0, '\xff' * 6, bssid, bssid, i % 4096) + \
+                '\x00' * 8 + struct.pack("<HH", 100, 1) + '\x00\x03net' + fcs
+        elif kind < 0.9:
+            flags = 0x01 | (0x08 if kind > 0.8 else 0)
+            frame = header(0x08, flags, bssid, station, '\xff' * 6,
+                           random.randrange(16)) + 'payload' + fcs
+        else:
+            frame = struct.pack("<BBH", 0xd4, 0, 44) + station + fcs
+        packets.append(('phy', i, frame))
+
+    single = run(packets, 1)
+    sharded = run(packets, 3)
+    if sorted(single) != sorted(sharded):
+        print "Error: sharded events differ from a single worker."
+
+    def per_bssid(events):
+        result = {}
+        for event in events:
+            if event[0] in (EVENT_BEACON, EVENT_DATA):
+                result.setdefault(event[3], []).append(event)
+        return result
+    if per_bssid(single) != per_bssid(sharded):
+        print "Error: frames of a BSSID out of capture order."
+    print "%d events from %d frames." % (len(single), len(packets))
@@ -0,0 +1,145 @@
+#/usr/bin/env python
+
+# Copyright (c) 2012, Andres Blanco and Matias Eissler
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. All advertising materials mentioning features or use of this software
+#    must display the following acknowledgement:
+#    This product includes software developed by the authors.
+# 4. Neither the name of the authors nor the
+#    names of its contributors may be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import time
+
+import applayer
+
+# Quantiles of the frame processing latency.
+LATENCY_QUANTILES = (0.5, 0.9, 0.99)
+
+
+class ReplayClock(object):
+    '''Maps the capture timestamps to the time the packets are due,
+       speed times faster than they were captured. A speed of 0 replays
+       as fast as possible.'''
+    def __init__(self, speed=0):
+        self.speed = speed
+        self.start = None
+        self.first = None
+
+    def getDue(self, timestamp):
+        '''Returns the time (seconds since the epoch) a packet captured at
+           timestamp (microseconds) must be processed.'''
+        now = time.time()
+        if self.speed <= 0:
+            return now
+        if self.start is None:
+            self.start = now
+            self.first = timestamp
+        return self.start + (timestamp - self.first) / (self.speed * 1e6)
+
+
+class ReplayStatistics(object):
+    '''Frames and messages throughput and latency quantiles of a replay.
+       The latency of a frame goes from the time it was due to the end of
+       its processing, so it grows when the server falls behind.'''
+    def __init__(self, quantiles=LATENCY_QUANTILES):
+        self.start = time.time()
+        self.end = None
+        self.frames = 0
+        self.messages = 0
+        self.maxLatency = 0
+        self.latency = [(p, applayer.P2Quantile(p)) for p in quantiles]
+
+    def addFrame(self, latency=None):
+        self.frames += 1
+        if latency is None:
+            return
+        if latency > self.maxLatency:
+            self.maxLatency = latency
+        for p, estimator in self.latency:
+            estimator.update(latency)
+
+    def addMessage(self):
+        # The UI is still updated after the replay ended.
+        if self.end is None:
+            self.messages += 1
+
+    def stop(self):
+        '''Ends the replay, the rates no longer count the time after.'''
+        if self.end is None:
+            self.end = time.time()
+
+    def isStopped(self):
+        return self.end is not None
+
+    def getElapsed(self):
+        if self.end is not None:
+            return self.end - self.start
+        return time.time() - self.start
+
+    def getFrameRate(self):
+        return self.frames / max(self.getElapsed(), 1e-6)
+
+    def getMessageRate(self):
+        return self.messages / max(self.getElapsed(), 1e-6)
+
+    def getLatency(self, p):
+        '''Returns the latency quantile p in seconds, None without
+           samples.'''
+        for q, estimator in self.latency:
+            if q == p:
+                return estimator.get()
+        return None
+
+    def __str__(self):
+        result = "%d frames (%.1f/s), %d messages (%.1f/s)" % (
+            self.frames, self.getFrameRate(),
+            self.messages, self.getMessageRate())
+        latencies = ["p%g %.3f ms" % (p * 100, estimator.get() * 1000)
+                     for p, estimator in self.latency
+                     if estimator.get() is not None]
+        if latencies:
+            result += ", latency %s, max %.3f ms" % (
+                " ".join(latencies), self.maxLatency * 1000)
+        return result
+
+
+if __name__ == "__main__":
+    clock = ReplayClock(2)
+    t0 = clock.getDue(1000000)
+    if abs(clock.getDue(3000000) - t0 - 1) > 1e-6:
+        print "Error: replay clock incorrect."
+    if abs(ReplayClock(0).getDue(3000000) - time.time()) > 0.1:
+        print "Error: replay as fast as possible incorrect."
+    stats = ReplayStatistics()
+    for i in xrange(1000):
+        stats.addFrame(i / 1000.0)
+    if abs(stats.getLatency(0.5) - 0.5) > 0.02:
+        print "Error: latency median incorrect."
+    if stats.maxLatency != 0.999:
+        print "Error: latency maximum incorrect."
+    stats.stop()
+    elapsed = stats.getElapsed()
+    time.sleep(0.01)
+    if stats.getElapsed() != elapsed:
+        print "Error: stopped replay still counting time."
+    print stats
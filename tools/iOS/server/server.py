@@ -30,15 +30,26 @@
 
 
 import socket
+import asyncore
+import optparse
 import libpcap
-import plistlib
 import struct
 import time
-import select
 import ioctl
 import phy
 import dot11
 import applayer
+import wire
+import pipeline
+import replay
+import metrics
+import hopping
+import snapshot
+import eviction
+from collections import deque
+
+# Length prefix of the messages, both ways.
+LENGTH = struct.Struct("<L")
 
 # Server Commands
 class ServerCommand(object):
@@ -46,17 +57,11 @@ class ServerCommand(object):
         ''' Returns a dictionary with command parameters '''
         raise NotImplementedError()
 
-    def getSerialized(self):
+    def getSerialized(self, encoding=wire.ENCODING_XML):
         ''' Returns a string plist representing the command '''
-        plist = plistlib.Plist()
+        plist = self.getData()
         plist['command'] = self.CMD_ID
-        
-        cmd_values = self.getData()
-        plist.update(cmd_values)
-        ret =  plistlib.writePlistToString(plist)
-        if isinstance(self,NetworkDetailCmd):
-            pass  #print ret
-        return ret 
+        return wire.encode(plist, encoding)
 
         
 
@@ -69,49 +74,115 @@ class NetworkUpdateCmd(ServerCommand): # Network update.
         self.phy_hdr = phy_hdr
 
     def getData(self):
-        return {'ssid': repr(self.network.getSsid())[1:-1],
+        data = {'ssid': repr(self.network.getSsid())[1:-1],
                 'bssid': self.network.getBssid(),
                 'protection': self.network.getSecurity(), # 'WEP',
-                'channel': self.phy_hdr.getChannel(),  
-                'rssi': self.phy_hdr.getRssi(),
                 'vendor': self.network.getVendor()}
+        # Restored networks have not been seen since the restart.
+        if self.phy_hdr is None:
+            data['channel'] = self.network.getChannel()
+            data['rssi'] = self.network.getRssiStatistics().getSmoothed()
+        else:
+            data['channel'] = self.phy_hdr.getChannel()
+            data['rssi'] = self.phy_hdr.getRssi()
+        # Smoothed rssi instead of the one of the last beacon.
+        data.update(self.network.getRssiStatistics().toDict())
+        return data
+
+
+class NetworkBatchCmd(ServerCommand):
+    ''' Networks that changed during the last tick, only the fields that
+        changed since the previous batch are sent besides the bssid '''
+    CMD_ID = 2
+    def __init__(self, deltas):
+        super(NetworkBatchCmd, self).__init__()
+        self.deltas = deltas
+
+    def getData(self):
+        return {'networks': self.deltas}
 
 
 class NetworkDetailCmd(ServerCommand):
+    ''' Stations of the selected network. Only the stations in macs are
+        sent, a full snapshot of the network if macs is None '''
     CMD_ID = 1
-    def __init__(self, network):
+    def __init__(self, network, linkStatistics, macs=None):
         super(NetworkDetailCmd, self).__init__()
         self.network = network
+        self.linkStatistics = linkStatistics
+        self.macs = macs
 
     def getData(self):
         stations = self.network.getStations()
-        clients = [stations[k].toDict() for k in stations]
-        return {'clients': clients}
+        macs = self.macs
+        if macs is None:
+            macs = stations.keys()
+        clients = []
+        for k in macs:
+            station = stations.get(k)
+            if station is None:
+                # Evicted since it was seen.
+                continue
+            client = station.toDict()
+            client['airtime'] = self.linkStatistics.getAirtime(k)
+            client['retryRate'] = self.linkStatistics.getRetryRate(k)
+            # Plists have no null, unknown values (vendor of randomized
+            # MACs) are left out.
+            clients.append(dict((key, value) for key, value
+                                in client.iteritems() if value is not None))
+        return {'clients': clients, 'full': self.macs is None}
+
+
+class MetricsCmd(ServerCommand):
+    ''' Runtime metrics of the server, sent to the client that asked '''
+    CMD_ID = 3
+    def __init__(self, snapshot):
+        super(MetricsCmd, self).__init__()
+        self.snapshot = snapshot
+
+    def getData(self):
+        return {'metrics': self.snapshot}
 
 
 # Client Commands
+# Client command classes by CMD_ID.
+client_commands = {}
+
+def register_command(cls):
+    ''' Class decorator that adds a client command to client_commands '''
+    if cls.CMD_ID in client_commands:
+        raise ValueError("Command %d already registered by %s." %
+                         (cls.CMD_ID, client_commands[cls.CMD_ID].__name__))
+    client_commands[cls.CMD_ID] = cls
+    return cls
+
+
 class ClientCommand(object):
     def __init__(self, server):
         self.server = server
+        # Connection that sent the command.
+        self.client = None
 
     def action(self):
         raise NotImplementedError()
 
     @classmethod
-    def fromStream(cls, stream, server):
-        size = stream.recv(4, socket.MSG_WAITALL)
-        size = struct.unpack("<L", size)[0]
-        rawCmd = stream.recv(size, socket.MSG_WAITALL)
-        cmd = plistlib.readPlistFromString(rawCmd)
-        return cls.fromDict(cmd, server)
+    def fromString(cls, rawCmd, server, client=None):
+        cmd = wire.decode(rawCmd)
+        return cls.fromDict(cmd, server, client)
 
     @classmethod
-    def fromDict(cls, d, server):
+    def fromDict(cls, d, server, client=None):
         cmd_id = d['command']
-        child = [c for c in cls.__subclasses__() if c.CMD_ID == cmd_id][0]
-        return child(d, server)
-        
+        child = client_commands.get(cmd_id)
+        if child is None:
+            raise ValueError("Unknown command %r." % cmd_id)
+        cmd = child(d, server)
+        cmd.client = client
+        return cmd
+
 
+@register_command
 class SetChannelCmd(ClientCommand):
     CMD_ID = 0
     def __init__(self, cmd, server):
@@ -119,10 +190,12 @@ class SetChannelCmd(ClientCommand):
         self.channel = cmd['channel']
 
     def action(self):
-        ioctl.set_channel(self.channel)
-        while ioctl.get_channel()[0] != self.channel:
-            ioctl.set_channel(self.channel)
+        # A fixed channel stops the hopping until asked again.
+        self.server.stopHopping()
+        if not ioctl.set_channel_checked(self.channel):
+            print "Channel %d could not be set." % self.channel
 
+@register_command
 class SetNetworkCmd(ClientCommand):
     CMD_ID = 1
     def __init__(self, cmd, server):
@@ -131,95 +204,476 @@ class SetNetworkCmd(ClientCommand):
 
     def action(self):
         network = self.server.networks[self.bssid]
-        newMode = NetworkDetailMode(self.server.networks, network)
+        newMode = NetworkDetailMode(self.server.networks,
+                                    self.server.linkStatistics,
+                                    network, self.server.changed,
+                                    self.server.changedStations)
         self.server.setMode(newMode)
+        self.server.pauseHopping(network.getChannel())
 
 
+@register_command
 class UnsetNetworkCmd(ClientCommand):
     CMD_ID = 2
     def __init__(self, cmd, server):
         super(UnsetNetworkCmd, self).__init__(server)
 
     def action(self):
-        newMode = PassiveScanMode(self.server.networks)
+        newMode = PassiveScanMode(self.server.networks,
+                                  self.server.linkStatistics,
+                                  self.server.changed,
+                                  self.server.changedStations)
         self.server.setMode(newMode)
+        self.server.resumeHopping()
+
+
+@register_command
+class ResyncCmd(ClientCommand):
+    ''' Asks for the whole state on the next update '''
+    CMD_ID = 4
+    def __init__(self, cmd, server):
+        super(ResyncCmd, self).__init__(server)
+
+    def action(self):
+        if self.client is None:
+            self.server.mode.resync()
+        else:
+            self.client.requestSnapshot()
+
+
+@register_command
+class GetMetricsCmd(ClientCommand):
+    CMD_ID = 5
+    def __init__(self, cmd, server):
+        super(GetMetricsCmd, self).__init__(server)
+
+    def action(self):
+        self.server.sendCommandTo(MetricsCmd(self.server.getMetrics()),
+                                  self.client)
+
+
+@register_command
+class SetHoppingCmd(ClientCommand):
+    ''' Starts or stops the channel hopping '''
+    CMD_ID = 6
+    def __init__(self, cmd, server):
+        super(SetHoppingCmd, self).__init__(server)
+        self.enabled = cmd['enabled']
+
+    def action(self):
+        if self.enabled:
+            self.server.startHopping()
+        else:
+            self.server.stopHopping()
+
+
+@register_command
+class SetEncodingCmd(ClientCommand):
+    ''' Selects the encoding of the messages sent to the client, XML
+        plists until the client asks for another one '''
+    CMD_ID = 3
+    def __init__(self, cmd, server):
+        super(SetEncodingCmd, self).__init__(server)
+        self.encoding = cmd['encoding']
+
+    def action(self):
+        if not self.encoding in wire.encoders:
+            raise Exception("Unknown encoding %s." % self.encoding)
+        self.client.setEncoding(self.encoding)
 
 
 class OperationMode(object):
-    def __init__(self, networks):
+    ''' Updates the networks from the captured frames. Frames are parsed
+        by onFrame, the pipeline workers send the same values to the
+        on*Frame methods already parsed '''
+    def __init__(self, networks, linkStatistics, changed=None,
+                 changedStations=None):
         self.networks = networks
+        self.linkStatistics = linkStatistics
+        # BSSIDs of the networks and (BSSID, MAC) of the stations
+        # updated, shared with the server that saves and evicts them.
+        if changed is None:
+            changed = set()
+        self.changed = changed
+        if changedStations is None:
+            changedStations = set()
+        self.changedStations = changedStations
+        self.lastRtsTransmitter = None
 
     def onFrame(self, phy_hdr, raw_frame):
-        frame = None
         try: 
-            fc = dot11.FrameControl(raw_frame)
-            if fc.getType() == 0 and fc.getSubtype() == 8:
-                frame = dot11.Beacon(raw_frame)
-                bssid = frame.getBssid()
-
-                if not bssid in self.networks:
-                    net = applayer.Network(frame)
-                    self.networks[bssid] = net
-
-            elif fc.getType() == 2:
-                frame = dot11.Data(raw_frame)
-                bssid = frame.getBssid()
-                if bssid in self.networks:
-                    net = self.networks[bssid]
-                    stations = net.getStations()
-                    src = frame.getSourceAddress()
-                    if not src in stations:
-                        net.addStation(applayer.Station(src))
-                    else:
-                        s = stations[src]
-                        s.incrementDataFrameStatistics()
-
-            return self.cmdFromFrame(frame, phy_hdr)
-
+            event = self.parseFrame(phy_hdr, raw_frame)
+            if event is not None:
+                handler, args = event
+                handler(*args)
         except Exception, e:
             print repr(e)
 
-    def cmdFromFrame(self, frame, phy_hdr):
-        raise NotImplementedError()
-    
+    def parseFrame(self, phy_hdr, raw_frame):
+        ''' Returns the handler of the frame and its arguments, None if
+            the frame is not used '''
+        # Frame control first byte: subtype (4 bits), type (2 bits)
+        # and protocol (2 bits).
+        fc = ord(raw_frame[0])
+        fc_type = (fc & 0x0C) >> 2
+        fc_subtype = (fc & 0xF0) >> 4
+        if fc_type == dot11.TYPE_CONTROL:
+            frame = dot11.parse_control_frame(raw_frame)
+            if frame is not None:
+                return self.onControlFrame, (frame.getSubtype(),
+                                             frame.getDuration(),
+                                             frame.getRawTransmitterAddress(),
+                                             frame.getRawReceiverAddress())
+
+        elif fc_type == 0 and fc_subtype == 8:
+            frame = dot11.BeaconSummary(raw_frame)
+            return self.onBeacon, (frame.getBssid(), frame.getDigest(),
+                                   raw_frame, phy_hdr)
+
+        elif fc_type == 2:
+            frame = dot11.DataFrame(raw_frame)
+            return self.onDataFrame, (frame.getBssid(),
+                                      frame.getSourceAddress(),
+                                      frame.getFrameControl().getFromDs(),
+                                      phy_hdr)
+        return None
+
+    def onBeacon(self, bssid, digest, raw_frame, phy_hdr):
+        # Only parse the whole beacon when it changed since the last
+        # one seen for the network.
+        net = self.networks.get(bssid)
+        if net is None:
+            net = applayer.Network(dot11.Beacon(raw_frame))
+            self.networks[bssid] = net
+        elif net.getBeaconDigest() != digest:
+            net.update(dot11.Beacon(raw_frame))
+        net.setBeaconDigest(digest)
+        net.updateRssi(phy_hdr.getRssi())
+        self.changed.add(bssid)
+        self.onBeaconSeen(bssid, phy_hdr)
+
+    def onDataFrame(self, bssid, src, fromDs, phy_hdr):
+        net = self.networks.get(bssid)
+        if net is None:
+            return
+        stations = net.getStations()
+        if not src in stations:
+            s = applayer.Station(src)
+            net.addStation(s)
+        else:
+            s = stations[src]
+            s.incrementDataFrameStatistics()
+        # The rssi belongs to the source only if it sent it.
+        if not fromDs:
+            s.updateRssi(phy_hdr.getRssi())
+        self.changed.add(bssid)
+        self.changedStations.add((bssid, src))
+        self.onDataSeen(bssid, src)
+
+    def onControlFrame(self, subtype, duration, transmitter, receiver):
+        '''Accounts the medium reserved by the control frame (Duration/ID
+           field) to the station that owns the frame exchange.'''
+        owner = transmitter
+        if subtype == dot11.SUBTYPE_CONTROL_RTS:
+            self.lastRtsTransmitter = owner
+        elif owner is None:
+            # CTS and ACK are owned by the station they are sent to.
+            owner = receiver
+            # The NAV of a CTS answering a RTS is already covered by it.
+            if (subtype == dot11.SUBTYPE_CONTROL_CTS and
+                owner == self.lastRtsTransmitter):
+                self.lastRtsTransmitter = None
+                return
+        if duration:
+            self.linkStatistics.addAirtime(owner, duration)
+
+    def onBeaconSeen(self, bssid, phy_hdr):
+        pass
+
+    def onDataSeen(self, bssid, src):
+        pass
+
+    def onTick(self):
+        ''' Called periodically, returns the command with the changes
+            collected since the last tick or None '''
+        return None
+
+    def keepsNetwork(self, bssid):
+        ''' Returns True if the network must not be evicted '''
+        return False
+
+    def forgetNetwork(self, bssid):
+        ''' Called when the network is evicted '''
+        pass
+
+    def forgetStation(self, bssid, mac):
+        ''' Called when a station of the network is evicted '''
+        pass
+
+    def resync(self):
+        ''' Sends the whole state to every client on the next tick '''
+        pass
+
+    def getSnapshot(self):
+        ''' Returns the command with the whole state or None, sent to a
+            client that connects or lost messages '''
+        return None
+
 
 class PassiveScanMode(OperationMode):
-    def __init__(self, networks):
-        super(PassiveScanMode, self).__init__(networks)
-        self.notificationTimes = {}
-
-    def cmdFromFrame(self, frame, phy_hdr):
-        ret = None
-        if isinstance(frame, dot11.Beacon):
-            bssid = frame.getBssid()
-            t0 = time.time()
-            notify = False
-            if not bssid in self.notificationTimes:
-                self.notificationTimes[bssid] = t0
-                notify = True
-            elif t0 - self.notificationTimes[bssid] > 1:
-                self.notificationTimes[bssid] = t0
-                notify = True
-
-            if notify:
-                ret = NetworkUpdateCmd(self.networks[bssid], phy_hdr)
-            
-        return ret
+    def __init__(self, networks, linkStatistics, changed=None,
+                 changedStations=None):
+        super(PassiveScanMode, self).__init__(networks, linkStatistics,
+                                              changed, changedStations)
+        # Last PHY header of every network, for the channel and rssi.
+        self.phyHeaders = {}
+        # Networks seen since the last tick.
+        self.dirty = set()
+        # State of every network as sent on the last batch.
+        self.sentStates = {}
+
+    def onBeaconSeen(self, bssid, phy_hdr):
+        self.phyHeaders[bssid] = phy_hdr
+        self.dirty.add(bssid)
+
+    def onTick(self):
+        deltas = []
+        for bssid in self.dirty:
+            cmd = NetworkUpdateCmd(self.networks[bssid],
+                                   self.phyHeaders.get(bssid))
+            state = dict((k, v) for k, v in cmd.getData().iteritems()
+                         if v is not None)
+            last = self.sentStates.get(bssid)
+            if last is None:
+                delta = state
+            else:
+                delta = dict((k, v) for k, v in state.iteritems()
+                             if last.get(k) != v)
+                if not delta:
+                    continue
+                delta['bssid'] = bssid
+            self.sentStates[bssid] = state
+            deltas.append(delta)
+        self.dirty.clear()
+        if deltas:
+            return NetworkBatchCmd(deltas)
+        return None
+
+    def resync(self):
+        self.sentStates.clear()
+        self.dirty.update(self.networks)
+
+    def getSnapshot(self):
+        deltas = []
+        for bssid, network in self.networks.iteritems():
+            cmd = NetworkUpdateCmd(network, self.phyHeaders.get(bssid))
+            deltas.append(dict((k, v) for k, v in cmd.getData().iteritems()
+                               if v is not None))
+        if deltas:
+            return NetworkBatchCmd(deltas)
+        return None
+
+    def forgetNetwork(self, bssid):
+        self.phyHeaders.pop(bssid, None)
+        self.sentStates.pop(bssid, None)
+        self.dirty.discard(bssid)
 
 class NetworkDetailMode(OperationMode):
-    def __init__(self, networks, network):
-        super(NetworkDetailMode, self).__init__(networks)
+    ''' Sends the stations of a network. A full snapshot is sent when the
+        mode starts or on resync, then only the stations that sent data
+        frames since the last update, at most once per update_interval '''
+    # Seconds between station updates.
+    update_interval = 1.0
+
+    def __init__(self, networks, linkStatistics, network, changed=None,
+                 changedStations=None):
+        super(NetworkDetailMode, self).__init__(networks, linkStatistics,
+                                                changed, changedStations)
         self.network = network
-        self.justStarted = True
+        self.fullUpdate = True
+        # Stations that changed since the last update.
+        self.dirty = set()
+        self.lastUpdate = 0
+
+    def onDataSeen(self, bssid, src):
+        if bssid == self.network.getBssid():
+            self.dirty.add(src)
+
+    def onTick(self):
+        if self.fullUpdate:
+            self.fullUpdate = False
+            self.dirty.clear()
+            self.lastUpdate = time.time()
+            return NetworkDetailCmd(self.network, self.linkStatistics)
+        if not self.dirty:
+            return None
+        now = time.time()
+        if now - self.lastUpdate < self.update_interval:
+            return None
+        self.lastUpdate = now
+        macs = list(self.dirty)
+        self.dirty.clear()
+        return NetworkDetailCmd(self.network, self.linkStatistics, macs)
+
+    def resync(self):
+        self.fullUpdate = True
+
+    def getSnapshot(self):
+        return NetworkDetailCmd(self.network, self.linkStatistics)
+
+    def keepsNetwork(self, bssid):
+        return bssid == self.network.getBssid()
+
+    def forgetStation(self, bssid, mac):
+        if bssid == self.network.getBssid():
+            self.dirty.discard(mac)
+
+
+class CaptureDispatcher(asyncore.file_dispatcher):
+    ''' Processes captured packets when the capture is readable '''
+    def __init__(self, server, fd, map):
+        asyncore.file_dispatcher.__init__(self, fd, map)
+        self.server = server
+
+    def readable(self):
+        # The next replayed packet may not be due yet.
+        return time.time() >= self.server.captureWait
+
+    def writable(self):
+        return False
 
-    def cmdFromFrame(self, frame, phy_hdr):
-        ret = None
-        if isinstance(frame, dot11.Data):
-            if frame.getBssid() == self.network.getBssid() or self.justStarted:
-                self.justStarted = False
-                ret = NetworkDetailCmd(self.network)
+    def handle_read(self):
+        self.server.processPackets()
 
-        return ret
+
+class ClientDispatcher(asyncore.dispatcher):
+    ''' UI connection, commands are read and updates are sent without
+        blocking, messages are prefixed with their length. Every
+        complete command received is run as soon as it is read, a partial
+        one waits in the buffer for the rest.
+
+        Outgoing messages wait on a bounded queue. When the queue is full
+        the oldest message is dropped, so a slow client only loses
+        updates instead of stalling the capture and the other clients.
+        A client that lost updates gets no more until its queue drains,
+        then it is sent the whole state alone.
+    '''
+    recv_size = 65536
+    max_queued = 256
+    # Commands are small, a bigger length means a broken stream.
+    max_command_size = 1 << 20
+
+    def __init__(self, server, sock, map):
+        asyncore.dispatcher.__init__(self, sock, map)
+        self.server = server
+        self.inBuffer = ''
+        self.encoding = wire.ENCODING_XML
+        self.queue = deque()
+        self.sending = ''
+        self.sendOffset = 0
+        self.dropped = 0
+        # The whole state is sent once the queue drains.
+        self.snapshotPending = True
+
+    def sendMessage(self, message):
+        ''' Queues an already framed message '''
+        if len(self.queue) >= self.max_queued:
+            self.queue.popleft()
+            self.dropped += 1
+            # The dropped message may carry changes the client needs.
+            self.server.onClientOverflow(self)
+        self.queue.append(message)
+
+    def getEncoding(self):
+        return self.encoding
+
+    def setEncoding(self, encoding):
+        self.encoding = encoding
+
+    def getQueueSize(self):
+        return len(self.queue)
+
+    def requestSnapshot(self):
+        self.snapshotPending = True
+
+    def isSnapshotPending(self):
+        return self.snapshotPending
+
+    def isDrained(self):
+        return not self.queue and self.sendOffset >= len(self.sending)
+
+    def sendSnapshot(self, message):
+        ''' Queues the whole state, None if there is nothing to send '''
+        self.snapshotPending = False
+        if message is not None:
+            self.sendMessage(message)
+
+    def getDropped(self):
+        return self.dropped
+
+    def writable(self):
+        return self.sendOffset < len(self.sending) or len(self.queue) > 0
+
+    def handle_write(self):
+        if self.sendOffset >= len(self.sending):
+            # Send every queued message with a single write.
+            self.sending = ''.join(self.queue)
+            self.sendOffset = 0
+            self.queue.clear()
+        registry = metrics.registry
+        if registry.enabled:
+            t0 = time.time()
+            sent = self.send(buffer(self.sending, self.sendOffset))
+            registry.histogram('send').add(time.time() - t0)
+            registry.count('sentBytes', sent)
+        else:
+            sent = self.send(buffer(self.sending, self.sendOffset))
+        self.sendOffset += sent
+
+    def handle_read(self):
+        data = self.recv(self.recv_size)
+        if not data:
+            return
+        data = self.inBuffer + data
+        end = len(data)
+        offset = 0
+        # The buffer is sliced once after all the complete commands.
+        while offset + LENGTH.size <= end:
+            size = LENGTH.unpack_from(data, offset)[0]
+            if size > self.max_command_size:
+                print "Command of %d bytes, closing the connection." % size
+                self.handle_close()
+                return
+            begin = offset + LENGTH.size
+            if end < begin + size:
+                break
+            offset = begin + size
+            self.server.onCommand(data[begin:offset], self)
+        self.inBuffer = data[offset:]
+
+    def handle_close(self):
+        self.close()
+        self.server.onClientClosed(self)
+
+
+class ListenerDispatcher(asyncore.dispatcher):
+    ''' Accepts the UI connection '''
+    def __init__(self, server, port, map):
+        asyncore.dispatcher.__init__(self, map=map)
+        self.server = server
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(('127.0.0.1', port))
+        self.listen(5)
+
+    def writable(self):
+        return False
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        self.server.onClient(pair[0])
 
 
 class Server:
@@ -228,82 +682,724 @@ class Server:
     to_ms   = 1000
     pcap_filter = "ether host 88:88:88:88:88:88"
     ethernet_header_size = 14
-    wlc_phy_header_size = 36
+    # Packets used to guess the PHY header layout.
+    probe_packets = 16
+    # Packets processed before checking the connections again.
+    capture_batch = 64
+    # Seconds to wait for events.
+    poll_timeout = 1.0
+    # Seconds between network update batches.
+    tick_interval = 0.25
+    # Seconds between replay reports.
+    report_interval = 5.0
+    # Seconds between snapshots of the networks.
+    snapshot_interval = 30.0
+    # Networks of a snapshot saved on each tick.
+    snapshot_batch = 200
+    # Seconds the retransmission and fragment state of a transmitter is
+    # kept, retransmissions follow the original frame closely.
+    sequence_ttl = 60.0
 
-    def __init__(self, port):
+    def __init__(self, port, chipset=None, firmware=None,
+                 keepCorrupted=False, captureFile=None, tickInterval=None,
+                 workers=0, replaySpeed=0, hop=False, snapshotFile=None,
+                 snapshotInterval=None, maxNetworks=0, maxStations=0,
+                 ttl=0, spill=False):
         self.port = port
+        self.chipset = chipset
+        self.firmware = firmware
+        # Keep frames with invalid FCS, only useful for debugging.
+        self.keepCorrupted = keepCorrupted
+        # Read packets from a capture file instead of the card.
+        self.captureFile = captureFile
+        # Replay speed of the capture file, 1 is real time and 0 as fast
+        # as possible.
+        self.replaySpeed = replaySpeed
+        self.replayClock = None
+        self.replayStatistics = None
+        self.nextReport = self.report_interval
+        # Wait until this time to read the next packet on replay.
+        self.captureWait = 0
+        self.packetDue = 0
+        # Parse worker processes, 0 runs everything on this process.
+        self.workers = workers
+        self.pipeline = None
+        # Workers still sending events.
+        self.openWorkers = 0
+        # Hop between channels, only when capturing from the card.
+        self.hop = hop and captureFile is None
+        self.hopper = None
+        if tickInterval is not None:
+            self.tick_interval = tickInterval
+        self.nextTick = 0
+        # Frames with invalid FCS per channel.
+        self.corruptedFrames = {}
+        # Frames shorter than any 802.11 frame.
+        self.truncatedFrames = 0
+        self.phyHeaderClass = None
+        self.pendingPackets = []
+        self.pcap = None
+        self.capture = None
+        self.captureDone = False
+        self.capturePending = False
+        # asyncore channels of this server.
+        self.map = {}
+        self.clients = []
         self.networks = {}
-        self.mode = PassiveScanMode(self.networks)
+        # Networks and stations updated since the last tick.
+        self.changed = set()
+        self.changedStations = set()
+        # Networks updated since the last snapshot.
+        self.unsaved = set()
+        # Networks of the current snapshot not queued yet.
+        self.saving = set()
+        # Least recently updated networks and stations are evicted past
+        # the limits or after ttl seconds, 0 disables the bound.
+        self.networkLru = eviction.LruTracker(maxNetworks, ttl)
+        self.stationLru = eviction.LruTracker(maxStations, ttl)
+        # Save the evicted networks on the snapshot.
+        self.spill = spill
+        self.snapshot = None
+        if snapshotFile is not None:
+            self.snapshot = snapshot.SnapshotStore(snapshotFile)
+        if snapshotInterval is not None:
+            self.snapshot_interval = snapshotInterval
+        self.nextSnapshot = 0
+        # Link statistics of the addresses on the air, bound like the
+        # networks and stations.
+        linkLimit = maxNetworks + maxStations if maxNetworks and \
+            maxStations else 0
+        self.linkStatistics = applayer.LinkStatistics(linkLimit, ttl)
+        # Transmitters with sequence state, also kept by the workers.
+        self.sequenceLimit = maxStations
+        self.sequenceTracker = dot11.SequenceTracker(
+            self.linkStatistics, limit=maxStations, ttl=self.sequence_ttl)
+        # Transmitters dropped by the SequenceTracker of the workers.
+        self.sequenceEvicted = 0
+        self.tsfClock = phy.TsfClock()
+        self.mode = PassiveScanMode(self.networks, self.linkStatistics,
+                                    self.changed, self.changedStations)
+        # Frames per type (management, control, data, extension).
+        self.frameTypes = [0, 0, 0, 0]
+        # Frames dropped as retransmissions or waiting fragments.
+        self.sequenceDrops = 0
+        # Packets skipped because processing them failed.
+        self.packetErrors = 0
+        self.sampleCountdown = metrics.SAMPLE_RATE
 
     def setMode(self, mode):
         self.mode = mode
 
+    def startHopping(self):
+        if self.captureFile is not None:
+            return
+        self.hop = True
+        if self.hopper is None:
+            self.hopper = hopping.ChannelHopper()
+        self.hopper.resume(time.time())
+
+    def stopHopping(self):
+        self.hop = False
+        if self.hopper is not None:
+            self.hopper.pause()
+
+    def pauseHopping(self, channel):
+        ''' Stays on the channel of a followed network, hopping goes on
+            if the card can not be moved to it '''
+        if self.hopper is None or not self.hop:
+            return
+        if not channel or not self.hopper.pauseOn(channel):
+            print "Channel %d could not be set, hopping goes on." % channel
+
+    def resumeHopping(self):
+        if self.hop:
+            self.startHopping()
+
+    def hopChannel(self, now):
+        frames = self.frameTypes[dot11.TYPE_MANAGEMENT] + \
+            self.frameTypes[dot11.TYPE_DATA]
+        self.hopper.hop(now, frames, len(self.networks))
+        metrics.registry.count('hops')
+
     def setupConnection(self):
-        s = socket.socket()
-        s.bind(('127.0.0.1', self.port))
-        s.listen(1)
-        self.sock = s.accept()[0]
-        s.close()
+        ListenerDispatcher(self, self.port, self.map)
 
     def setupCard(self):
         if ioctl.get_intvar('mpc'):
             ioctl.set_intvar('mpc', 0)
 
     def setupPcap(self):
-        device = libpcap.pcap_findalldevs()[0]
-        self.pcap = libpcap.pcap_open_live(device, self.snaplen, self.promisc, self.to_ms)
+        if self.captureFile is not None:
+            self.pcap = libpcap.pcap_open_offline(self.captureFile)
+        else:
+            device = libpcap.pcap_findalldevs()[0]
+            self.pcap = libpcap.pcap_open_live(device, self.snaplen, self.promisc, self.to_ms)
+        if not self.pcap:
+            raise Exception("Unable to open the capture.")
         bpf = libpcap.bpf_program()
         libpcap.pcap_compile(self.pcap, self.pcap_filter, bpf)
         libpcap.pcap_setfilter(self.pcap, bpf)
 
-    def getFrame(self):
-        pkt_hdr, pkt_data = libpcap.pcap_next(self.pcap)
-        packet = libpcap.Packet(pkt_hdr, pkt_data)
+    def setupCapture(self):
+        ''' Registers the capture on the event loop '''
+        if self.captureFile is None:
+            libpcap.pcap_setnonblock(self.pcap, 1)
+        fd = libpcap.pcap_get_selectable_fd(self.pcap)
+        self.capture = CaptureDispatcher(self, fd, self.map)
+
+    def setupPhy(self):
+        '''Selects the PHY header decoder from the chipset, the firmware
+           signature or, if neither is known, the first captured packets.'''
+        if self.chipset is not None:
+            try:
+                self.phyHeaderClass = phy.get_phy_header_class(self.chipset)
+            except Exception, e:
+                print "%s Probing the PHY header." % e
+        elif self.firmware is not None:
+            with open(self.firmware, "rb") as f:
+                self.phyHeaderClass = phy.get_firmware_phy_header_class(
+                    f.read())
+            if self.phyHeaderClass is None:
+                print "No supported chipset on the firmware signature. " \
+                      "Probing the PHY header."
+        if self.phyHeaderClass is None:
+            packets = []
+            while len(packets) < self.probe_packets and not self.captureDone:
+                packet = self.readPacket()
+                if packet is not None:
+                    packets.append(packet)
+            self.phyHeaderClass = phy.probe_phy_header_class(
+                [p.getData() for p in packets], self.ethernet_header_size)
+            # Probed packets are processed as usual.
+            self.pendingPackets = packets
+        print "PHY header: %s" % self.phyHeaderClass.CHIPSET
+
+    def readPacket(self):
+        ''' Returns the next packet or None if there is none available,
+            on replay also if the next packet is not due yet '''
+        if self.pendingPackets:
+            packet = self.pendingPackets.pop(0)
+        else:
+            packet = self.readCapturedPacket()
+        if packet is not None and self.replayClock is not None:
+            due = self.replayClock.getDue(packet.getTimestamp())
+            if due > time.time():
+                self.pendingPackets.insert(0, packet)
+                self.captureWait = due
+                return None
+            self.packetDue = due
+        return packet
+
+    def readCapturedPacket(self):
+        result, pkt_hdr, pkt_data = libpcap.pcap_next_ex(self.pcap)
+        if result == libpcap.PCAP_NEXT_OK:
+            return libpcap.Packet(pkt_hdr, pkt_data)
+        if result == libpcap.PCAP_NEXT_EOF:
+            self.captureDone = True
+        elif result == libpcap.PCAP_NEXT_ERROR:
+            raise Exception("Capture error.")
+        return None
+
+    def getPhyFrame(self, packet):
+        ''' Returns the PHY header and the 802.11 frame of the packet,
+            the frame is None if it must be dropped '''
         raw_packet = packet.getData()
-        frame_index = self.ethernet_header_size + self.wlc_phy_header_size
+        phy_header_class = self.phyHeaderClass
+        frame_index = self.ethernet_header_size + phy_header_class.SIZE
         if len(raw_packet) < frame_index:
             return None, None
 
-        raw_phy_header = raw_packet[self.ethernet_header_size:frame_index]
-        phy_hdr = phy.Bcm4329PhyHeader(raw_phy_header)
-        raw_frame = raw_packet[frame_index:]
+        phy_hdr = phy_header_class(raw_packet, self.ethernet_header_size)
+        if not phy_hdr.hasValidFCS():
+            channel = phy_hdr.getChannel()
+            self.corruptedFrames[channel] = \
+                self.corruptedFrames.get(channel, 0) + 1
+            if not self.keepCorrupted:
+                return phy_hdr, None
+        if len(raw_packet) - frame_index < dot11.DOT11_MIN_FRAME_SIZE:
+            self.truncatedFrames += 1
+            return phy_hdr, None
+        phy_hdr.setTimestamp(self.tsfClock.update(phy_hdr.getTsf(),
+                                                  packet.getTimestamp()))
+        return phy_hdr, raw_packet[frame_index:]
 
+    def getFrame(self, packet):
+        phy_hdr, raw_frame = self.getPhyFrame(packet)
+        if not raw_frame is None:
+            # Drop retransmissions and join fragments before parsing.
+            raw_frame = self.sequenceTracker.process(raw_frame)
+            if raw_frame is None:
+                self.sequenceDrops += 1
         return phy_hdr, raw_frame
 
-    def processCommands(self):
-        socks = [self.sock]
-        cmdPending = len(select.select(socks, [], [], 0)[0]) > 0
+    def processPacket(self, packet):
+        phy_hdr, raw_frame = self.getFrame(packet)
+        if not raw_frame is None:
+            self.frameTypes[(ord(raw_frame[0]) >> 2) & 0x03] += 1
+            self.mode.onFrame(phy_hdr, raw_frame)
 
-        if cmdPending:
-            cmd = ClientCommand.fromStream(self.sock, self)
+    def processSampledPacket(self):
+        ''' Same as readPacket and processPacket, timing every stage '''
+        t0 = time.time()
+        packet = self.readPacket()
+        if packet is None:
+            return None
+        try:
+            self.processTimedPacket(packet, t0)
+        except Exception, e:
+            self.onPacketError(e)
+        return packet
+
+    def processTimedPacket(self, packet, t0):
+        histogram = metrics.registry.histogram
+        t1 = time.time()
+        histogram('capture').add(t1 - t0)
+        phy_hdr, raw_frame = self.getPhyFrame(packet)
+        t2 = time.time()
+        histogram('phy').add(t2 - t1)
+        if raw_frame is None:
+            return
+        raw_frame = self.sequenceTracker.process(raw_frame)
+        t3 = time.time()
+        histogram('sequence').add(t3 - t2)
+        if raw_frame is None:
+            self.sequenceDrops += 1
+            return
+        self.frameTypes[(ord(raw_frame[0]) >> 2) & 0x03] += 1
+        try:
+            event = self.mode.parseFrame(phy_hdr, raw_frame)
+            t4 = time.time()
+            histogram('parse').add(t4 - t3)
+            if event is not None:
+                handler, args = event
+                handler(*args)
+                t5 = time.time()
+                histogram('mode').add(t5 - t4)
+        except Exception, e:
+            print repr(e)
+        histogram('frame').add(time.time() - t0)
+
+    def onPacketError(self, e):
+        ''' A packet that could not be processed is counted and skipped,
+            the capture goes on '''
+        self.packetErrors += 1
+        print repr(e)
+
+    def processPackets(self):
+        ''' Processes up to capture_batch packets, one of every
+            metrics.SAMPLE_RATE is timed when metrics are enabled '''
+        registry = metrics.registry
+        for i in xrange(self.capture_batch):
+            self.sampleCountdown -= 1
+            if self.sampleCountdown <= 0 and registry.enabled:
+                self.sampleCountdown = metrics.SAMPLE_RATE
+                packet = self.processSampledPacket()
+            else:
+                packet = self.readPacket()
+                if packet is not None:
+                    try:
+                        self.processPacket(packet)
+                    except Exception, e:
+                        self.onPacketError(e)
+            if packet is None:
+                self.capturePending = False
+                if self.captureDone:
+                    self.capture.close()
+                    self.onCaptureEnd()
+                return
+            if self.replayStatistics is not None:
+                self.replayStatistics.addFrame(time.time() - self.packetDue)
+        # pcap may have more packets buffered than the fd shows.
+        self.capturePending = True
+
+    def onEvents(self, events):
+        ''' Applies the events of a pipeline worker '''
+        mode = self.mode
+        if self.replayStatistics is not None:
+            for event in events:
+                if event[0] not in (pipeline.EVENT_SEQUENCE,
+                                    pipeline.EVENT_EVICTED):
+                    self.replayStatistics.addFrame()
+        for event in events:
+            try:
+                kind = event[0]
+                if kind == pipeline.EVENT_SEQUENCE:
+                    self.linkStatistics.addSequencedFrame(*event[1:])
+                elif kind == pipeline.EVENT_CONTROL:
+                    self.frameTypes[dot11.TYPE_CONTROL] += 1
+                    mode.onControlFrame(*event[1:])
+                elif kind == pipeline.EVENT_EVICTED:
+                    self.sequenceEvicted += event[1]
+                else:
+                    phy_hdr = self.phyHeaderClass(event[1])
+                    phy_hdr.setTimestamp(event[2])
+                    if kind == pipeline.EVENT_BEACON:
+                        self.frameTypes[dot11.TYPE_MANAGEMENT] += 1
+                        mode.onBeacon(event[3], event[4], event[5], phy_hdr)
+                    else:
+                        self.frameTypes[dot11.TYPE_DATA] += 1
+                        mode.onDataFrame(event[3], event[4], event[5], phy_hdr)
+            except Exception, e:
+                print repr(e)
+
+    def sendCommand(self, cmd):
+        if self.replayStatistics is not None:
+            self.replayStatistics.addMessage()
+        if not self.clients:
+            return
+        # Serialized once per encoding and shared by every client.
+        messages = {}
+        queued = False
+        for client in self.clients:
+            if client.isSnapshotPending():
+                # The snapshot will carry these changes.
+                continue
+            encoding = client.getEncoding()
+            message = messages.get(encoding)
+            if message is None:
+                message = messages[encoding] = self.serialize(cmd, encoding)
+                if message is None:
+                    return
+            client.sendMessage(message)
+            queued = True
+        if queued:
+            metrics.registry.count('messages')
+
+    def sendCommandTo(self, cmd, client):
+        message = self.serialize(cmd, client.getEncoding())
+        if message is not None:
+            client.sendMessage(message)
+            metrics.registry.count('messages')
+
+    def serialize(self, cmd, encoding):
+        ''' Returns the framed message of the command, None on error '''
+        registry = metrics.registry
+        t0 = time.time()
+        try:
+            data = cmd.getSerialized(encoding)
+        except Exception, e:
+            print e
+            return None
+        if registry.enabled:
+            registry.histogram('serialize').add(time.time() - t0)
+        return LENGTH.pack(len(data)) + data
+
+    def getMetrics(self):
+        ''' Returns the metrics snapshot with the server counters and
+            queue depths '''
+        snapshot = metrics.registry.getSnapshot()
+        uptime = snapshot['uptime']
+        frames = dict(zip(('management', 'control', 'data', 'extension'),
+                          self.frameTypes))
+        snapshot['frames'] = frames
+        snapshot['frameRates'] = dict((k, v / uptime)
+                                      for k, v in frames.iteritems())
+        drops = {'sequence': self.sequenceDrops,
+                 'errors': self.packetErrors,
+                 'corrupted': sum(self.corruptedFrames.itervalues()),
+                 'truncated': self.truncatedFrames,
+                 'clientQueues': sum(c.getDropped() for c in self.clients)}
+        if self.pcap and self.captureFile is None and not self.pipeline:
+            stats = libpcap.pcap_stats(self.pcap)
+            if stats is not None:
+                drops['pcap'] = stats[1]
+                drops['interface'] = stats[2]
+        snapshot['drops'] = drops
+        snapshot['corruptedPerChannel'] = dict(
+            (str(k), v) for k, v in self.corruptedFrames.iteritems())
+        snapshot['queues'] = {
+            'pendingPackets': len(self.pendingPackets),
+            'clients': [c.getQueueSize() for c in self.clients]}
+        snapshot['networks'] = len(self.networks)
+        snapshot['stations'] = len(self.stationLru)
+        snapshot['evicted'] = {
+            'networks': self.networkLru.evicted,
+            'stations': self.stationLru.evicted,
+            'sequences': self.sequenceTracker.getEvicted() +
+                         self.sequenceEvicted,
+            'linkStatistics': self.linkStatistics.getEvicted()}
+        snapshot['ieCache'] = dot11.ie_cache.getStatistics()
+        if self.snapshot is not None:
+            snapshot['snapshot'] = self.snapshot.getStatistics()
+        if self.hopper is not None:
+            snapshot['hopping'] = {
+                'channel': self.hopper.getCurrentChannel(),
+                'hops': self.hopper.hops,
+                'failures': self.hopper.failures,
+                'activity': dict((str(c), a) for c, a in
+                                 self.hopper.activity.iteritems()
+                                 if a is not None)}
+        return snapshot
+
+    def onCommand(self, rawCmd, client=None):
+        try:
+            cmd = ClientCommand.fromString(rawCmd, self, client)
             cmd.action()
+        except Exception, e:
+            print repr(e)
+
+    def onClient(self, sock):
+        # New clients start with a snapshot of their own.
+        self.clients.append(ClientDispatcher(self, sock, self.map))
+
+    def onClientOverflow(self, client):
+        client.requestSnapshot()
+
+    def sendSnapshots(self):
+        ''' Sends the whole state to the clients that asked for it and
+            already sent everything queued, serialized for each one '''
+        for client in self.clients:
+            if not client.isSnapshotPending() or not client.isDrained():
+                continue
+            cmd = self.mode.getSnapshot()
+            if cmd is None:
+                client.sendSnapshot(None)
+                continue
+            message = self.serialize(cmd, client.getEncoding())
+            if message is not None:
+                client.sendSnapshot(message)
+                metrics.registry.count('messages')
+
+    def onTick(self):
+        registry = metrics.registry
+        t0 = time.time()
+        self.expireState(t0)
+        cmd = self.mode.onTick()
+        if not cmd is None:
+            self.sendCommand(cmd)
+        self.sendSnapshots()
+        if self.saving:
+            self.saveNetworks(self.snapshot_batch)
+        if registry.enabled:
+            registry.histogram('tick').add(time.time() - t0)
+        if self.replayStatistics is not None and \
+           not self.replayStatistics.isStopped() and \
+           self.replayStatistics.getElapsed() >= self.nextReport:
+            self.nextReport += self.report_interval
+            self.reportReplay()
+
+    def reportReplay(self):
+        print "Replay: %s" % self.replayStatistics
+
+    def finishReplay(self):
+        ''' Stops the replay statistics and prints the final report, the
+            UI is still served after the end of the capture '''
+        if not self.replayStatistics.isStopped():
+            self.replayStatistics.stop()
+            self.reportReplay()
+
+    def onCaptureEnd(self):
+        print "End of capture."
+        if self.replayStatistics is not None:
+            self.finishReplay()
+
+    def onWorkerClosed(self):
+        ''' The workers close their pipe once the capture ended '''
+        self.openWorkers -= 1
+        if self.openWorkers == 0:
+            self.onCaptureEnd()
+
+    def restoreSnapshot(self):
+        t0 = time.time()
+        restored = self.snapshot.load(self.networkLru.limit,
+                                      self.stationLru.limit)
+        self.networks.update(restored)
+        stations = sum(len(n.getStations()) for n in restored.itervalues())
+        print "Restored %d networks and %d stations in %.0f ms." % \
+            (len(restored), stations, (time.time() - t0) * 1000)
+        # Restored least recently seen first, so the eviction order is the
+        # one saved. The ones past the limits are already on the snapshot.
+        for bssid, network in restored.iteritems():
+            seen = network.getLastSeen()
+            self.networkLru.touch(bssid, seen)
+            for mac in network.getStations():
+                self.stationLru.touch((bssid, mac), seen)
+        self.expireState(t0, False)
+        self.mode.resync()
+
+    def saveSnapshot(self):
+        ''' Starts a snapshot of the networks updated since the last one,
+            they are queued a batch on each tick '''
+        self.touchState(time.time())
+        self.saving.update(self.unsaved)
+        self.unsaved.clear()
+
+    def saveNetworks(self, limit):
+        ''' Queues up to limit networks of the current snapshot, their
+            states are written by the snapshot thread '''
+        networks = self.networks
+        saving = self.saving
+        batch = []
+        while saving and len(batch) < limit:
+            network = networks.get(saving.pop())
+            if network is not None:
+                batch.append(network)
+        self.snapshot.save(batch)
+
+    def touchState(self, now):
+        ''' Moves the networks and stations updated since the last call
+            to the end of the eviction order '''
+        touch = self.networkLru.touch
+        networks = self.networks
+        for bssid in self.changed:
+            touch(bssid, now)
+            network = networks.get(bssid)
+            if network is not None:
+                network.setLastSeen(now)
+        touch = self.stationLru.touch
+        for key in self.changedStations:
+            touch(key, now)
+        if self.snapshot is not None:
+            self.unsaved.update(self.changed)
+        self.changed.clear()
+        self.changedStations.clear()
+
+    def expireState(self, now, spill=True):
+        ''' Evicts the least recently updated networks and stations past
+            the limits or the ttl, with their per network state '''
+        self.touchState(now)
+        networks = self.networks
+        linkStatistics = self.linkStatistics
+        mode = self.mode
+        spilled = []
+        for bssid in self.networkLru.expire(now, mode.keepsNetwork):
+            network = networks.pop(bssid, None)
+            if network is None:
+                continue
+            for mac in network.getStations():
+                self.stationLru.discard((bssid, mac))
+                linkStatistics.forget(mac)
+            linkStatistics.forget(bssid)
+            mode.forgetNetwork(bssid)
+            self.unsaved.discard(bssid)
+            self.saving.discard(bssid)
+            spilled.append(network)
+        for bssid, mac in self.stationLru.expire(now):
+            network = networks.get(bssid)
+            if network is not None:
+                network.removeStation(mac)
+            linkStatistics.forget(mac)
+            mode.forgetStation(bssid, mac)
+        linkStatistics.expire(now)
+        self.sequenceTracker.expire(now)
+        if spill and self.spill and self.snapshot is not None and spilled:
+            self.snapshot.save(spilled)
+
+    def onClientClosed(self, client):
+        if client in self.clients:
+            self.clients.remove(client)
 
     def _run(self):
+        if self.snapshot is not None:
+            self.restoreSnapshot()
         self.setupConnection()
-        self.setupCard()
+        if self.captureFile is None:
+            self.setupCard()
         self.setupPcap()
+        self.setupPhy()
+        if self.captureFile is not None:
+            self.replayClock = replay.ReplayClock(self.replaySpeed)
+            self.replayStatistics = replay.ReplayStatistics()
+        if self.workers:
+            self.pipeline = pipeline.Pipeline(self, self.workers)
+            self.openWorkers = self.workers
+            self.pipeline.start()
+        else:
+            self.setupCapture()
+        if self.hop:
+            self.startHopping()
 
-        while True:
-            self.processCommands()
-            phy_hdr, raw_frame = self.getFrame()
-            if not raw_frame is None:
-                cmd = self.mode.onFrame(phy_hdr, raw_frame)
-                if not cmd is None:
-                    try:
-                        cmd_str = cmd.getSerialized()
-                        self.sock.send(struct.pack("<L", len(cmd_str)) + cmd_str)
-                    except Exception, e:
-                        print e
+        while self.map:
+            now = time.time()
+            if now >= self.nextTick:
+                self.onTick()
+                self.nextTick = now + self.tick_interval
+            if self.snapshot is not None and now >= self.nextSnapshot:
+                if self.nextSnapshot:
+                    self.saveSnapshot()
+                self.nextSnapshot = now + self.snapshot_interval
+            timeout = min(self.poll_timeout, self.nextTick - now)
+            nextHop = self.hopper and self.hopper.getNextHop()
+            if nextHop is not None:
+                if now >= nextHop:
+                    self.hopChannel(now)
+                    nextHop = self.hopper.getNextHop()
+                timeout = min(timeout, nextHop - now)
+            if self.captureWait > now:
+                timeout = min(timeout, self.captureWait - now)
+            if self.capturePending:
+                timeout = 0
+            asyncore.loop(timeout, False, self.map, 1)
+            if self.capturePending:
+                self.processPackets()
 
     def run(self):
         try:
             self._run()
         finally:
-            if hasattr(self, 'sock'):
-                self.sock.close()
+            if self.replayStatistics is not None:
+                self.finishReplay()
+            if self.pipeline:
+                self.pipeline.stop()
+            if self.snapshot is not None:
+                self.saveSnapshot()
+                self.saveNetworks(len(self.saving))
+                self.snapshot.close()
+            asyncore.close_all(self.map)
+            if self.pcap:
+                libpcap.pcap_close(self.pcap)
 
 
 if __name__ == "__main__":
-    s = Server(61000)
+    parser = optparse.OptionParser()
+    parser.add_option("-p", "--port", type="int", default=61000,
+                      help="UI port [default: %default]")
+    parser.add_option("-c", "--chipset",
+                      help="chipset PHY header layout (bcm4325, bcm4329, "
+                           "bcm4330), probed if not given")
+    parser.add_option("-f", "--firmware",
+                      help="read the chipset from the firmware signature")
+    parser.add_option("-r", "--read", dest="captureFile",
+                      help="read packets from a raw capture file")
+    parser.add_option("-s", "--speed", type="float", default=0,
+                      help="replay speed of the capture file, 1 is real "
+                           "time and 0 as fast as possible [default: %default]")
+    parser.add_option("-t", "--tick", type="int", default=250,
+                      help="milliseconds between network updates "
+                           "[default: %default]")
+    parser.add_option("-w", "--workers", type="int", default=0,
+                      help="parse frames on WORKERS processes, sharded "
+                           "by BSSID [default: %default]")
+    parser.add_option("-m", "--metrics", action="store_true", default=False,
+                      help="collect runtime metrics, sent to the UI on "
+                           "request")
+    parser.add_option("--hop", action="store_true", default=False,
+                      help="hop between channels, staying longer on the "
+                           "busy ones")
+    parser.add_option("-S", "--snapshot", dest="snapshotFile",
+                      help="restore the networks from SNAPSHOTFILE and "
+                           "save them periodically")
+    parser.add_option("--snapshot-interval", type="float", default=30,
+                      help="seconds between snapshots [default: %default]")
+    parser.add_option("--max-networks", type="int", default=10000,
+                      help="networks kept, the least recently seen are "
+                           "evicted, 0 for no limit [default: %default]")
+    parser.add_option("--max-stations", type="int", default=50000,
+                      help="stations kept, the least recently seen are "
+                           "evicted, 0 for no limit [default: %default]")
+    parser.add_option("--ttl", type="float", default=0,
+                      help="seconds a network or station is kept after "
+                           "it was last seen, 0 forever [default: %default]")
+    parser.add_option("--spill", action="store_true", default=False,
+                      help="save the evicted networks on the snapshot")
+    parser.add_option("--keep-corrupted", action="store_true",
+                      default=False, help="process frames with invalid FCS")
+    options, args = parser.parse_args()
+    metrics.registry.enable(options.metrics)
+    s = Server(options.port, options.chipset, options.firmware,
+               options.keepCorrupted, options.captureFile,
+               options.tick / 1000.0, options.workers, options.speed,
+               options.hop, options.snapshotFile, options.snapshotInterval,
+               options.max_networks, options.max_stations, options.ttl,
+               options.spill)
     s.run()
-
@@ -0,0 +1,317 @@
+#/usr/bin/env python
+
+# Copyright (c) 2012, Andres Blanco and Matias Eissler
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. All advertising materials mentioning features or use of this software
+#    must display the following acknowledgement:
+#    This product includes software developed by the authors.
+# 4. Neither the name of the authors nor the
+#    names of its contributors may be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import gc
+import os
+import marshal
+import struct
+import threading
+import Queue
+from collections import OrderedDict
+from operator import itemgetter
+
+import applayer
+
+# File header: magic and format version.
+MAGIC = 'MONMOBSS'
+VERSION = 2
+HEADER = struct.Struct('<8sH')
+# Record header: kind and payload length. The payload is a marshaled
+# tuple of Network states.
+RECORD = struct.Struct('<BI')
+RECORD_FULL = 0
+RECORD_DELTA = 1
+# The deltas are merged into one full record when they take more than
+# this fraction of the file.
+COMPACT_RATIO = 0.5
+# Do not compact files smaller than this.
+COMPACT_MIN_SIZE = 64 * 1024
+
+
+def read_records(path):
+    '''Returns a dictionary of Network states by BSSID read from the
+       snapshot at path, later records replace the earlier states of a
+       network, and the offset where the valid records end. A record cut
+       by a crash ends the file.'''
+    states = {}
+    if not os.path.exists(path):
+        return states, 0
+    f = open(path, 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    if len(data) < HEADER.size:
+        return states, 0
+    magic, version = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("%s is not a snapshot of version %d." %
+                         (path, VERSION))
+    offset = HEADER.size
+    while offset + RECORD.size <= len(data):
+        kind, length = RECORD.unpack_from(data, offset)
+        end = offset + RECORD.size + length
+        if end > len(data):
+            break
+        try:
+            records = marshal.loads(data[offset + RECORD.size:end])
+        except (ValueError, EOFError, TypeError):
+            break
+        offset = end
+        if kind == RECORD_FULL:
+            states.clear()
+        for state in records:
+            states[state[0]] = state
+    return states, offset
+
+
+def read_states(path):
+    '''Returns a dictionary of Network states by BSSID read from the
+       snapshot at path.'''
+    return read_records(path)[0]
+
+
+def write_record(f, kind, states):
+    payload = marshal.dumps(tuple(states), 2)
+    f.write(RECORD.pack(kind, len(payload)))
+    f.write(payload)
+    return RECORD.size + len(payload)
+
+
+class SnapshotStore(object):
+    '''Networks and Stations saved to a file by a writer thread.
+
+       The file is a full record followed by delta records with the
+       Networks that changed since the previous one, so a save only costs
+       the changed Networks. The writer merges the deltas into a new full
+       record when they grow past COMPACT_RATIO of the file, reading the
+       file instead of keeping a copy of the state in memory.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.fullSize = 0
+        self.deltaSize = 0
+        self.saved = 0
+        self.errors = 0
+
+    def load(self, maxNetworks=0, maxStations=0):
+        '''Returns an OrderedDict of the Networks saved by BSSID, the least
+           recently seen first. Only the most recently seen Networks that
+           fit in maxNetworks and maxStations are built, 0 for no limit.'''
+        # Nothing restored is garbage, the collector would only walk the
+        # growing heap again and again.
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            states, end = read_records(self.path)
+            kept = []
+            stations = 0
+            for state in sorted(states.itervalues(), reverse=True,
+                                key=itemgetter(
+                                    applayer.Network.STATE_LAST_SEEN)):
+                if maxNetworks and len(kept) >= maxNetworks or \
+                   maxStations and stations >= maxStations:
+                    break
+                kept.append(state)
+                stations += len(state[applayer.Network.STATE_STATIONS])
+            kept.reverse()
+            from_state = applayer.Network.fromState
+            networks = OrderedDict((state[0], from_state(state))
+                                   for state in kept)
+        finally:
+            if enabled:
+                gc.enable()
+        if os.path.exists(self.path):
+            # Records appended after a torn one would never be read.
+            if end < HEADER.size:
+                os.remove(self.path)
+            elif end < os.path.getsize(self.path):
+                f = open(self.path, 'r+b')
+                try:
+                    f.truncate(end)
+                finally:
+                    f.close()
+            # The size of the full record is unknown, the first save
+            # after a restore compacts the file if it is big enough.
+            self.deltaSize = end
+        return networks
+
+    def save(self, networks):
+        '''Queues the states of networks for the writer, must be called
+           from the thread that updates them.'''
+        states = [network.getState() for network in networks]
+        if not states:
+            return
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.writer,
+                                           name="snapshot")
+            self.thread.daemon = True
+            self.thread.start()
+        self.queue.put(states)
+
+    def close(self):
+        '''Waits until everything queued is written.'''
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def writer(self):
+        while True:
+            states = self.queue.get()
+            if states is None:
+                return
+            try:
+                self.append(states)
+                if self.deltaSize > COMPACT_MIN_SIZE and \
+                   self.deltaSize > COMPACT_RATIO * (self.fullSize +
+                                                     self.deltaSize):
+                    self.compact()
+                self.saved += len(states)
+            except (IOError, OSError, ValueError), e:
+                self.errors += 1
+                print "Snapshot not saved: %s" % e
+
+    def append(self, states):
+        new = not os.path.exists(self.path)
+        f = open(self.path, 'ab')
+        try:
+            if new:
+                f.write(HEADER.pack(MAGIC, VERSION))
+                self.fullSize = HEADER.size
+                self.deltaSize = 0
+            self.deltaSize += write_record(f, RECORD_DELTA, states)
+        finally:
+            f.close()
+
+    def compact(self):
+        '''Rewrites the file as a single full record, the file is
+           replaced atomically so a crash keeps the old one.'''
+        states = read_states(self.path)
+        temp = self.path + '.tmp'
+        f = open(temp, 'wb')
+        try:
+            f.write(HEADER.pack(MAGIC, VERSION))
+            size = HEADER.size + write_record(f, RECORD_FULL,
+                                              states.itervalues())
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(temp, self.path)
+        self.fullSize = size
+        self.deltaSize = 0
+
+    def getStatistics(self):
+        return {'saved': self.saved,
+                'errors': self.errors,
+                'size': self.fullSize + self.deltaSize}
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    import tempfile
+
+    def make_network(n, stations):
+        network = applayer.Network.fromState(
+            ('00:11:22:%02x:%02x:%02x' % (n >> 16, (n >> 8) & 0xff, n & 0xff),
+             'net%d' % n, False, 'WPA2', 'Unknown', n % 14 + 1, n,
+             applayer.RssiStatistics().getState(), 0, 0, (), n))
+        for i in xrange(stations):
+            station = applayer.Station('02:00:%02x:%02x:%02x:%02x' %
+                                       (n >> 8, n & 0xff, i >> 8, i & 0xff))
+            for rssi in (-40, -45, -50, -55, -60, -65):
+                station.updateRssi(rssi)
+            network.addStation(station)
+            network.updateRssi(-50 - i % 20)
+        return network
+
+    stations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    networks = dict((net.getBssid(), net) for net in
+                    (make_network(n, 10) for n in xrange(stations / 10)))
+    path = os.path.join(tempfile.mkdtemp(), 'snapshot')
+    store = SnapshotStore(path)
+    start = time.time()
+    store.save(networks.itervalues())
+    queued = time.time() - start
+    # Deltas with a tenth of the networks changed.
+    changed = networks.values()[::10]
+    for network in changed:
+        network.incrementDataFrameStatistics()
+    store.save(changed)
+    store.close()
+    start = time.time()
+    restored = SnapshotStore(path).load()
+    loaded = time.time() - start
+    if sorted(restored) != sorted(networks):
+        print "Error: restored networks differ."
+    # Past the limits only the most recently seen networks are built, the
+    # least recently seen first.
+    newest = sorted(networks.itervalues(), key=lambda n: n.getLastSeen())
+    if SnapshotStore(path).load(5).keys() != \
+       [n.getBssid() for n in newest[-5:]]:
+        print "Error: restored networks not the most recently seen."
+    if len(SnapshotStore(path).load(0, 25)) != 3:
+        print "Error: restored stations past the limit."
+    for bssid, network in networks.iteritems():
+        if restored[bssid].getState() != network.getState():
+            print "Error: %s restored incorrectly." % bssid
+            break
+    # A record cut by a crash is ignored.
+    f = open(path, 'ab')
+    f.write(RECORD.pack(RECORD_DELTA, 1000) + 'x' * 10)
+    f.close()
+    if len(read_states(path)) != len(networks):
+        print "Error: truncated record not ignored."
+    # The torn record is dropped on load, a network saved after it is
+    # restored.
+    store = SnapshotStore(path)
+    store.load()
+    added = make_network(len(networks), 1)
+    store.save([added])
+    store.close()
+    restored = SnapshotStore(path).load()
+    if added.getBssid() not in restored or \
+       restored[added.getBssid()].getState() != added.getState():
+        print "Error: network saved after a torn record not restored."
+    networks[added.getBssid()] = added
+    # Compaction keeps the last state of every network.
+    store = SnapshotStore(path)
+    store.load()
+    store.save(changed)
+    store.close()
+    if len(read_states(path)) != len(networks):
+        print "Error: compaction lost networks."
+    print "%d stations: %.0f ms to queue, %.0f ms to restore, %d bytes." % \
+        (stations, queued * 1000, loaded * 1000, os.path.getsize(path))
+    os.remove(path)
@@ -0,0 +1,361 @@
+#/usr/bin/env python
+
+# Copyright (c) 2012, Andres Blanco and Matias Eissler
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. All advertising materials mentioning features or use of this software
+#    must display the following acknowledgement:
+#    This product includes software developed by the authors.
+# 4. Neither the name of the authors nor the
+#    names of its contributors may be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import struct
+import plistlib
+
+# Encodings of the messages exchanged with the UI. Every message is
+# prefixed with its length (4 bytes, little endian) whatever the encoding.
+ENCODING_XML = "xml"
+ENCODING_BINARY = "binary"
+
+# Binary property list (bplist00), the compact tagged format that
+# NSPropertyListSerialization reads natively, so the UI decodes it with
+# the same call it uses for XML plists.
+BINARY_MAGIC = "bplist00"
+
+MARKER_FALSE = 0x08
+MARKER_TRUE = 0x09
+MARKER_INT = 0x10
+MARKER_REAL = 0x20
+MARKER_DATA = 0x40
+MARKER_ASCII = 0x50
+MARKER_UNICODE = 0x60
+MARKER_ARRAY = 0xA0
+MARKER_DICT = 0xD0
+
+binary_trailer = struct.Struct(">6xBBQQQ")
+double = struct.Struct(">d")
+int_formats = ((0xFF, ">B", 0), (0xFFFF, ">H", 1), (0xFFFFFFFF, ">L", 2))
+offset_formats = {1: ">%dB", 2: ">%dH", 4: ">%dL", 8: ">%dQ"}
+
+# Keys, vendors and security names repeat on every message, their
+# encoding is kept here until the cache fills up.
+STRING_CACHE_SIZE = 4096
+string_cache = {}
+
+
+def _encode_int(value):
+    if value >= 0:
+        for limit, fmt, size in int_formats:
+            if value <= limit:
+                return chr(MARKER_INT | size) + struct.pack(fmt, value)
+    return chr(MARKER_INT | 3) + struct.pack(">q", value)
+
+
+def _encode_header(marker, count):
+    if count < 0x0F:
+        return chr(marker | count)
+    return chr(marker | 0x0F) + _encode_int(count)
+
+
+def _ref_size(count):
+    if count <= 0xFF:
+        return 1
+    if count <= 0xFFFF:
+        return 2
+    return 4
+
+
+def _encode_string(value):
+    if isinstance(value, str):
+        try:
+            value.decode("ascii")
+            return _encode_header(MARKER_ASCII, len(value)) + value
+        except UnicodeDecodeError:
+            value = value.decode("utf-8")
+    try:
+        data = value.encode("ascii")
+        return _encode_header(MARKER_ASCII, len(data)) + data
+    except UnicodeEncodeError:
+        data = value.encode("utf-16be")
+        return _encode_header(MARKER_UNICODE, len(data) / 2) + data
+
+
+def _encode_scalar(value):
+    if isinstance(value, bool):
+        if value:
+            return chr(MARKER_TRUE)
+        return chr(MARKER_FALSE)
+    if isinstance(value, (int, long)):
+        return _encode_int(value)
+    if isinstance(value, float):
+        return chr(MARKER_REAL | 3) + double.pack(value)
+    if isinstance(value, plistlib.Data):
+        return _encode_header(MARKER_DATA, len(value.data)) + value.data
+    raise TypeError("unsuported type: %s" % type(value))
+
+
+class _BinaryPlistWriter(object):
+    '''Flattens an object in the bplist00 object table. Scalars are
+       encoded right away, containers once the reference size is known.
+       Strings are written once and shared by every reference.'''
+    def __init__(self):
+        self.objects = []
+        self.strings = {}
+
+    def flatten(self, value):
+        objects = self.objects
+        if isinstance(value, basestring):
+            ref = self.strings.get(value)
+            if ref is None:
+                ref = self.strings[value] = len(objects)
+                data = string_cache.get(value)
+                if data is None:
+                    if len(string_cache) >= STRING_CACHE_SIZE:
+                        string_cache.clear()
+                    data = string_cache[value] = _encode_string(value)
+                objects.append(data)
+            return ref
+        ref = len(objects)
+        if isinstance(value, dict):
+            objects.append(None)
+            items = value.items()
+            refs = [self.flatten(k) for k, v in items]
+            refs.extend([self.flatten(v) for k, v in items])
+            objects[ref] = (MARKER_DICT, len(items), refs)
+        elif isinstance(value, (list, tuple)):
+            objects.append(None)
+            refs = [self.flatten(v) for v in value]
+            objects[ref] = (MARKER_ARRAY, len(refs), refs)
+        else:
+            objects.append(_encode_scalar(value))
+        return ref
+
+    def write(self, value):
+        top = self.flatten(value)
+        ref_size = _ref_size(len(self.objects))
+        ref_format = offset_formats[ref_size]
+        chunks = [BINARY_MAGIC]
+        offsets = []
+        position = len(BINARY_MAGIC)
+        for obj in self.objects:
+            if isinstance(obj, tuple):
+                marker, count, refs = obj
+                data = _encode_header(marker, count) + \
+                    struct.pack(ref_format % len(refs), *refs)
+            else:
+                data = obj
+            offsets.append(position)
+            chunks.append(data)
+            position += len(data)
+        offset_size = _ref_size(position)
+        chunks.append(struct.pack(offset_formats[offset_size] % len(offsets),
+                                  *offsets))
+        chunks.append(binary_trailer.pack(offset_size, ref_size,
+                                          len(self.objects), top, position))
+        return ''.join(chunks)
+
+
+def encode_binary(value):
+    '''Returns value as a binary property list.'''
+    return _BinaryPlistWriter().write(value)
+
+
+def decode_binary(data):
+    '''Returns the object stored in a binary property list.'''
+    if not data.startswith(BINARY_MAGIC):
+        raise ValueError("Not a binary property list.")
+    offset_size, ref_size, count, top, table = \
+        binary_trailer.unpack_from(data, len(data) - binary_trailer.size)
+    offsets = struct.unpack_from(offset_formats[offset_size] % count,
+                                 data, table)
+    ref_format = offset_formats[ref_size]
+
+    def read_count(info, position):
+        if info != 0x0F:
+            return info, position
+        size = 1 << (ord(data[position]) & 0x0F)
+        value = int(data[position + 1:position + 1 + size].encode("hex"), 16)
+        return value, position + 1 + size
+
+    def read(ref):
+        position = offsets[ref]
+        marker = ord(data[position])
+        kind = marker & 0xF0
+        info = marker & 0x0F
+        position += 1
+        if marker == MARKER_FALSE:
+            return False
+        if marker == MARKER_TRUE:
+            return True
+        if kind == MARKER_INT:
+            size = 1 << info
+            value = int(data[position:position + size].encode("hex"), 16)
+            if size == 8 and value >= 1 << 63:
+                value -= 1 << 64
+            return value
+        if kind == MARKER_REAL:
+            if info == 2:
+                return struct.unpack_from(">f", data, position)[0]
+            return double.unpack_from(data, position)[0]
+        count, position = read_count(info, position)
+        if kind == MARKER_DATA:
+            return plistlib.Data(data[position:position + count])
+        if kind == MARKER_ASCII:
+            return data[position:position + count]
+        if kind == MARKER_UNICODE:
+            return data[position:position + count * 2].decode("utf-16be")
+        if kind == MARKER_ARRAY:
+            refs = struct.unpack_from(ref_format % count, data, position)
+            return [read(r) for r in refs]
+        if kind == MARKER_DICT:
+            refs = struct.unpack_from(ref_format % (count * 2), data, position)
+            return dict((read(k), read(v))
+                        for k, v in zip(refs[:count], refs[count:]))
+        raise ValueError("Unknown object marker 0x%02x." % marker)
+
+    return read(top)
+
+
+def encode_xml(value):
+    '''Returns value as an XML property list.'''
+    return plistlib.writePlistToString(value)
+
+
+def decode_xml(data):
+    '''Returns the object stored in an XML property list.'''
+    return plistlib.readPlistFromString(data)
+
+
+encoders = {ENCODING_XML: encode_xml,
+            ENCODING_BINARY: encode_binary}
+
+
+def encode(value, encoding=ENCODING_XML):
+    return encoders[encoding](value)
+
+
+def decode(data):
+    '''Returns the object stored in a property list of any encoding.'''
+    if data.startswith(BINARY_MAGIC):
+        return decode_binary(data)
+    return decode_xml(data)
+
+
+if __name__ == "__main__":
+    import time
+
+    def benchmark(function, value, loops=2000):
+        t0 = time.time()
+        for i in xrange(loops):
+            function(value)
+        return (time.time() - t0) * 1000000 / loops
+
+    # Payloads built by the commands the server sends.
+    import applayer
+    import server
+
+    def message(cmd):
+        data = cmd.getData()
+        data['command'] = cmd.CMD_ID
+        return data
+
+    networks = []
+    for i in xrange(20):
+        network = applayer.Network.fromState(
+            ('00:11:22:33:44:%02x' % i, 'wireless network %d' % i, False,
+             'WPA2', 'CIMSYS Inc', 6, 0, applayer.RssiStatistics().getState(),
+             0, 0, (), 0))
+        for j in xrange(32 if i == 0 else 0):
+            station = applayer.Station('00:11:22:66:%02x:%02x' % (i, j))
+            for rssi in (-61, -80, -40, -58, -66, -60):
+                station.updateRssi(rssi)
+            station.incrementDataFrameStatistics()
+            network.addStation(station)
+        for rssi in (-52, -71, -48, -55, -53, -50):
+            network.updateRssi(rssi)
+        networks.append(network)
+    network_update = message(server.NetworkBatchCmd(
+        [server.NetworkUpdateCmd(n, None).getData() for n in networks[:1]]))
+    network_batch = message(server.NetworkBatchCmd(
+        [server.NetworkUpdateCmd(n, None).getData() for n in networks]))
+    network_detail = message(server.NetworkDetailCmd(
+        networks[0], applayer.LinkStatistics()))
+    misc = {'command': 2, 'negative': -1 << 40, 'big': 1 << 40,
+            'long': 'x' * 100, 'unicode': u'\xf1and\xfa', 'flag': True,
+            'empty': [], 'data': plistlib.Data('\x00\xff' * 20)}
+
+    for value in (network_update, network_batch, network_detail, misc):
+        data = encode_binary(value)
+        if decode_binary(data) != value:
+            print "Error: binary round trip failed for %r." % value
+        if decode(data) != decode(encode_xml(value)):
+            print "Error: encodings disagree for %r." % value
+
+    # Commands split at any point are read whole and in order.
+    import socket
+
+    class Receiver(object):
+        def __init__(self):
+            self.commands = []
+            self.closed = 0
+
+        def onCommand(self, raw, client):
+            self.commands.append(decode(raw)['n'])
+
+        def onClientClosed(self, client):
+            self.closed += 1
+
+    stream = ''.join(server.LENGTH.pack(len(data)) + data for data in
+                     (encode_binary({'command': 4, 'n': i})
+                      for i in xrange(2000)))
+    for chunk in (1, 7, 4096, 65536):
+        a, b = socket.socketpair()
+        receiver = Receiver()
+        client = server.ClientDispatcher(receiver, b, {})
+        for offset in xrange(0, len(stream), chunk):
+            a.sendall(stream[offset:offset + chunk])
+            client.handle_read()
+        if receiver.commands != range(2000) or client.inBuffer:
+            print "Error: commands lost in chunks of %d bytes." % chunk
+        a.close()
+        client.close()
+    a, b = socket.socketpair()
+    receiver = Receiver()
+    client = server.ClientDispatcher(receiver, b, {})
+    a.sendall(server.LENGTH.pack(client.max_command_size + 1))
+    client.handle_read()
+    if receiver.closed != 1:
+        print "Error: oversized command did not close the connection."
+    a.close()
+
+    print "%-16s %8s %8s %12s %12s" % ("message", "encoding", "bytes",
+                                        "encode (us)", "decode (us)")
+    for name, value in (("NetworkUpdate", network_update),
+                        ("NetworkBatch", network_batch),
+                        ("NetworkDetail", network_detail)):
+        for encoding, decoder in ((ENCODING_XML, decode_xml),
+                                  (ENCODING_BINARY, decode_binary)):
+            data = encode(value, encoding)
+            print "%-16s %8s %8d %12.1f %12.1f" % (
+                name, encoding, len(data),
+                benchmark(encoders[encoding], value),
+                benchmark(decoder, data))
@@ -40,14 +40,24 @@
     NetworksViewController *nets;
     NetworkDetailController *netDetail;
     CFWriteStreamRef wStream;
+    NSMutableDictionary *networkStates;
+    NSMutableDictionary *detailClients;
+    // Received bytes of the messages not complete yet.
+    NSMutableData *inBuffer;
 }
 
 + (Manager *)getInstance;
 - (void)updateNetwork:(Network *)newNetwork;
+- (void)updateNetworkDelta:(NSDictionary *)delta;
+- (NetworkDetail *)mergeNetworkDetail:(NSDictionary *)cmd;
 - (void)updateNetworkDetail:(NetworkDetail *)newNetworkDetail;
 - (void)setChannel:(int)channel;
 - (void)setNetwork:(NSString *)bssid;
 - (void)unsetNetwork;
+- (void)resync;
+- (void)setEncoding:(NSString *)encoding;
+- (void)readCommands:(CFReadStreamRef)stream;
+- (void)processCommand:(NSData *)raw;
 
 @property(retain) NetworksViewController *nets;
 @property(retain) NetworkDetailController *netDetail;
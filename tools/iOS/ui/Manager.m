@@ -33,11 +33,17 @@
 // Server Commands:
 #define CMD_BEACON_SEEN 0
 #define CMD_NETWORK_DETAIL 1
+#define CMD_NETWORK_BATCH 2
 
 // Client Commands:
 #define SET_CHANNEL 0
 #define SET_NETWORK 1
 #define UNSET_NETWORK 2
+#define SET_ENCODING 3
+#define RESYNC 4
+
+// Bytes read from the server stream at a time.
+#define READ_CHUNK_SIZE 16384
 
 // Called when server has a msg for us.
 void networkCallback(CFReadStreamRef stream, CFStreamEventType event, void *myPtr);
@@ -62,6 +68,9 @@ void networkCallback(CFReadStreamRef stream, CFStreamEventType event, void *myPt
     // TODO: Launch server.
     self.nets = nil;
     self.netDetail = nil;
+    networkStates = [[NSMutableDictionary alloc] init];
+    detailClients = [[NSMutableDictionary alloc] init];
+    inBuffer = [[NSMutableData alloc] init];
 
     CFReadStreamRef rStream;
     CFStreamCreatePairWithSocketToHost(kCFAllocatorDefault, CFSTR("127.0.0.1"), 61000, &rStream, &wStream);
@@ -71,6 +80,9 @@ void networkCallback(CFReadStreamRef stream, CFStreamEventType event, void *myPt
     CFReadStreamScheduleWithRunLoop(rStream, CFRunLoopGetCurrent(), kCFRunLoopCommonModes);
     CFReadStreamOpen(rStream);
     CFWriteStreamOpen(wStream);
+    // Binary plists are smaller and cheaper to build, the reader below
+    // detects the format of each message.
+    [self setEncoding:@"binary"];
     return self;
 }
 
@@ -80,6 +92,32 @@ void networkCallback(CFReadStreamRef stream, CFStreamEventType event, void *myPt
         [self.nets updateNetwork: newNetwork];
 }
 
+- (void)updateNetworkDelta:(NSDictionary *)delta
+{
+    // Only the changed fields are sent, merge them with the last state.
+    NSString *bssid = [delta objectForKey:@"bssid"];
+    NSMutableDictionary *state = [networkStates objectForKey:bssid];
+    if(state == nil) {
+        state = [NSMutableDictionary dictionaryWithDictionary:delta];
+        [networkStates setObject:state forKey:bssid];
+    }
+    else
+        [state addEntriesFromDictionary:delta];
+    [self updateNetwork:[Network networkWithDictionary:state]];
+}
+
+- (NetworkDetail *)mergeNetworkDetail:(NSDictionary *)cmd
+{
+    // Only the changed stations are sent unless it is a full snapshot.
+    if([[cmd objectForKey:@"full"] boolValue])
+        [detailClients removeAllObjects];
+    for(NSDictionary *client in [cmd objectForKey:@"clients"])
+        [detailClients setObject:client forKey:[client objectForKey:@"addr"]];
+    NSDictionary *merged = [NSDictionary dictionaryWithObject:[detailClients allValues]
+                                         forKey:@"clients"];
+    return [NetworkDetail networkDetailWithDictionary:merged];
+}
+
 - (void)updateNetworkDetail:(NetworkDetail *)newNetworkDetail
 {
     if(self.netDetail != nil)
@@ -117,6 +155,26 @@ void networkCallback(CFReadStreamRef stream, CFStreamEventType event, void *myPt
     [self sendCmd:cmd];
 }
 
+-(void)setEncoding:(NSString *)encoding
+{
+    NSDictionary *cmd = [NSDictionary dictionaryWithObjects: [NSArray arrayWithObjects:
+                                                                [NSNumber numberWithInt:SET_ENCODING],
+                                                                encoding, nil]
+                                      forKeys: [NSArray arrayWithObjects: @"command", @"encoding", nil]];
+
+    [self sendCmd:cmd];
+}
+
+-(void)resync
+{
+    NSDictionary *cmd = [NSDictionary dictionaryWithObjects: [NSArray arrayWithObjects:
+                                                                [NSNumber numberWithInt:RESYNC],
+                                                                nil]
+                                      forKeys: [NSArray arrayWithObjects: @"command", nil]];
+
+    [self sendCmd:cmd];
+}
+
 -(void)unsetNetwork
 {
     NSDictionary *cmd = [NSDictionary dictionaryWithObjects: [NSArray arrayWithObjects:
@@ -127,42 +185,68 @@ void networkCallback(CFReadStreamRef stream, CFStreamEventType event, void *myPt
     [self sendCmd:cmd];
 }
 
-@end
+-(void)processCommand:(NSData *)raw
+{
+    NSPropertyListFormat xml = NSPropertyListXMLFormat_v1_0;
+    NSDictionary *cmd = [NSPropertyListSerialization propertyListWithData: raw
+        options: NSPropertyListImmutable
+        format: &xml
+        error: nil];
+    if(cmd == nil)
+        return;
+
+    int cmd_id = [((NSNumber *)[cmd objectForKey: @"command"]) intValue];
+    if(cmd_id  == CMD_BEACON_SEEN) {
+        Network *newNetwork = [Network networkWithDictionary:cmd];
+        [self updateNetwork:newNetwork];
+    }
+    else if(cmd_id == CMD_NETWORK_BATCH) {
+        for(NSDictionary *delta in [cmd objectForKey: @"networks"])
+            [self updateNetworkDelta:delta];
+    }
+    else if(cmd_id == CMD_NETWORK_DETAIL)   {
+        NetworkDetail *newNetworkDetail = [self mergeNetworkDetail:cmd];
+        [self updateNetworkDetail:newNetworkDetail];
+    }
+}
 
+-(void)readCommands:(CFReadStreamRef)stream
+{
+    // Reads may return part of a message (a full network table is
+    // hundreds of KB), keep the bytes until the whole message arrived.
+    UInt8 chunk[READ_CHUNK_SIZE];
+    while(CFReadStreamHasBytesAvailable(stream)) {
+        CFIndex bytesRead = CFReadStreamRead(stream, chunk, sizeof(chunk));
+        if(bytesRead <= 0)
+            break;
+        [inBuffer appendBytes:chunk length:bytesRead];
+    }
+
+    const UInt8 *bytes = [inBuffer bytes];
+    NSUInteger length = [inBuffer length];
+    NSUInteger offset = 0;
+    UInt32 cmdLen;
+    while(length - offset >= sizeof(cmdLen)) {
+        memcpy(&cmdLen, bytes + offset, sizeof(cmdLen));
+        if(length - offset - sizeof(cmdLen) < cmdLen)
+            break;
+        offset += sizeof(cmdLen);
+        [self processCommand:[inBuffer subdataWithRange:NSMakeRange(offset, cmdLen)]];
+        offset += cmdLen;
+    }
+    if(offset > 0)
+        [inBuffer replaceBytesInRange:NSMakeRange(0, offset) withBytes:NULL length:0];
+}
+
+@end
 
 void networkCallback (CFReadStreamRef stream, CFStreamEventType event, void *myPtr)
 {
-    CFIndex bytesRead;
     Manager *mgr = (Manager *)myPtr;
-	UInt32 cmdLen;
-    int cmd_id;
 
     switch(event) {
         case kCFStreamEventHasBytesAvailable:
-            bytesRead = CFReadStreamRead(stream, (void *)&cmdLen, sizeof(cmdLen)); // Esto podria hacer short read
-			if(bytesRead == 4) {
-                UInt8 *buf = malloc(cmdLen);
-				if(buf != NULL) {
-                    NSData *raw = [NSData dataWithBytesNoCopy: buf length: cmdLen freeWhenDone: YES];
-                    bytesRead = CFReadStreamRead(stream, (void *)buf, cmdLen); // Esto podria hacer short read
-
-                    NSPropertyListFormat xml = NSPropertyListXMLFormat_v1_0;
-                    NSDictionary *cmd = [NSPropertyListSerialization propertyListWithData: raw
-                        options: NSPropertyListImmutable
-                        format: &xml 
-                        error: nil];
-
-                    cmd_id = [((NSNumber *)[cmd objectForKey: @"command"]) intValue];
-                    if(cmd_id  == CMD_BEACON_SEEN) {
-	                	Network *newNetwork = [Network networkWithDictionary:cmd];
-	                	[mgr updateNetwork:newNetwork];
-					}
-                    else if(cmd_id == CMD_NETWORK_DETAIL)   {
-                        NetworkDetail *newNetworkDetail = [NetworkDetail networkDetailWithDictionary:cmd];
-                        [mgr updateNetworkDetail:newNetworkDetail];
-                    }
-	            }
-			}
+            [mgr readCommands:stream];
             break;
         case kCFStreamEventErrorOccurred:
             /* 